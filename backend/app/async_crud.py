@@ -0,0 +1,93 @@
+"""
+Async versions of the crud functions.
+
+Each one runs the synchronous implementation in crud.py through
+database.run_db, so the SQL stays in one place and the event loop is never
+blocked, whether the session is an AsyncSession or a plain Session.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import crud, search
+from .database import run_db
+from .models import User, RecommendationSet, RecommendationBody, RecommendationJob
+from .schemas import HistoryItem, SearchResult
+
+async def create_user(db, user_id: str) -> User:
+    """Create or get existing user"""
+    return await run_db(db, crud.create_user, user_id)
+
+async def create_recommendation_set(
+    db,
+    user_id: str,
+    prompt_text: str,
+    recommendations_data: dict,
+    usage: Optional[Dict[str, Any]] = None
+) -> RecommendationSet:
+    """Create a new recommendation set with all related data"""
+    return await run_db(
+        db,
+        crud.create_recommendation_set,
+        user_id=user_id,
+        prompt_text=prompt_text,
+        recommendations_data=recommendations_data,
+        usage=usage
+    )
+
+async def get_user_history(
+    db,
+    user_id: str,
+    limit: int = 50,
+    cursor: Optional[str] = None
+) -> Tuple[List[HistoryItem], Optional[str]]:
+    """Get one page of a user's recommendation history"""
+    return await run_db(db, crud.get_user_history, user_id, limit=limit, cursor=cursor)
+
+async def get_recommendation_set(db, set_id: str) -> Optional[RecommendationSet]:
+    """Get a specific recommendation set by ID with its whole tree loaded"""
+    return await run_db(db, crud.get_recommendation_set, set_id)
+
+async def get_recommendation_etag(db, set_id: str) -> Optional[str]:
+    """Get a set's ETag without loading its body"""
+    return await run_db(db, crud.get_recommendation_etag, set_id)
+
+async def get_recommendation_body(db, set_id: str) -> Optional[RecommendationBody]:
+    """Get a set's stored, serialized response"""
+    return await run_db(db, crud.get_recommendation_body, set_id)
+
+async def store_recommendation_body(db, set_id: str, response: dict) -> RecommendationBody:
+    """Store the serialized response of a set written before bodies existed"""
+    return await run_db(db, crud.store_recommendation_body, set_id, response)
+
+async def search_recommendation_sets(
+    db,
+    query: str,
+    user_id: Optional[str] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    match_all: bool = True
+) -> Tuple[List[SearchResult], Optional[str]]:
+    """Get one page of full-text search results, best match first"""
+    return await run_db(
+        db, search.search_recommendation_sets, query,
+        user_id=user_id, limit=limit, cursor=cursor, match_all=match_all
+    )
+
+async def create_job(
+    db,
+    user_id: str,
+    prompt_text: str,
+    bypass_cache: bool = False,
+    idempotency_key: Optional[str] = None
+) -> Tuple[RecommendationJob, bool]:
+    """Queue a recommendation job, deduplicated by idempotency key"""
+    return await run_db(
+        db, crud.create_job, user_id, prompt_text, bypass_cache=bypass_cache, idempotency_key=idempotency_key
+    )
+
+async def get_job(db, job_id: str) -> Optional[RecommendationJob]:
+    """Get a recommendation job by ID"""
+    return await run_db(db, crud.get_job, job_id)
+
+async def get_job_by_idempotency_key(db, user_id: str, idempotency_key: str) -> Optional[RecommendationJob]:
+    """Get the job a user submitted under an idempotency key"""
+    return await run_db(db, crud.get_job_by_idempotency_key, user_id, idempotency_key)
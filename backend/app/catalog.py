@@ -0,0 +1,338 @@
+"""
+Canonical product catalog.
+
+Each distinct product (by normalized brand and name) is stored once in
+catalog_products with its pros/cons and store links; pro/con strings are
+interned in catalog_texts. A category references its products through
+category_products, which keeps the display order and, when one answer words
+a product differently from the canonical copy, a JSON overlay of just the
+fields that differ. Merging the overlay back reproduces the original answer
+exactly.
+"""
+import json
+import logging
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+from sqlalchemy import insert, literal_column, select, tuple_
+from sqlalchemy.orm import Session
+
+from .models import (
+    CategoryProduct, CatalogProduct, CatalogProductDetail, CatalogStoreLink, CatalogText,
+    Product, ProductDetail, StoreLink,
+)
+
+# Keeps IN lists well under SQLite's bound-parameter limit
+CHUNK_SIZE = 400
+
+logger = logging.getLogger(__name__)
+
+CatalogKey = Tuple[str, str]
+
+# Known retailer domains, matched against the link's host and its parent domains
+STORE_DOMAINS = {
+    "rei.com": "REI",
+    "evo.com": "Evo",
+    "backcountry.com": "Backcountry",
+}
+
+def get_store_name(url: str) -> str:
+    """Resolve a store name from a product URL using STORE_DOMAINS"""
+    parsed = urlparse(url if "//" in url else f"//{url}")
+    labels = (parsed.hostname or "").split(".")
+    for i in range(len(labels) - 1):
+        store_name = STORE_DOMAINS.get(".".join(labels[i:]))
+        if store_name:
+            return store_name
+    return "Unknown"
+
+def _normalize(value: Optional[str]) -> str:
+    return " ".join((value or "").lower().split())
+
+def catalog_key(brand: Optional[str], name: Optional[str]) -> CatalogKey:
+    """The canonical identity of a product: case- and whitespace-insensitive brand and name"""
+    return _normalize(brand), _normalize(name)
+
+def product_fields(product_data: Dict[str, Any]) -> Dict[str, Any]:
+    """A Gemini product in API response form (field order included)"""
+    return {
+        "name": product_data["name"],
+        "brand": product_data["brand"],
+        "description": product_data["description"],
+        "priceRange": product_data.get("priceRange", "") or "",
+        "pros": list(product_data.get("pros", []) or []),
+        "cons": list(product_data.get("cons", []) or []),
+        "highlight": product_data["highlight"],
+        "storeLink": list(product_data.get("storeLink", []) or []),
+    }
+
+def catalog_product_to_dict(catalog_product: CatalogProduct) -> Dict[str, Any]:
+    """A loaded catalog product (details and links included) in API response form"""
+    details = {"pro": [], "con": []}
+    for detail in catalog_product.details:
+        details.setdefault(detail.type, []).append(detail.text.text)
+    return {
+        "name": catalog_product.name,
+        "brand": catalog_product.brand,
+        "description": catalog_product.description,
+        "priceRange": catalog_product.price_range or "",
+        "pros": details["pro"],
+        "cons": details["con"],
+        "highlight": catalog_product.highlight,
+        "storeLink": [link.url for link in catalog_product.store_links],
+    }
+
+def category_item_to_product(item: CategoryProduct) -> Dict[str, Any]:
+    """The product exactly as it appeared in the set: canonical fields plus overrides"""
+    product = catalog_product_to_dict(item.catalog_product)
+    if item.overrides:
+        product.update(json.loads(item.overrides))
+    return product
+
+def _chunks(items: Sequence, size: int = CHUNK_SIZE) -> Iterator[Sequence]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _insert_ignore(db: Session, model, rows: List[dict]) -> None:
+    """Bulk insert that skips rows whose unique key already exists"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        raise NotImplementedError(f"Catalog writes are not supported on {dialect}")
+    db.execute(dialect_insert(model).on_conflict_do_nothing(), rows)
+
+def intern_texts(db: Session, texts: Iterable[str]) -> Dict[str, int]:
+    """Returns the catalog_texts id of every string, inserting the new ones"""
+    texts = list(dict.fromkeys(texts))
+    if not texts:
+        return {}
+    _insert_ignore(db, CatalogText, [{"text": text} for text in texts])
+    ids = {}
+    for chunk in _chunks(texts):
+        ids.update(db.execute(select(CatalogText.text, CatalogText.id).where(CatalogText.text.in_(chunk))).all())
+    return ids
+
+def _find_catalog_ids(db: Session, keys: Iterable[CatalogKey]) -> Dict[CatalogKey, str]:
+    keys = list(keys)
+    found = {}
+    for chunk in _chunks(keys):
+        rows = db.execute(
+            select(CatalogProduct.brand_key, CatalogProduct.name_key, CatalogProduct.id)
+            .where(tuple_(CatalogProduct.brand_key, CatalogProduct.name_key).in_(chunk))
+        ).all()
+        found.update(((row.brand_key, row.name_key), row.id) for row in rows)
+    return found
+
+def _insert_catalog_children(db: Session, products: Dict[str, Dict[str, Any]]) -> None:
+    """Writes pros/cons and store links for newly created catalog products"""
+    text_ids = intern_texts(db, (text for p in products.values() for text in p["pros"] + p["cons"]))
+    details, links = [], []
+    for catalog_id, product in products.items():
+        position = 0
+        for detail_type, key in (("pro", "pros"), ("con", "cons")):
+            for text in product[key]:
+                details.append({
+                    "catalog_product_id": catalog_id,
+                    "position": position,
+                    "type": detail_type,
+                    "text_id": text_ids[text],
+                })
+                position += 1
+        for position, url in enumerate(product["storeLink"]):
+            links.append({
+                "catalog_product_id": catalog_id,
+                "position": position,
+                "url": url,
+                "store_name": get_store_name(url),
+            })
+    if details:
+        db.execute(insert(CatalogProductDetail), details)
+    if links:
+        db.execute(insert(CatalogStoreLink), links)
+
+def _load_canonical(db: Session, catalog_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Canonical API-form products by id, in three queries per chunk"""
+    canonical = {}
+    for chunk in _chunks(list(catalog_ids)):
+        for row in db.execute(select(CatalogProduct).where(CatalogProduct.id.in_(chunk))).scalars():
+            canonical[row.id] = {
+                "name": row.name,
+                "brand": row.brand,
+                "description": row.description,
+                "priceRange": row.price_range or "",
+                "pros": [],
+                "cons": [],
+                "highlight": row.highlight,
+                "storeLink": [],
+            }
+        details = db.execute(
+            select(CatalogProductDetail.catalog_product_id, CatalogProductDetail.type, CatalogText.text)
+            .join(CatalogText, CatalogText.id == CatalogProductDetail.text_id)
+            .where(CatalogProductDetail.catalog_product_id.in_(chunk))
+            .order_by(CatalogProductDetail.catalog_product_id, CatalogProductDetail.position)
+        ).all()
+        for catalog_id, detail_type, text in details:
+            canonical[catalog_id]["pros" if detail_type == "pro" else "cons"].append(text)
+        links = db.execute(
+            select(CatalogStoreLink.catalog_product_id, CatalogStoreLink.url)
+            .where(CatalogStoreLink.catalog_product_id.in_(chunk))
+            .order_by(CatalogStoreLink.catalog_product_id, CatalogStoreLink.position)
+        ).all()
+        for catalog_id, url in links:
+            canonical[catalog_id]["storeLink"].append(url)
+    return canonical
+
+def load_category_products(
+    db: Session,
+    category_ids: Iterable[str],
+    canonical: Optional[Dict[str, Dict[str, Any]]] = None
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    The products of many categories in API response form, keyed by category
+    id and in display order. Canonical products already in `canonical` are
+    not loaded again; the ones loaded are added to it.
+    """
+    canonical = {} if canonical is None else canonical
+    items = []
+    for chunk in _chunks(list(category_ids)):
+        items.extend(db.execute(
+            select(CategoryProduct.category_id, CategoryProduct.catalog_product_id, CategoryProduct.overrides)
+            .where(CategoryProduct.category_id.in_(chunk))
+            .order_by(CategoryProduct.category_id, CategoryProduct.position)
+        ).all())
+    canonical.update(_load_canonical(db, {item.catalog_product_id for item in items} - canonical.keys()))
+    products: Dict[str, List[Dict[str, Any]]] = {}
+    for category_id, catalog_id, overrides in items:
+        product = dict(canonical[catalog_id])
+        if overrides:
+            product.update(json.loads(overrides))
+        products.setdefault(category_id, []).append(product)
+    return products
+
+def link_catalog_products(db: Session, items: List[Dict[str, Any]]) -> List[dict]:
+    """
+    Resolves pending category products to catalog rows (no commit).
+
+    `items` are {"category_id", "position", "product"} mappings as produced by
+    crud.build_recommendation_rows. Unknown products become new canonical
+    entries; known ones are diffed against their canonical copy. Returns the
+    category_products rows to insert.
+    """
+    products = [product_fields(item["product"]) for item in items]
+    keys = [catalog_key(p["brand"], p["name"]) for p in products]
+    catalog_ids = _find_catalog_ids(db, set(keys))
+
+    # The first answer to mention a product defines its canonical copy
+    missing: Dict[CatalogKey, Dict[str, Any]] = {}
+    for key, product in zip(keys, products):
+        if key not in catalog_ids:
+            missing.setdefault(key, product)
+
+    canonical: Dict[str, Dict[str, Any]] = {}
+    if missing:
+        candidates = {key: str(uuid.uuid4()) for key in missing}
+        now = datetime.utcnow()
+        _insert_ignore(db, CatalogProduct, [
+            {
+                "id": candidates[key],
+                "brand_key": key[0],
+                "name_key": key[1],
+                "name": product["name"],
+                "brand": product["brand"],
+                "description": product["description"],
+                "price_range": product["priceRange"],
+                "highlight": product["highlight"],
+                "created_at": now,
+            }
+            for key, product in missing.items()
+        ])
+        # Re-read: a concurrent writer may have created some of them first
+        catalog_ids.update(_find_catalog_ids(db, missing))
+        created = {catalog_ids[key]: missing[key] for key in missing if catalog_ids[key] == candidates[key]}
+        _insert_catalog_children(db, created)
+        canonical.update(created)
+    canonical.update(_load_canonical(db, set(catalog_ids.values()) - set(canonical)))
+
+    rows = []
+    for item, key, product in zip(items, keys, products):
+        catalog_id = catalog_ids[key]
+        base = canonical[catalog_id]
+        overrides = {field: value for field, value in product.items() if base[field] != value}
+        rows.append({
+            "category_id": item["category_id"],
+            "position": item["position"],
+            "catalog_product_id": catalog_id,
+            "overrides": json.dumps(overrides) if overrides else None,
+        })
+    return rows
+
+def migrate_legacy_products(db: Session, batch_size: int = 200) -> int:
+    """
+    Moves per-set product copies (products, product_details, store_links)
+    into the catalog, `batch_size` categories per transaction. Safe to rerun:
+    migrated rows are deleted, so a finished database is a no-op.
+    Returns the number of products migrated.
+    """
+    # Legacy rows had no explicit order and were always read back in SQLite
+    # rowid order, so that is the order preserved here
+    rowid = literal_column("rowid")
+    migrated = 0
+    while True:
+        category_ids = [row[0] for row in db.execute(select(Product.category_id).distinct().limit(batch_size))]
+        if not category_ids:
+            break
+
+        legacy_products = db.execute(
+            select(Product).where(Product.category_id.in_(category_ids)).order_by(Product.category_id, rowid)
+        ).scalars().all()
+        product_ids = select(Product.id).where(Product.category_id.in_(category_ids))
+        details: Dict[str, Dict[str, List[str]]] = {}
+        for product_id, detail_type, text in db.execute(
+            select(ProductDetail.product_id, ProductDetail.type, ProductDetail.text)
+            .where(ProductDetail.product_id.in_(product_ids)).order_by(rowid)
+        ):
+            details.setdefault(product_id, {}).setdefault(detail_type, []).append(text)
+        links: Dict[str, List[str]] = {}
+        for product_id, url in db.execute(
+            select(StoreLink.product_id, StoreLink.url).where(StoreLink.product_id.in_(product_ids)).order_by(rowid)
+        ):
+            links.setdefault(product_id, []).append(url)
+
+        items = []
+        positions: Dict[str, int] = {}
+        for product in legacy_products:
+            position = positions.get(product.category_id, 0)
+            positions[product.category_id] = position + 1
+            product_details = details.get(product.id, {})
+            items.append({
+                "category_id": product.category_id,
+                "position": position,
+                "product": {
+                    "name": product.name,
+                    "brand": product.brand,
+                    "description": product.description,
+                    "priceRange": product.price_range or "",
+                    "pros": product_details.get("pro", []),
+                    "cons": product_details.get("con", []),
+                    "highlight": product.highlight,
+                    "storeLink": links.get(product.id, []),
+                },
+            })
+
+        try:
+            db.execute(insert(CategoryProduct), link_catalog_products(db, items))
+            db.execute(ProductDetail.__table__.delete().where(ProductDetail.product_id.in_(product_ids)))
+            db.execute(StoreLink.__table__.delete().where(StoreLink.product_id.in_(product_ids)))
+            db.execute(Product.__table__.delete().where(Product.category_id.in_(category_ids)))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        migrated += len(items)
+        logger.info("Migrated %d legacy products into the catalog", migrated)
+    return migrated
@@ -1,10 +1,24 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from typing import List, Optional
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import and_, desc, insert, or_, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from typing import Any, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
+import base64
+import json
+import binascii
 import uuid
-from .models import User, RecommendationSet, Category, Product, ProductDetail, StoreLink
+from .models import (
+    User, RecommendationSet, RecommendationBody, RecommendationJob, Category, CategoryProduct, CatalogProduct,
+    CatalogProductDetail,
+)
+from .catalog import category_item_to_product, link_catalog_products
+from .search import index_documents, search_document
+from .similarity import index_sets
+from .response_bodies import body_row, negotiate_body
 from .schemas import HistoryItem
+from .metrics import STAGE_SECONDS, timed
 
+@timed(STAGE_SECONDS, stage="db_user")
 def create_user(db: Session, user_id: str) -> User:
     """Create or get existing user"""
     user = db.query(User).filter(User.id == user_id).first()
@@ -15,105 +29,438 @@ def create_user(db: Session, user_id: str) -> User:
         db.refresh(user)
     return user
 
+def build_recommendation_rows(
+    user_id: str,
+    prompt_text: str,
+    recommendations_data: dict,
+    set_id: Optional[str] = None,
+    created_at: Optional[datetime] = None,
+    usage: Optional[Dict[str, Any]] = None
+) -> Dict[str, List[dict]]:
+    """
+    Flatten a recommendation tree into per-table row mappings.
+
+    Primary keys are generated here so that every table can be inserted in a
+    single batch without waiting for parent rows to come back from the DB.
+    `usage` is the Gemini token usage and model tier of the call that
+    produced the answer, or the set it was reused from (see similarity.py).
+    """
+    usage = usage or {}
+    set_id = set_id or str(uuid.uuid4())
+    created_at = created_at or datetime.utcnow()
+    rows = {
+        "recommendation_sets": [{
+            "id": set_id,
+            "user_id": user_id,
+            "prompt_text": prompt_text,
+            "created_at": created_at,
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "cached_tokens": usage.get("cached_tokens"),
+            "output_tokens": usage.get("output_tokens"),
+            "model_tier": usage.get("model_tier"),
+            "model": usage.get("model"),
+            "reused_from": usage.get("reused_from"),
+            "similarity": usage.get("similarity"),
+        }],
+        # The GET response, rendered once since the set never changes
+        "recommendation_bodies": [body_row(set_id, {
+            **recommendations_data,
+            "id": set_id,
+            "prompt_text": prompt_text,
+            "created_at": created_at.isoformat(),
+        })],
+        "categories": [],
+        "category_products": [],
+    }
+    
+    for category_data in recommendations_data.get("categories", []):
+        category_id = str(uuid.uuid4())
+        rows["categories"].append({
+            "id": category_id,
+            "recommendation_set_id": set_id,
+            "title": category_data["categoryTitle"],
+        })
+        
+        # Resolved against the product catalog at insert time
+        for position, product_data in enumerate(category_data.get("products", [])):
+            rows["category_products"].append({
+                "category_id": category_id,
+                "position": position,
+                "product": product_data,
+            })
+    
+    return rows
+
+# Parent tables first so foreign keys are always satisfied
+_BULK_INSERT_ORDER = [
+    ("recommendation_sets", RecommendationSet),
+    ("recommendation_bodies", RecommendationBody),
+    ("categories", Category),
+]
+
+def insert_recommendation_rows(db: Session, rows_list: List[Dict[str, List[dict]]]) -> None:
+    """Insert one or more flattened trees with one executemany per table (no commit)"""
+    for table_name, model in _BULK_INSERT_ORDER:
+        table_rows = [row for rows in rows_list for row in rows[table_name]]
+        if table_rows:
+            db.execute(insert(model), table_rows)
+    
+    items = [item for rows in rows_list for item in rows["category_products"]]
+    if items:
+        db.execute(insert(CategoryProduct), link_catalog_products(db, items))
+    
+    # Keep the full-text index in step with the sets
+    index_documents(db, [
+        search_document(
+            rows["recommendation_sets"][0]["id"],
+            rows["recommendation_sets"][0]["user_id"],
+            rows["recommendation_sets"][0]["prompt_text"],
+            (item["product"] for item in rows["category_products"]),
+        )
+        for rows in rows_list
+    ])
+
+def _insert_missing_users(db: Session, rows_list: List[Dict[str, List[dict]]]) -> None:
+    user_ids = {rows["recommendation_sets"][0]["user_id"] for rows in rows_list}
+    existing = {row.id for row in db.query(User.id).filter(User.id.in_(user_ids))}
+    missing = [{"id": user_id, "created_at": datetime.utcnow()} for user_id in user_ids - existing]
+    if missing:
+        db.execute(insert(User), missing)
+
+@timed(STAGE_SECONDS, stage="db_write")
+def write_recommendation_sets(db: Session, rows_list: List[Dict[str, List[dict]]]) -> None:
+    """
+    Persist several flattened trees (see build_recommendation_rows) in one
+    transaction, creating any users they reference that do not exist yet.
+    """
+    try:
+        _insert_missing_users(db, rows_list)
+        insert_recommendation_rows(db, rows_list)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    index_sets(rows_list)
+
+@timed(STAGE_SECONDS, stage="db_write")
 def create_recommendation_set(
     db: Session, 
     user_id: str, 
     prompt_text: str, 
-    recommendations_data: dict
+    recommendations_data: dict,
+    usage: Optional[Dict[str, Any]] = None
 ) -> RecommendationSet:
-    """Create a new recommendation set with all related data"""
-    
-    # Create the recommendation set
-    recommendation_set = RecommendationSet(
-        user_id=user_id,
-        prompt_text=prompt_text
-    )
-    db.add(recommendation_set)
-    db.commit()
-    db.refresh(recommendation_set)
-    
-    # Create categories and products
-    for category_data in recommendations_data.get("categories", []):
-        category = Category(
-            recommendation_set_id=recommendation_set.id,
-            title=category_data["categoryTitle"]
-        )
-        db.add(category)
+    """Create a new recommendation set with all related data in one transaction"""
+    rows = build_recommendation_rows(user_id, prompt_text, recommendations_data, usage=usage)
+    try:
+        insert_recommendation_rows(db, [rows])
         db.commit()
-        db.refresh(category)
-        
-        # Create products for this category
-        for product_data in category_data.get("products", []):
-            product = Product(
-                category_id=category.id,
-                name=product_data["name"],
-                brand=product_data["brand"],
-                description=product_data["description"],
-                price_range=product_data.get("priceRange", ""),
-                highlight=product_data["highlight"]
-            )
-            db.add(product)
-            db.commit()
-            db.refresh(product)
-            
-            # Create store links (if any)
-            store_links = product_data.get("storeLink", [])
-            if store_links and len(store_links) > 0:
-                for store_link in store_links:
-                    # Extract store name from URL
-                    store_name = "Unknown"
-                    if "rei.com" in store_link:
-                        store_name = "REI"
-                    elif "evo.com" in store_link:
-                        store_name = "Evo"
-                    elif "backcountry.com" in store_link:
-                        store_name = "Backcountry"
-                    
-                    store_link_obj = StoreLink(
-                        product_id=product.id,
-                        url=store_link,
-                        store_name=store_name
-                    )
-                    db.add(store_link_obj)
-            
-            # Create product details (pros and cons)
-            for pro in product_data.get("pros", []):
-                pro_detail = ProductDetail(
-                    product_id=product.id,
-                    type="pro",
-                    text=pro
-                )
-                db.add(pro_detail)
-            
-            for con in product_data.get("cons", []):
-                con_detail = ProductDetail(
-                    product_id=product.id,
-                    type="con",
-                    text=con
-                )
-                db.add(con_detail)
-    
-    db.commit()
-    return recommendation_set
+    except Exception:
+        db.rollback()
+        raise
+    index_sets([rows])
+    return db.get(RecommendationSet, rows["recommendation_sets"][0]["id"])
+
+def encode_history_cursor(created_at: datetime, set_id: str) -> str:
+    """Encode a history position as an opaque, URL-safe cursor"""
+    raw = f"{created_at.isoformat()}|{set_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_history_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Decode a history cursor; raises ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        created_at, set_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), set_id
+    except (UnicodeError, binascii.Error, ValueError) as e:
+        raise ValueError("Invalid history cursor") from e
 
-def get_user_history(db: Session, user_id: str) -> List[HistoryItem]:
-    """Get user's recommendation history"""
-    recommendation_sets = db.query(RecommendationSet)\
-        .filter(RecommendationSet.user_id == user_id)\
-        .order_by(desc(RecommendationSet.created_at))\
+@timed(STAGE_SECONDS, stage="db_read")
+def get_user_history(
+    db: Session,
+    user_id: str,
+    limit: int = 50,
+    cursor: Optional[str] = None
+) -> Tuple[List[HistoryItem], Optional[str]]:
+    """
+    Get one page of a user's recommendation history, newest first.
+
+    Pages are keyed on (created_at, id) and walk the composite
+    (user_id, created_at, id) index, so deep pages cost the same as the first.
+    Returns the items and the cursor for the next page (None on the last page).
+    """
+    query = db.query(RecommendationSet.id, RecommendationSet.prompt_text, RecommendationSet.created_at)\
+        .filter(RecommendationSet.user_id == user_id)
+    if cursor:
+        created_at, set_id = decode_history_cursor(cursor)
+        query = query.filter(
+            tuple_(RecommendationSet.created_at, RecommendationSet.id) < tuple_(created_at, set_id)
+        )
+    rows = query\
+        .order_by(desc(RecommendationSet.created_at), desc(RecommendationSet.id))\
+        .limit(limit + 1)\
         .all()
     
-    return [
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_history_cursor(rows[-1].created_at, rows[-1].id)
+    
+    items = [
         HistoryItem(
-            id=str(rs.id),
-            prompt_text=rs.prompt_text,
-            created_at=rs.created_at.isoformat()
+            id=str(row.id),
+            prompt_text=row.prompt_text,
+            created_at=row.created_at.isoformat()
         )
-        for rs in recommendation_sets
+        for row in rows
     ]
+    return items, next_cursor
 
+@timed(STAGE_SECONDS, stage="db_read")
 def get_recommendation_set(db: Session, set_id: str) -> Optional[RecommendationSet]:
-    """Get a specific recommendation set by ID"""
-    return db.query(RecommendationSet)\
+    """
+    Get a specific recommendation set by ID with its whole tree eagerly loaded.
+
+    The selectinload chains fetch each level with one IN query, so a read costs
+    six queries no matter how many categories and products the set has.
+    Archived sets have no tree; their stored body is loaded instead.
+    """
+    catalog_products = selectinload(RecommendationSet.categories)\
+        .selectinload(Category.items)\
+        .selectinload(CategoryProduct.catalog_product)
+    recommendation_set = db.query(RecommendationSet)\
+        .options(
+            catalog_products.selectinload(CatalogProduct.details).joinedload(CatalogProductDetail.text),
+            catalog_products.selectinload(CatalogProduct.store_links),
+        )\
         .filter(RecommendationSet.id == set_id)\
         .first()
+    if recommendation_set is not None and recommendation_set.archived_at is not None:
+        # Async callers cannot lazy-load once this returns
+        db.refresh(recommendation_set, ["response_body"])
+    return recommendation_set
+
+@timed(STAGE_SECONDS, stage="db_read")
+def get_recommendation_etag(db: Session, set_id: str) -> Optional[str]:
+    """Get a set's ETag from its stored body without loading the body"""
+    return db.query(RecommendationBody.etag).filter(RecommendationBody.set_id == set_id).scalar()
+
+@timed(STAGE_SECONDS, stage="db_read")
+def get_recommendation_body(db: Session, set_id: str) -> Optional[RecommendationBody]:
+    """Get a set's stored, serialized response"""
+    return db.get(RecommendationBody, set_id)
+
+@timed(STAGE_SECONDS, stage="db_write")
+def store_recommendation_body(db: Session, set_id: str, response: dict) -> RecommendationBody:
+    """
+    Store the serialized response of a set written before bodies existed.
+    A concurrent reader may store it first; its row is returned then.
+    """
+    row = body_row(set_id, response)
+    try:
+        db.execute(insert(RecommendationBody), [row])
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return db.get(RecommendationBody, set_id)
+    return RecommendationBody(**row)
+
+def recommendation_set_to_response(recommendation_set: RecommendationSet) -> dict:
+    """Convert a loaded recommendation set back to the API response format"""
+    if recommendation_set.archived_at is not None:
+        body = recommendation_set.response_body
+        return json.loads(negotiate_body(body.body, body.encoding, None)[0])
+    categories = []
+    for category in recommendation_set.categories:
+        products = [category_item_to_product(item) for item in category.items]
+        
+        categories.append({
+            "categoryTitle": category.title,
+            "products": products
+        })
+    
+    return {
+        "categories": categories,
+        "id": str(recommendation_set.id),
+        "prompt_text": recommendation_set.prompt_text,
+        "created_at": recommendation_set.created_at.isoformat()
+    }
+
+def create_job(
+    db: Session,
+    user_id: str,
+    prompt_text: str,
+    bypass_cache: bool = False,
+    idempotency_key: Optional[str] = None
+) -> Tuple[RecommendationJob, bool]:
+    """
+    Queue a recommendation job. With an idempotency key, a job the user
+    already submitted under that key is returned instead of a new one.
+    Returns the job and whether it was created.
+    """
+    if idempotency_key is not None:
+        existing = get_job_by_idempotency_key(db, user_id, idempotency_key)
+        if existing is not None:
+            return existing, False
+    job = RecommendationJob(
+        user_id=user_id, prompt_text=prompt_text, bypass_cache=bypass_cache, idempotency_key=idempotency_key
+    )
+    db.add(job)
+    try:
+        db.commit()
+    except IntegrityError:
+        # A concurrent submission with the same key got there first
+        db.rollback()
+        return get_job_by_idempotency_key(db, user_id, idempotency_key), False
+    db.refresh(job)
+    return job, True
+
+def get_job(db: Session, job_id: str) -> Optional[RecommendationJob]:
+    """Get a recommendation job by ID"""
+    return db.get(RecommendationJob, job_id)
+
+def get_job_by_idempotency_key(db: Session, user_id: str, idempotency_key: str) -> Optional[RecommendationJob]:
+    """Get the job a user submitted under an idempotency key"""
+    return db.query(RecommendationJob)\
+        .filter(RecommendationJob.user_id == user_id, RecommendationJob.idempotency_key == idempotency_key)\
+        .first()
+
+def has_unfinished_jobs(db: Session) -> bool:
+    """Whether any job is still queued or running"""
+    unfinished = RecommendationJob.status.in_(("queued", "running"))
+    return db.execute(select(RecommendationJob.id).where(unfinished).limit(1)).first() is not None
+
+def claim_job(db: Session, owner: str, lease_seconds: float, max_attempts: int) -> Optional[Any]:
+    """
+    Lease the oldest available job to `owner` for `lease_seconds`.
+
+    Queued jobs are claimable once available; running jobs whose lease
+    expired (their worker died) are claimed again until they have used
+    `max_attempts`, after which they are marked failed. The claim is one
+    conditional UPDATE, so two workers can never hold the same job.
+    Returns the claimed row (id, user_id, prompt_text, bypass_cache,
+    attempts, created_at) or None.
+    """
+    now = datetime.utcnow()
+    expired = and_(RecommendationJob.status == "running", RecommendationJob.lease_expires_at < now)
+    queued = and_(RecommendationJob.status == "queued", RecommendationJob.available_at <= now)
+    # Idle workers poll, so find out with a read whether there is anything to
+    # do before taking SQLite's write lock
+    if db.execute(select(RecommendationJob.id).where(or_(queued, expired)).limit(1)).first() is None:
+        db.rollback()
+        return None
+    db.execute(
+        update(RecommendationJob)
+        .where(expired, RecommendationJob.attempts >= max_attempts)
+        .values(status="failed", error="The job's worker stopped responding", lease_owner=None, finished_at=now)
+    )
+    claimable = or_(queued, and_(expired, RecommendationJob.attempts < max_attempts))
+    oldest = select(RecommendationJob.id)\
+        .where(claimable)\
+        .order_by(RecommendationJob.available_at)\
+        .limit(1)\
+        .scalar_subquery()
+    row = db.execute(
+        update(RecommendationJob)
+        .where(RecommendationJob.id == oldest, claimable)
+        .values(
+            status="running",
+            lease_owner=owner,
+            lease_expires_at=now + timedelta(seconds=lease_seconds),
+            attempts=RecommendationJob.attempts + 1,
+        )
+        .returning(
+            RecommendationJob.id, RecommendationJob.user_id, RecommendationJob.prompt_text,
+            RecommendationJob.bypass_cache, RecommendationJob.attempts, RecommendationJob.created_at,
+        )
+    ).first()
+    db.commit()
+    return row
+
+def _owned(job_id: str, owner: str):
+    return and_(
+        RecommendationJob.id == job_id,
+        RecommendationJob.lease_owner == owner,
+        RecommendationJob.status == "running",
+    )
+
+def renew_job_lease(db: Session, job_id: str, owner: str, lease_seconds: float) -> bool:
+    """Extend a claim; False if the job is no longer held by `owner`"""
+    result = db.execute(
+        update(RecommendationJob)
+        .where(_owned(job_id, owner))
+        .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=lease_seconds))
+    )
+    db.commit()
+    return result.rowcount == 1
+
+@timed(STAGE_SECONDS, stage="db_write")
+def complete_job(db: Session, job_id: str, owner: str, rows: Dict[str, List[dict]]) -> bool:
+    """
+    Persist a job's recommendation set and mark the job succeeded in one
+    transaction. Nothing is written, and False is returned, if `owner` no
+    longer holds the job, so a job is never answered twice.
+    """
+    try:
+        _insert_missing_users(db, [rows])
+        insert_recommendation_rows(db, [rows])
+        result = db.execute(
+            update(RecommendationJob)
+            .where(_owned(job_id, owner))
+            .values(
+                status="succeeded",
+                recommendation_set_id=rows["recommendation_sets"][0]["id"],
+                lease_owner=None,
+                lease_expires_at=None,
+                error=None,
+                finished_at=datetime.utcnow(),
+            )
+        )
+        if result.rowcount != 1:
+            db.rollback()
+            return False
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    index_sets([rows])
+    return True
+
+def requeue_job(db: Session, job_id: str, owner: str, delay: float, error: Optional[str] = None, count_attempt: bool = True) -> bool:
+    """Hand a held job back to the queue, claimable again after `delay` seconds"""
+    result = db.execute(
+        update(RecommendationJob)
+        .where(_owned(job_id, owner))
+        .values(
+            status="queued",
+            available_at=datetime.utcnow() + timedelta(seconds=delay),
+            attempts=RecommendationJob.attempts - (0 if count_attempt else 1),
+            lease_owner=None,
+            lease_expires_at=None,
+            error=error,
+        )
+    )
+    db.commit()
+    return result.rowcount == 1
+
+def fail_job(db: Session, job_id: str, owner: str, error: str) -> bool:
+    """Mark a held job failed for good"""
+    result = db.execute(
+        update(RecommendationJob)
+        .where(_owned(job_id, owner))
+        .values(status="failed", error=error, lease_owner=None, lease_expires_at=None, finished_at=datetime.utcnow())
+    )
+    db.commit()
+    return result.rowcount == 1
+
+def job_to_response(job: RecommendationJob) -> dict:
+    """Convert a job to the API response format"""
+    return {
+        "id": job.id,
+        "status": job.status,
+        "prompt_text": job.prompt_text,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "recommendation_set_id": job.recommendation_set_id,
+        "error": job.error,
+    }
@@ -1,17 +1,57 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 import os
 
 # Database URL - using SQLite for simplicity
-DATABASE_URL = "sqlite:///./slopeselector.db"
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./slopeselector.db")
+
+# With USE_ASYNC_DB the request handlers use an AsyncSession (aiosqlite for
+# SQLite) instead of running synchronous sessions on worker threads
+USE_ASYNC_DB = os.environ.get("USE_ASYNC_DB", "false").lower() == "true"
+
+# Run init_db() from the app's startup hook. run_server.py's production mode
+# initializes the database once before starting workers and turns this off
+INIT_DB_ON_STARTUP = os.environ.get("INIT_DB_ON_STARTUP", "true").lower() == "true"
+
+# With SHARED_CACHE the response cache, the Gemini context cache and the rate
+# limit buckets keep their state only in the database, so every worker
+# process sees the same entries
+SHARED_CACHE = os.environ.get("SHARED_CACHE", "false").lower() == "true"
+
+def _to_async_url(url: str) -> str:
+    """Map a sync driver URL onto its asyncio driver"""
+    if url.startswith("sqlite:"):
+        return "sqlite+aiosqlite:" + url[len("sqlite:"):]
+    if url.startswith("postgresql:"):
+        return "postgresql+asyncpg:" + url[len("postgresql:"):]
+    return url
+
+ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL", _to_async_url(DATABASE_URL))
+
+_connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}  # Needed for SQLite
 
 engine = create_engine(
-    DATABASE_URL, 
-    connect_args={"check_same_thread": False}  # Needed for SQLite
+    DATABASE_URL,
+    connect_args=_connect_args
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = None
+AsyncSessionLocal = None
+if USE_ASYNC_DB:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+    async_engine = create_async_engine(ASYNC_DATABASE_URL)
+    # Objects are handed back to the event loop after the greenlet returns,
+    # so they must not expire and lazy-load on commit
+    AsyncSessionLocal = async_sessionmaker(
+        async_engine, autoflush=False, expire_on_commit=False
+    )
+
 Base = declarative_base()
 
 def get_db():
@@ -22,8 +62,81 @@ def get_db():
     finally:
         db.close()
 
+@asynccontextmanager
+async def session_scope():
+    """Open the configured session type: AsyncSession or a plain Session"""
+    if USE_ASYNC_DB:
+        async with AsyncSessionLocal() as db:
+            yield db
+    else:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            await run_in_threadpool(db.close)
+
+async def get_session():
+    """Dependency to get a session for the async crud layer"""
+    async with session_scope() as db:
+        yield db
+
+async def run_db(db, fn, *args, **kwargs):
+    """
+    Run a synchronous crud function without blocking the event loop.
+
+    An AsyncSession runs it through run_sync on the async driver; a plain
+    Session runs it on a worker thread.
+    """
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(fn, db, *args, **kwargs)
+
+async def dispose_engines():
+    """Close pooled connections on shutdown"""
+    if async_engine is not None:
+        await async_engine.dispose()
+    engine.dispose()
+
+def _add_missing_columns():
+    """create_all never alters existing tables, so add nullable columns introduced later"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+
 def init_db():
     """Initialize database tables"""
     # Import models to ensure they're registered with Base
     from . import models
+    if DATABASE_URL.startswith("sqlite"):
+        # Readers no longer wait for a writer, which matters once several
+        # worker processes share the file; the mode is stored in the file
+        with engine.connect() as conn:
+            # Only takes effect before the file is first written; older files
+            # are converted by the first maintenance pass (retention.compact)
+            conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
+
+    # create_all skips tables that already exist, so add any indexes that
+    # were introduced after the database file was first created
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+    # One-time move of per-set product copies into the shared catalog, then
+    # the search index (built from the catalog) if it does not exist yet
+    from .catalog import migrate_legacy_products
+    from .search import ensure_search_index
+    with SessionLocal() as db:
+        migrated = migrate_legacy_products(db)
+        ensure_search_index(db)
+    if migrated and DATABASE_URL.startswith("sqlite"):
+        # Hand the pages the legacy rows occupied back to the filesystem
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM")
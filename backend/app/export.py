@@ -0,0 +1,264 @@
+"""
+Streaming export of recommendation history.
+
+Sets are read through one server-side cursor (yield_per), a chunk at a
+time; each chunk's categories and products are loaded with a few IN
+queries (catalog.load_category_products) and archived sets are read from
+their stored bodies. Only one chunk is held in memory, so an export of
+any size runs in constant memory. Records are written as NDJSON, or as
+Parquet (one row group per chunk) when pyarrow is installed.
+
+Exports cover sets created in [since, until). `until` defaults to
+EXPORT_SETTLE_SECONDS ago, since write-behind stamps sets before they are
+committed; pass the returned watermark as the next export's `since` to
+get only the sets written in between.
+"""
+import hmac
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .catalog import CHUNK_SIZE, load_category_products
+from .metrics import EXPORTED_SETS
+from .models import Category, RecommendationBody, RecommendationSet
+from .response_bodies import negotiate_body
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional dependency
+    pa = pq = None
+
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", "200"))
+EXPORT_SETTLE_SECONDS = float(os.environ.get("EXPORT_SETTLE_SECONDS", "60"))
+# Canonical products kept between chunks; answers keep recommending the same ones
+EXPORT_CATALOG_CACHE_SIZE = int(os.environ.get("EXPORT_CATALOG_CACHE_SIZE", "5000"))
+# Bearer token GET /api/export requires; the endpoint is off while it is unset
+EXPORT_TOKEN = os.environ.get("EXPORT_TOKEN", "")
+
+EXPORT_FORMATS = ("ndjson", "parquet")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+_SET_COLUMNS = (
+    RecommendationSet.id, RecommendationSet.user_id, RecommendationSet.prompt_text, RecommendationSet.created_at,
+    RecommendationSet.prompt_tokens, RecommendationSet.cached_tokens, RecommendationSet.output_tokens,
+    RecommendationSet.model_tier, RecommendationSet.model, RecommendationSet.reused_from,
+    RecommendationSet.similarity, RecommendationSet.archived_at,
+)
+
+def export_authorized(authorization: Optional[str], token: str) -> bool:
+    """Whether an Authorization header carries `token` as a bearer token"""
+    scheme, _, credentials = (authorization or "").partition(" ")
+    return bool(token) and scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip(), token)
+
+def to_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Stored timestamps are naive UTC; convert aware filter values to match"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def export_window(
+    since: Optional[datetime] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+) -> tuple:
+    """
+    The (lower, upper) created_at bounds of an export: the later of the
+    watermark `since` and `start`, and the earlier of `end` and the settle
+    cutoff. The upper bound is the watermark of the export.
+    """
+    lower = max((bound for bound in (to_utc(since), to_utc(start)) if bound is not None), default=None)
+    settled = datetime.utcnow() - timedelta(seconds=EXPORT_SETTLE_SECONDS)
+    upper = min(to_utc(end), settled) if end is not None else settled
+    return lower, upper
+
+def _chunk_records(db: Session, rows: List[Any], canonical: "OrderedDict[str, Dict[str, Any]]") -> List[Dict[str, Any]]:
+    live = [row.id for row in rows if row.archived_at is None]
+    archived = [row.id for row in rows if row.archived_at is not None]
+
+    categories: Dict[str, List[Dict[str, Any]]] = {}
+    if live:
+        category_rows = db.execute(
+            select(Category.id, Category.recommendation_set_id, Category.title)
+            .where(Category.recommendation_set_id.in_(live))
+        ).all()
+        products = load_category_products(db, [row.id for row in category_rows], canonical)
+        while len(canonical) > EXPORT_CATALOG_CACHE_SIZE:
+            canonical.popitem(last=False)
+        for category_id, set_id, title in category_rows:
+            categories.setdefault(set_id, []).append({"categoryTitle": title, "products": products.get(category_id, [])})
+    if archived:
+        for set_id, encoding, body in db.execute(
+            select(RecommendationBody.set_id, RecommendationBody.encoding, RecommendationBody.body)
+            .where(RecommendationBody.set_id.in_(archived))
+        ):
+            categories[set_id] = json.loads(negotiate_body(body, encoding, None)[0])["categories"]
+
+    return [
+        {
+            "id": row.id,
+            "user_id": row.user_id,
+            "prompt_text": row.prompt_text,
+            "created_at": row.created_at,
+            "prompt_tokens": row.prompt_tokens,
+            "cached_tokens": row.cached_tokens,
+            "output_tokens": row.output_tokens,
+            "model_tier": row.model_tier,
+            "model": row.model,
+            "reused_from": row.reused_from,
+            "similarity": row.similarity,
+            "archived": row.archived_at is not None,
+            "categories": categories.get(row.id, []),
+        }
+        for row in rows
+    ]
+
+def iter_export_chunks(
+    db: Session,
+    user_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Export records of the sets created in [since, until), oldest first,
+    `chunk_size` at a time. Records carry the set's columns and its
+    categories in API response form; created_at stays a datetime.
+    """
+    query = select(*_SET_COLUMNS).order_by(RecommendationSet.created_at, RecommendationSet.id)
+    if user_id is not None:
+        query = query.where(RecommendationSet.user_id == user_id)
+    if since is not None:
+        query = query.where(RecommendationSet.created_at >= since)
+    if until is not None:
+        query = query.where(RecommendationSet.created_at < until)
+    # IN lists of a chunk's set ids stay under SQLite's parameter limit
+    chunk_size = max(1, min(chunk_size, CHUNK_SIZE))
+    canonical: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    result = db.execute(query.execution_options(yield_per=chunk_size))
+    try:
+        for rows in result.partitions():
+            records = _chunk_records(db, rows, canonical)
+            EXPORTED_SETS.inc(len(records))
+            yield records
+    finally:
+        result.close()
+
+def _ndjson(chunks: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    for records in chunks:
+        lines = []
+        for record in records:
+            record["created_at"] = record["created_at"].isoformat()
+            lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+def _parquet_schema():
+    strings = pa.list_(pa.string())
+    product = pa.struct([
+        ("name", pa.string()), ("brand", pa.string()), ("description", pa.string()), ("priceRange", pa.string()),
+        ("pros", strings), ("cons", strings), ("highlight", pa.string()), ("storeLink", strings),
+    ])
+    return pa.schema([
+        ("id", pa.string()), ("user_id", pa.string()), ("prompt_text", pa.string()),
+        ("created_at", pa.timestamp("us")), ("prompt_tokens", pa.int64()), ("cached_tokens", pa.int64()),
+        ("output_tokens", pa.int64()), ("model_tier", pa.string()), ("model", pa.string()),
+        ("reused_from", pa.string()), ("similarity", pa.float64()), ("archived", pa.bool_()),
+        ("categories", pa.list_(pa.struct([("categoryTitle", pa.string()), ("products", pa.list_(product))]))),
+    ])
+
+
+class _ChunkSink:
+    """Write-only file for ParquetWriter whose bytes are handed out as they are written"""
+
+    def __init__(self):
+        self.closed = False
+        self._parts: List[bytes] = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+def _parquet(chunks: Iterator[List[Dict[str, Any]]]) -> Iterator[bytes]:
+    schema = _parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="zstd")
+    for records in chunks:
+        writer.write_table(pa.Table.from_pylist(records, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def encode_export(chunks: Iterator[List[Dict[str, Any]]], export_format: str = "ndjson") -> Iterator[bytes]:
+    """
+    Serializes export chunks as NDJSON lines or a Parquet file, one piece
+    per chunk. Raises ValueError for an unknown format and RuntimeError for
+    Parquet without pyarrow.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {export_format}")
+    if export_format == "parquet":
+        if pa is None:
+            raise RuntimeError("Parquet export requires pyarrow: pip install pyarrow")
+        return _parquet(chunks)
+    return _ndjson(chunks)
+
+
+if __name__ == "__main__":
+    # python -m app.export --output sets.ndjson --state-file .export-watermark
+    import argparse
+    import sys
+
+    from .database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Stream recommendation history as NDJSON or Parquet")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson")
+    parser.add_argument("--output", help="file to write (default: stdout)")
+    parser.add_argument("--user", help="only this user's sets")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="sets created at or after this UTC time")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="sets created before this UTC time")
+    parser.add_argument("--state-file", help="read the watermark of the last export from this file and store the new one")
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    since = None
+    if args.state_file and os.path.exists(args.state_file):
+        with open(args.state_file) as f:
+            since = datetime.fromisoformat(f.read().strip())
+    lower, upper = export_window(since, args.start, args.end)
+
+    out = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        with SessionLocal() as db:
+            for piece in encode_export(iter_export_chunks(db, args.user, lower, upper, args.chunk_size), args.format):
+                out.write(piece)
+    finally:
+        if args.output:
+            out.close()
+    if args.state_file:
+        # Only a finished export moves the watermark
+        with open(args.state_file + ".tmp", "w") as f:
+            f.write(upper.isoformat())
+        os.replace(args.state_file + ".tmp", args.state_file)
+    print(f"Exported sets created before {upper.isoformat()} (the next export's watermark)", file=sys.stderr)
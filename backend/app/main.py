@@ -1,14 +1,54 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from typing import AsyncIterator, Dict, List, Optional, Type
+from datetime import datetime
+import json
+import logging
+import math
+import time
 import uuid
 
-from .database import get_db, init_db
+from .database import INIT_DB_ON_STARTUP, SessionLocal, dispose_engines, get_session, init_db, run_db, session_scope
 from .models import User, RecommendationSet, Category, Product, ProductDetail, StoreLink
-from .schemas import RecommendationRequest, ApiResponse, HistoryItem
-from .crud import create_user, create_recommendation_set, get_user_history, get_recommendation_set
-from .services.gemini_service import fetch_recommendations
+from .schemas import RecommendationRequest, BatchRecommendationRequest, ApiResponse, HistoryItem, JobResponse, SearchResult
+from .crud import job_to_response, recommendation_set_to_response
+from .export import EXPORT_TOKEN, MEDIA_TYPES, encode_export, export_authorized, export_window, iter_export_chunks
+from .response_bodies import IMMUTABLE_CACHE_CONTROL, etag_matches, negotiate_body, response_etag
+from .logging_config import configure_logging, request_id_var
+from .metrics import HTTP_ERRORS, HTTP_REQUESTS, HTTP_REQUEST_SECONDS, JOB_EVENTS, STAGE_SECONDS, render_metrics
+from .similarity import prompt_index
+from .async_crud import (
+    create_user,
+    create_recommendation_set,
+    get_user_history,
+    get_recommendation_set,
+    get_recommendation_etag,
+    get_recommendation_body,
+    store_recommendation_body,
+    search_recommendation_sets,
+    create_job,
+    get_job,
+    get_job_by_idempotency_key,
+)
+from .services.admission import BATCH, AdmissionRejectedError, upstream_limiter, user_rate_limiter
+from .services.batch_service import BATCH_MAX_ITEMS, run_batch
+from .services.cache_service import (
+    get_recommendations_cached,
+    lookup_cached_recommendations,
+    recommendation_cache,
+    store_cached_recommendations,
+)
+from .services.gemini_service import USAGE_KEY, single_flight, stream_recommendations
+from .services.job_queue import job_workers
+from .services.maintenance import MAINTENANCE_ENABLED, maintenance_scheduler
+from .services.json_stream import IncrementalJSONParser
+from .services.upstream import UPSTREAM_TIMEOUT, start_client, close_client, UpstreamUnavailableError
+from .services.write_behind import WRITE_BEHIND_ENABLED, WriteQueueFullError, write_behind_queue
+
+configure_logging()
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="SlopeSelector AI API", version="1.0.0")
 
@@ -19,99 +59,421 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Request-ID", "ETag", "X-Reused-From", "X-Similarity", "X-Export-Watermark"],
 )
 
-# Initialize database on startup
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Tag each request with an ID, log it and record per-endpoint metrics"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        # Label by route template so set and user ids don't explode cardinality
+        route = request.scope.get("route")
+        endpoint = getattr(route, "path", "unmatched")
+        HTTP_REQUESTS.inc(method=request.method, endpoint=endpoint, status=str(status_code))
+        HTTP_REQUEST_SECONDS.observe(elapsed, method=request.method, endpoint=endpoint)
+        if status_code >= 500:
+            HTTP_ERRORS.inc(method=request.method, endpoint=endpoint)
+        logger.info(
+            "%s %s %d",
+            request.method,
+            request.url.path,
+            status_code,
+            extra={"endpoint": endpoint, "status": status_code, "duration_ms": round(elapsed * 1000, 2)}
+        )
+        request_id_var.reset(token)
+
+def render_response(model: Type[BaseModel], data: dict) -> Response:
+    """Validate and serialize a response body, timing it as its own stage"""
+    with STAGE_SECONDS.time(stage="serialize"):
+        body = model.model_validate(data).model_dump_json()
+    return Response(content=body, media_type="application/json")
+
+# Initialize database and the shared upstream client on startup
 @app.on_event("startup")
 async def startup_event():
-    init_db()
+    if INIT_DB_ON_STARTUP:
+        init_db()
+    await start_client()
+    if prompt_index is not None:
+        async with session_scope() as db:
+            await run_db(db, prompt_index.sync)
+    if WRITE_BEHIND_ENABLED:
+        await write_behind_queue.start()
+    await job_workers.start_if_pending()
+    if MAINTENANCE_ENABLED:
+        await maintenance_scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Let answers still on their way from Gemini arrive, then drain queued
+    # writes, before the connections go away
+    await maintenance_scheduler.stop()
+    await job_workers.stop(UPSTREAM_TIMEOUT)
+    await single_flight.drain(UPSTREAM_TIMEOUT)
+    await write_behind_queue.stop()
+    await close_client()
+    await dispose_engines()
 
 @app.get("/")
 async def root():
     return {"message": "SlopeSelector AI API is running"}
 
+async def save_recommendations(db, user_id: str, prompt_text: str, recommendations: dict) -> dict:
+    """Persist a fresh answer and add the set's id and timestamp to it.
+
+    In write-behind mode the set is queued and the response is returned
+    before it reaches the database. Token usage attached by the Gemini
+    service is stored on the set and removed from the response.
+    """
+    usage = recommendations.pop(USAGE_KEY, None)
+    if WRITE_BEHIND_ENABLED:
+        return await write_behind_queue.submit(user_id, prompt_text, recommendations, usage=usage)
+    
+    # Ensure user exists
+    await create_user(db, user_id)
+    
+    recommendation_set = await create_recommendation_set(
+        db, 
+        user_id=user_id, 
+        prompt_text=prompt_text, 
+        recommendations_data=recommendations,
+        usage=usage
+    )
+    
+    # Add database info to response
+    recommendations["id"] = str(recommendation_set.id)
+    recommendations["prompt_text"] = prompt_text
+    recommendations["created_at"] = recommendation_set.created_at.isoformat()
+    return recommendations
+
+def too_many_requests(e: AdmissionRejectedError) -> HTTPException:
+    """429 telling the client how long to back off"""
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+
 @app.post("/api/recommendations", response_model=ApiResponse)
-async def get_recommendations(request: RecommendationRequest, db: Session = Depends(get_db)):
+async def get_recommendations(request: RecommendationRequest, db=Depends(get_session)):
     """Get AI-powered gear recommendations"""
     try:
-        # Ensure user exists
-        user = create_user(db, request.userId)
-        
-        # Get recommendations from Gemini API
-        recommendations = await fetch_recommendations(request.prompt)
+        await user_rate_limiter.acquire(request.userId)
+        # Get recommendations from the cache or the Gemini API
+        recommendations = await get_recommendations_cached(
+            request.prompt, bypass_cache=request.bypassCache
+        )
+        usage = recommendations.get(USAGE_KEY) or {}
         
         # Save to database
-        recommendation_set = create_recommendation_set(
-            db, 
-            user_id=request.userId, 
-            prompt_text=request.prompt, 
-            recommendations_data=recommendations
+        recommendations = await save_recommendations(db, request.userId, request.prompt, recommendations)
+        response = render_response(ApiResponse, recommendations)
+        if usage.get("reused_from"):
+            response.headers["X-Reused-From"] = usage["reused_from"]
+            response.headers["X-Similarity"] = f"{usage['similarity']:.4f}"
+        return response
+        
+    except AdmissionRejectedError as e:
+        raise too_many_requests(e)
+    except (UpstreamUnavailableError, WriteQueueFullError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        logger.exception("Error in get_recommendations: %s", e)
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+# Parts of the streamed answer that are forwarded as soon as they are complete
+STREAM_EVENT_PATHS = [
+    ("categories", "*", "categoryTitle"),
+    ("categories", "*", "products", "*"),
+    ("categories", "*"),
+]
+
+def _sse(event: str, data: dict) -> str:
+    """Format a server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _recommendation_events(request: RecommendationRequest) -> AsyncIterator[str]:
+    """Stream product and category events, then persist and send the full set"""
+    try:
+        usage = {}
+        cached = None if request.bypassCache else await lookup_cached_recommendations(request.prompt)
+        if cached is not None:
+            usage = cached.pop(USAGE_KEY, None) or {}
+            if usage.get("reused_from"):
+                yield _sse("reused", {"reusedFrom": usage["reused_from"], "similarity": usage["similarity"]})
+            async def replay():
+                yield json.dumps(cached)
+            chunks = replay()
+        else:
+            chunks = stream_recommendations(request.prompt, usage=usage)
+        
+        parser = IncrementalJSONParser(STREAM_EVENT_PATHS)
+        category_titles = {}
+        async for chunk in chunks:
+            for path, value in parser.feed(chunk):
+                if path[-1] == "categoryTitle":
+                    category_titles[path[1]] = value
+                elif len(path) == 4:
+                    yield _sse("product", {
+                        "categoryIndex": path[1],
+                        "productIndex": path[3],
+                        "categoryTitle": category_titles.get(path[1]),
+                        "product": value
+                    })
+                else:
+                    yield _sse("category", {"categoryIndex": path[1], "category": value})
+        
+        recommendations = ApiResponse.model_validate(parser.result()).model_dump(
+            include={"categories"}
         )
+        if cached is None:
+            await store_cached_recommendations(request.prompt, recommendations)
+        if usage:
+            recommendations[USAGE_KEY] = usage
         
-        # Add database info to response
-        recommendations["id"] = str(recommendation_set.id)
-        recommendations["prompt_text"] = request.prompt
-        recommendations["created_at"] = recommendation_set.created_at.isoformat()
+        # Save to database once the whole answer is in
+        async with session_scope() as db:
+            recommendations = await save_recommendations(db, request.userId, request.prompt, recommendations)
         
-        return recommendations
+        yield _sse("complete", recommendations)
         
+    except AdmissionRejectedError as e:
+        yield _sse("error", {"detail": str(e), "retryAfter": math.ceil(e.retry_after)})
     except Exception as e:
-        print(f"Error in get_recommendations: {e}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+        logger.exception("Error in stream_recommendations: %s", e)
+        yield _sse("error", {"detail": f"Internal server error: {str(e)}"})
+
+@app.post("/api/recommendations/stream")
+async def get_recommendations_stream(request: RecommendationRequest):
+    """Stream AI-powered gear recommendations as server-sent events"""
+    # Shed before the stream starts, while a status code can still be sent
+    try:
+        await user_rate_limiter.acquire(request.userId)
+        upstream_limiter.check()
+    except AdmissionRejectedError as e:
+        raise too_many_requests(e)
+    return StreamingResponse(
+        _recommendation_events(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/recommendations/batch")
+async def get_recommendations_batch(request: BatchRecommendationRequest):
+    """Generate recommendations for many prompts, streamed back as NDJSON.
+
+    Each line reports one item (by its index in the request) as soon as it is
+    done, with either its saved recommendation set or its error.
+    """
+    if len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"A batch may contain at most {BATCH_MAX_ITEMS} items")
+    try:
+        upstream_limiter.check(BATCH)
+    except AdmissionRejectedError as e:
+        raise too_many_requests(e)
+    return StreamingResponse(run_batch(request.items), media_type="application/x-ndjson")
+
+@app.post("/api/recommendations/jobs", status_code=202, response_model=JobResponse)
+async def submit_recommendation_job(
+    request: RecommendationRequest,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    db=Depends(get_session)
+):
+    """Queue a recommendation request and return at once; poll the job for its set.
+
+    Resubmitting with the same `Idempotency-Key` header returns the job
+    created the first time instead of queueing another one.
+    """
+    try:
+        if idempotency_key is None or await get_job_by_idempotency_key(db, request.userId, idempotency_key) is None:
+            await user_rate_limiter.acquire(request.userId)
+        job, created = await create_job(
+            db, request.userId, request.prompt, bypass_cache=request.bypassCache, idempotency_key=idempotency_key
+        )
+    except AdmissionRejectedError as e:
+        raise too_many_requests(e)
+    if not created and (job.prompt_text, job.bypass_cache) != (request.prompt, request.bypassCache):
+        raise HTTPException(status_code=409, detail="Idempotency-Key was already used for a different request")
+    JOB_EVENTS.inc(event="submitted" if created else "deduplicated")
+    if created:
+        job_workers.notify()
+    response = render_response(JobResponse, job_to_response(job))
+    response.status_code = 202
+    response.headers["Location"] = f"/api/recommendations/jobs/{job.id}"
+    return response
+
+@app.get("/api/recommendations/jobs/{jobId}", response_model=JobResponse)
+async def get_recommendation_job(jobId: str, db=Depends(get_session)):
+    """Get a job's status and, once it succeeded, its recommendation set ID"""
+    job = await get_job(db, jobId)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return render_response(JobResponse, job_to_response(job))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus metrics for stage latencies, requests and upstream load"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """Get recommendation cache hit/miss, request coalescing, upstream queue, similarity index and job worker counters"""
+    return {
+        **recommendation_cache.stats(),
+        **single_flight.stats(),
+        **upstream_limiter.stats(),
+        **(prompt_index.stats() if prompt_index is not None else {}),
+        **job_workers.stats(),
+    }
 
 @app.get("/api/history/{userId}", response_model=List[HistoryItem])
-async def get_history(userId: str, db: Session = Depends(get_db)):
-    """Get user's recommendation history"""
+async def get_history(
+    userId: str,
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    db=Depends(get_session)
+):
+    """Get one page of the user's recommendation history, newest first.
+
+    When more items exist, the X-Next-Cursor response header holds the cursor
+    for the next page.
+    """
     try:
-        history = get_user_history(db, userId)
-        if not history:
+        history, next_cursor = await get_user_history(db, userId, limit=limit, cursor=cursor)
+        if not history and not cursor:
             raise HTTPException(status_code=404, detail="User or history not found")
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
         return history
     except HTTPException:
         raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/search", response_model=List[SearchResult])
+async def search(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=500),
+    userId: Optional[str] = None,
+    match: str = Query("all", pattern="^(all|any)$"),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    db=Depends(get_session)
+):
+    """Full-text search over prompts and recommended products, best match first.
+
+    Words and "quoted phrases" in `q` must all match (match=any relaxes that
+    to at least one). Pass userId to search a single user's sets. When more
+    results exist, the X-Next-Cursor response header holds the next page.
+    """
+    try:
+        results, next_cursor = await search_recommendation_sets(
+            db, q, user_id=userId, limit=limit, cursor=cursor, match_all=match == "all"
+        )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return results
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NotImplementedError as e:
+        raise HTTPException(status_code=501, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/export")
+async def export_history(
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|parquet)$"),
+    userId: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    since: Optional[datetime] = None,
+    authorization: Optional[str] = Header(None),
+):
+    """Stream every recommendation set with its categories and products, oldest first.
+
+    Every user's history is readable here, so the endpoint only exists when
+    EXPORT_TOKEN is set and answers requests that send it as a bearer token.
+
+    NDJSON (one set per line) or, with pyarrow installed, Parquet. Filter by
+    userId and a created_at range [start, end); pass the X-Export-Watermark
+    header of the previous export as `since` to get only newer sets. Rows
+    are read in chunks, so memory use does not grow with the history.
+    """
+    if not EXPORT_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not export_authorized(authorization, EXPORT_TOKEN):
+        raise HTTPException(status_code=401, detail="A valid export token is required",
+                            headers={"WWW-Authenticate": "Bearer"})
+    lower, upper = export_window(since, start, end)
+
+    def chunks():
+        # Opened once the response starts streaming, closed when it ends
+        with SessionLocal() as db:
+            yield from iter_export_chunks(db, user_id=userId, since=lower, until=upper)
+
+    try:
+        body = encode_export(chunks(), export_format)
+    except RuntimeError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    return StreamingResponse(
+        body,
+        media_type=MEDIA_TYPES[export_format],
+        headers={
+            "X-Export-Watermark": upper.isoformat(),
+            "Content-Disposition": f'attachment; filename="recommendations.{export_format}"',
+        },
+    )
+
+def _set_headers(etag: str) -> Dict[str, str]:
+    # 304s carry Vary too, so caches key the revalidated entry the same way
+    return {"ETag": response_etag(etag), "Cache-Control": IMMUTABLE_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+
 @app.get("/api/recommendations/{setId}", response_model=ApiResponse)
-async def get_recommendation_by_id(setId: str, db: Session = Depends(get_db)):
-    """Get a specific recommendation set by ID"""
+async def get_recommendation_by_id(setId: str, request: Request, db=Depends(get_session)):
+    """Get a specific recommendation set by ID.
+
+    Sets are immutable, so the response carries a weak ETag (shared by the
+    compressed and plain bodies) and a long-lived Cache-Control;
+    If-None-Match is answered with 304 from the ETag alone.
+    The body is sent exactly as stored at write time, precompressed when the
+    client accepts the stored encoding.
+    """
     try:
-        recommendation_set = get_recommendation_set(db, setId)
-        if not recommendation_set:
-            raise HTTPException(status_code=404, detail="Recommendation set not found")
+        # Sets still waiting in the write-behind queue are served from memory
+        pending = write_behind_queue.get_pending(setId)
+        if pending is not None:
+            return render_response(ApiResponse, pending)
         
-        # Convert database data back to API response format
-        response = {
-            "categories": [],
-            "id": str(recommendation_set.id),
-            "prompt_text": recommendation_set.prompt_text,
-            "created_at": recommendation_set.created_at.isoformat()
-        }
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            etag = await get_recommendation_etag(db, setId)
+            if etag and etag_matches(if_none_match, etag):
+                return Response(status_code=304, headers=_set_headers(etag))
         
-        for category in recommendation_set.categories:
-            category_data = {
-                "categoryTitle": category.title,
-                "products": []
-            }
-            
-            for product in category.products:
-                product_data = {
-                    "name": product.name,
-                    "brand": product.brand,
-                    "description": product.description,
-                    "priceRange": product.price_range or "",
-                    "pros": [detail.text for detail in product.details if detail.type == "pro"],
-                    "cons": [detail.text for detail in product.details if detail.type == "con"],
-                    "highlight": product.highlight,
-                    "storeLink": [link.url for link in product.store_links] if product.store_links else []
-                }
-                category_data["products"].append(product_data)
-            
-            response["categories"].append(category_data)
+        stored = await get_recommendation_body(db, setId)
+        if stored is None:
+            # Sets written before bodies were stored get theirs on first read
+            recommendation_set = await get_recommendation_set(db, setId)
+            if not recommendation_set:
+                raise HTTPException(status_code=404, detail="Recommendation set not found")
+            stored = await store_recommendation_body(db, setId, recommendation_set_to_response(recommendation_set))
+            if etag_matches(if_none_match, stored.etag):
+                return Response(status_code=304, headers=_set_headers(stored.etag))
         
-        return response
+        body, content_encoding = negotiate_body(stored.body, stored.encoding, request.headers.get("accept-encoding"))
+        headers = _set_headers(stored.etag)
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        return Response(content=body, media_type="application/json", headers=headers)
         
     except HTTPException:
         raise
@@ -0,0 +1,320 @@
+"""
+Minimal in-process metrics with Prometheus text exposition.
+
+Metrics are module-level singletons registered on import; GET /metrics
+renders all of them with render_metrics().
+"""
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from a cache hit up to a slow Gemini call
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 60.0)
+
+_registry: List["_Metric"] = []
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function = function
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    @contextmanager
+    def track_in_progress(self, **labels: str) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def _samples(self) -> List[str]:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items and not self.labelnames:
+            items = [((), 0.0)]
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observes the wall-clock duration of the with-block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        counts = self._counts.get(self._key(labels))
+        return counts[-1] if counts else 0
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            items = sorted(self._counts.items())
+            sums = dict(self._sums)
+        for key, counts in items:
+            for bound, count in zip(self.buckets, counts):
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(sums[key])}")
+            lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+def timed(histogram: Histogram, **labels: str) -> Callable:
+    """Decorator that observes each call's duration on `histogram`"""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render_metrics() -> str:
+    """Renders every registered metric in the Prometheus text format"""
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Per-stage latency of the recommendation pipeline
+STAGE_SECONDS = Histogram(
+    "slopeselector_stage_duration_seconds",
+    "Latency of each request stage (upstream, json_parse, db_user, db_write, db_read, serialize).",
+    ["stage"],
+)
+UPSTREAM_RETRIES = Histogram(
+    "slopeselector_upstream_retries",
+    "Retries needed per upstream Gemini call.",
+    buckets=(0, 1, 2, 3, 4, 5),
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "slopeselector_upstream_in_flight",
+    "Gemini calls currently in flight.",
+)
+
+# Write-behind persistence of new sets (services/write_behind.py)
+WRITE_BEHIND_QUEUED = Gauge(
+    "slopeselector_write_behind_queued",
+    "Recommendation sets waiting in the write-behind queue.",
+)
+WRITE_BEHIND_FAILURES = Counter(
+    "slopeselector_write_behind_failures_total",
+    "Failed attempts to write a write-behind batch; the batch is retried until it is written.",
+)
+
+# Per-endpoint HTTP traffic
+HTTP_REQUESTS = Counter(
+    "slopeselector_http_requests_total",
+    "HTTP requests by endpoint and status code.",
+    ["method", "endpoint", "status"],
+)
+HTTP_ERRORS = Counter(
+    "slopeselector_http_request_errors_total",
+    "HTTP requests that failed with a 5xx status or an unhandled exception.",
+    ["method", "endpoint"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "slopeselector_http_request_duration_seconds",
+    "End-to-end HTTP request latency by endpoint.",
+    ["method", "endpoint"],
+)
+
+# Caching and coalescing effectiveness
+CACHE_LOOKUPS = Counter(
+    "slopeselector_cache_lookups_total",
+    "Recommendation cache lookups by result (hit or miss).",
+    ["result"],
+)
+UPSTREAM_CALLS_SAVED = Counter(
+    "slopeselector_upstream_calls_saved_total",
+    "Requests served by joining an identical in-flight Gemini call.",
+)
+
+# Upstream token usage and system-prompt context caching
+UPSTREAM_TOKENS = Histogram(
+    "slopeselector_upstream_tokens",
+    "Tokens per Gemini call by kind (prompt, cached, output).",
+    ["kind"],
+    buckets=(0, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+CONTEXT_CACHE_EVENTS = Counter(
+    "slopeselector_context_cache_events_total",
+    "System-prompt cachedContents events (create, refresh, failure, invalidated).",
+    ["event"],
+)
+
+# Hedged requests to the fallback model tier
+UPSTREAM_HEDGES = Counter(
+    "slopeselector_upstream_hedges_total",
+    "Hedge requests sent because the primary model missed its deadline or failed, by reason and winning tier.",
+    ["reason", "winner"],
+)
+UPSTREAM_HEDGE_DELAY = Gauge(
+    "slopeselector_upstream_hedge_delay_seconds",
+    "Current deadline before a hedge request is sent.",
+)
+
+# Admission control in front of the upstream
+UPSTREAM_QUEUE_DEPTH = Gauge(
+    "slopeselector_upstream_queue_depth",
+    "Calls waiting for an upstream slot, by priority (interactive, batch).",
+    ["priority"],
+)
+UPSTREAM_QUEUE_WAIT_SECONDS = Histogram(
+    "slopeselector_upstream_queue_wait_seconds",
+    "Time calls waited for an upstream slot, by priority.",
+    ["priority"],
+)
+ADMISSION_REJECTIONS = Counter(
+    "slopeselector_admission_rejections_total",
+    "Requests turned away with 429, by reason (rate_limit, queue_full, queue_timeout).",
+    ["reason"],
+)
+
+# Reuse of answers to similar past prompts
+SIMILARITY_LOOKUPS = Counter(
+    "slopeselector_similarity_lookups_total",
+    "Similar-prompt lookups after an exact cache miss, by result (hit or miss).",
+    ["result"],
+)
+SIMILARITY_SCORES = Histogram(
+    "slopeselector_similarity_score",
+    "Cosine similarity of each looked-up prompt to its nearest stored prompt.",
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.98, 1.0),
+)
+
+# Asynchronous recommendation jobs
+JOB_EVENTS = Counter(
+    "slopeselector_job_events_total",
+    "Recommendation job events (submitted, deduplicated, claimed, succeeded, retried, failed, lease_lost).",
+    ["event"],
+)
+JOB_QUEUE_SECONDS = Histogram(
+    "slopeselector_job_queue_seconds",
+    "Time from submitting a job to its first claim by a worker.",
+)
+
+# Retention and compaction (services/maintenance.py)
+MAINTENANCE_ROWS = Counter(
+    "slopeselector_maintenance_rows_total",
+    "Rows handled by scheduled maintenance, by action (archived, deleted, jobs_deleted, catalog_pruned).",
+    ["action"],
+)
+MAINTENANCE_SECONDS = Histogram(
+    "slopeselector_maintenance_seconds",
+    "Duration of each maintenance step (archive, delete, jobs, catalog, compact).",
+    ["step"],
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0),
+)
+
+# History export
+EXPORTED_SETS = Counter(
+    "slopeselector_exported_sets_total",
+    "Recommendation sets written by history exports.",
+)
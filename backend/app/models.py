@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Text, DateTime, ForeignKey
+from sqlalchemy import Boolean, Column, String, Text, DateTime, Float, ForeignKey, Index, Integer, LargeBinary, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
 import uuid
@@ -20,27 +20,125 @@ class RecommendationSet(Base):
     user_id = Column(String, ForeignKey("users.id"))
     prompt_text = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Gemini token usage of the call that produced the set; NULL for cache hits
+    prompt_tokens = Column(Integer, nullable=True)
+    cached_tokens = Column(Integer, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    # Model tier ("primary" or "hedge") and model that answered; NULL for cache hits
+    model_tier = Column(String, nullable=True)
+    model = Column(String, nullable=True)
+    # Set whose answer was reused for this near-duplicate prompt, and how similar the prompts were
+    reused_from = Column(String, nullable=True)
+    similarity = Column(Float, nullable=True)
+    # When the set's tree was dropped in favour of its stored body (see retention.py)
+    archived_at = Column(DateTime, nullable=True)
     
     # Relationships
     user = relationship("User", back_populates="recommendation_sets")
     categories = relationship("Category", back_populates="recommendation_set", cascade="all, delete-orphan")
+    response_body = relationship("RecommendationBody", uselist=False, cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        # Serves keyset-paginated history: newest first per user
+        Index("ix_recommendation_sets_user_created", "user_id", created_at.desc(), id.desc()),
+        # Serves retention: the oldest sets across all users
+        Index("ix_recommendation_sets_created", "created_at"),
+    )
+
+class RecommendationBody(Base):
+    """The set's serialized API response, stored once (see response_bodies.py)"""
+    __tablename__ = "recommendation_bodies"
+    
+    set_id = Column(String, ForeignKey("recommendation_sets.id"), primary_key=True)
+    etag = Column(String, nullable=False)
+    encoding = Column(String, nullable=False)  # "gzip", "br" or "identity"
+    body = Column(LargeBinary, nullable=False)
 
 class Category(Base):
     __tablename__ = "categories"
     
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    recommendation_set_id = Column(String, ForeignKey("recommendation_sets.id"))
+    recommendation_set_id = Column(String, ForeignKey("recommendation_sets.id"), index=True)
     title = Column(String)
     
     # Relationships
     recommendation_set = relationship("RecommendationSet", back_populates="categories")
+    items = relationship("CategoryProduct", back_populates="category", cascade="all, delete-orphan",
+                         order_by="CategoryProduct.position")
     products = relationship("Product", back_populates="category", cascade="all, delete-orphan")
 
+class CategoryProduct(Base):
+    """A category's reference to a catalog product, in display order"""
+    __tablename__ = "category_products"
+    
+    category_id = Column(String, ForeignKey("categories.id"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    catalog_product_id = Column(String, ForeignKey("catalog_products.id"), index=True)
+    # JSON of the API fields where this answer differs from the canonical product
+    overrides = Column(Text, nullable=True)
+    
+    # Relationships
+    category = relationship("Category", back_populates="items")
+    catalog_product = relationship("CatalogProduct")
+
+class CatalogProduct(Base):
+    """One canonical product, shared by every set that recommends it"""
+    __tablename__ = "catalog_products"
+    
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    brand_key = Column(String, nullable=False)  # normalized brand
+    name_key = Column(String, nullable=False)  # normalized name
+    name = Column(String)
+    brand = Column(String)
+    description = Column(Text)
+    price_range = Column(String)
+    highlight = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    details = relationship("CatalogProductDetail", cascade="all, delete-orphan",
+                           order_by="CatalogProductDetail.position")
+    store_links = relationship("CatalogStoreLink", cascade="all, delete-orphan",
+                               order_by="CatalogStoreLink.position")
+    
+    __table_args__ = (
+        UniqueConstraint("brand_key", "name_key", name="uq_catalog_products_key"),
+    )
+
+class CatalogText(Base):
+    """Interned pro/con text"""
+    __tablename__ = "catalog_texts"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    text = Column(Text, nullable=False, unique=True)
+
+class CatalogProductDetail(Base):
+    __tablename__ = "catalog_product_details"
+    
+    catalog_product_id = Column(String, ForeignKey("catalog_products.id"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    type = Column(String)  # "pro" or "con"
+    text_id = Column(Integer, ForeignKey("catalog_texts.id"))
+    
+    # Relationships
+    text = relationship("CatalogText")
+
+class CatalogStoreLink(Base):
+    __tablename__ = "catalog_store_links"
+    
+    catalog_product_id = Column(String, ForeignKey("catalog_products.id"), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    url = Column(String)
+    store_name = Column(String)
+
+# Legacy per-set product copies. New sets are written to the catalog tables
+# above; these only hold rows until init_db migrates them.
+
 class Product(Base):
     __tablename__ = "products"
     
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    category_id = Column(String, ForeignKey("categories.id"))
+    category_id = Column(String, ForeignKey("categories.id"), index=True)
     name = Column(String)
     brand = Column(String)
     description = Column(Text)
@@ -56,7 +154,7 @@ class StoreLink(Base):
     __tablename__ = "store_links"
     
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    product_id = Column(String, ForeignKey("products.id"))
+    product_id = Column(String, ForeignKey("products.id"), index=True)
     url = Column(String)
     store_name = Column(String)  # e.g., "REI", "Evo", "Backcountry"
     
@@ -67,9 +165,68 @@ class ProductDetail(Base):
     __tablename__ = "product_details"
     
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    product_id = Column(String, ForeignKey("products.id"))
+    product_id = Column(String, ForeignKey("products.id"), index=True)
     type = Column(String)  # "pro" or "con"
     text = Column(String)
     
     # Relationships
     product = relationship("Product", back_populates="details")
+
+class CachedResponse(Base):
+    __tablename__ = "cached_responses"
+    
+    key = Column(String, primary_key=True)  # sha256 of normalized prompt + config fingerprint
+    response_json = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ContextCacheEntry(Base):
+    """The Gemini cachedContents entry in use per model, shared by worker processes"""
+    __tablename__ = "context_cache_entries"
+    
+    model = Column(String, primary_key=True)
+    prompt_hash = Column(String)  # sha256 of model + system prompt
+    name = Column(String)  # cachedContents/...
+    expires_at = Column(DateTime)  # UTC
+
+class RateLimitBucket(Base):
+    """A user's rate limit token bucket, shared by worker processes (see services/admission.py)"""
+    __tablename__ = "rate_limit_buckets"
+    
+    key = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False, index=True)  # Unix time of the last refill
+
+class RecommendationJob(Base):
+    """A queued recommendation request (POST /api/recommendations/jobs), see services/job_queue.py"""
+    __tablename__ = "recommendation_jobs"
+    
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(String, nullable=False)
+    prompt_text = Column(Text, nullable=False)
+    bypass_cache = Column(Boolean, nullable=False, default=False)
+    idempotency_key = Column(String, nullable=True)
+    status = Column(String, nullable=False, default="queued")  # queued, running, succeeded or failed
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(DateTime, nullable=False, default=datetime.utcnow)  # not claimed before this
+    # Worker holding the job and when its claim lapses unless renewed
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    recommendation_set_id = Column(String, ForeignKey("recommendation_sets.id"), nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        UniqueConstraint("user_id", "idempotency_key", name="uq_recommendation_jobs_idempotency"),
+        # Serves the claim query: the oldest available queued job, or an expired lease
+        Index("ix_recommendation_jobs_claim", "status", "available_at"),
+    )
+
+class MaintenanceRun(Base):
+    """Last run of a scheduled maintenance task, shared by worker processes (see services/maintenance.py)"""
+    __tablename__ = "maintenance_runs"
+    
+    name = Column(String, primary_key=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    summary = Column(Text, nullable=True)  # JSON of what the run did
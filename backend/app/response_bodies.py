@@ -0,0 +1,104 @@
+"""
+Serialized, precompressed responses for GET /api/recommendations/{setId}.
+
+A set never changes once written, so its ApiResponse JSON is rendered once,
+compressed with STORED_BODY_ENCODING and stored next to a hash of the
+uncompressed bytes. Reads send those bytes as they are to clients that
+accept the encoding and decompress only for the rest; both representations
+share one weak ETag (see response_etag).
+"""
+import gzip
+import hashlib
+import logging
+import os
+import zlib
+from typing import Dict, Optional, Tuple
+
+from .metrics import STAGE_SECONDS
+from .schemas import ApiResponse
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# "gzip" (default), "br" (needs the brotli package) or "identity"
+STORED_BODY_ENCODING = os.environ.get("STORED_BODY_ENCODING", "gzip").lower()
+if STORED_BODY_ENCODING == "br" and brotli is None:
+    logger.warning("STORED_BODY_ENCODING=br but brotli is not installed; storing gzip instead")
+    STORED_BODY_ENCODING = "gzip"
+if STORED_BODY_ENCODING not in ("gzip", "br", "identity"):
+    raise ValueError(f"Unsupported STORED_BODY_ENCODING: {STORED_BODY_ENCODING}")
+
+# Sets are immutable, so caches may keep them for a year without revalidating
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def compute_etag(body: bytes) -> str:
+    """Strong validator derived from the uncompressed bytes"""
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+def response_etag(etag: str) -> str:
+    """
+    The ETag header for a stored body's etag. The gzip and identity bytes
+    are different representations, which must not share a strong ETag, so
+    it is sent as a weak one; If-None-Match compares weakly anyway.
+    """
+    return etag if etag.startswith("W/") else "W/" + etag
+
+def encode_body(body: bytes, encoding: str = STORED_BODY_ENCODING) -> Dict[str, object]:
+    """The stored form of a serialized response: etag, encoding and bytes"""
+    if encoding == "gzip":
+        # mtime=0 keeps the bytes (and any CDN copies) identical across writers
+        stored = gzip.compress(body, compresslevel=9, mtime=0)
+    elif encoding == "br":
+        stored = brotli.compress(body)
+    else:
+        stored = body
+    return {"etag": compute_etag(body), "encoding": encoding, "body": stored}
+
+def body_row(set_id: str, response: dict) -> Dict[str, object]:
+    """Renders a set's ApiResponse and returns its recommendation_bodies row"""
+    with STAGE_SECONDS.time(stage="serialize"):
+        body = ApiResponse.model_validate(response).model_dump_json().encode("utf-8")
+    return {"set_id": set_id, **encode_body(body)}
+
+def _decode(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == "br":
+        if brotli is None:
+            raise RuntimeError("Stored body is brotli-compressed but brotli is not installed")
+        return brotli.decompress(body)
+    return body
+
+def _accepts(accept_encoding: Optional[str], encoding: str) -> bool:
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() in (encoding, "*"):
+            quality = params.strip()
+            if not quality.startswith("q="):
+                return True
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+def negotiate_body(body: bytes, encoding: str, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """Returns the bytes to send and their Content-Encoding (None for identity)"""
+    if encoding == "identity":
+        return body, None
+    if _accepts(accept_encoding, encoding):
+        return body, encoding
+    return _decode(body, encoding), None
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match uses weak comparison, so W/ prefixes are ignored"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any((tag[2:] if tag.startswith("W/") else tag) == etag for tag in candidates)
@@ -0,0 +1,210 @@
+"""
+Retention for recommendation history.
+
+Old sets are archived: their stored response body (recommendation_bodies,
+already gzip- or brotli-compressed) becomes the only copy of the answer,
+and their category and category_products rows are deleted. The set row,
+its search index entry and its body stay, so history, search and
+GET /api/recommendations/{id} keep working unchanged (see
+crud.recommendation_set_to_response). Catalog products no set links to any
+more are pruned afterwards, with their details, store links and texts.
+
+Sets older than the delete cutoff are removed entirely. compact() hands
+freed pages back to the filesystem and refreshes the query planner's
+statistics; everything here runs in small batches, one transaction each,
+so request writers are never locked out for long.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from sqlalchemy import delete, exists, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .crud import get_recommendation_set, recommendation_set_to_response
+from .models import (
+    CatalogProduct, CatalogProductDetail, CatalogStoreLink, CatalogText, Category, CategoryProduct,
+    MaintenanceRun, RecommendationBody, RecommendationJob, RecommendationSet,
+)
+from .response_bodies import body_row
+from .search import optimize_search_index, remove_documents, search_supported
+
+logger = logging.getLogger(__name__)
+
+# Free pages released per transaction by compact()
+VACUUM_CHUNK_PAGES = 1000
+
+def _delete_trees(db: Session, set_ids: List[str]) -> None:
+    category_ids = select(Category.id).where(Category.recommendation_set_id.in_(set_ids))
+    db.execute(delete(CategoryProduct).where(CategoryProduct.category_id.in_(category_ids)))
+    db.execute(delete(Category).where(Category.recommendation_set_id.in_(set_ids)))
+
+def archive_sets(db: Session, cutoff: datetime, batch_size: int = 200) -> int:
+    """
+    Archives up to `batch_size` of the oldest sets created before `cutoff`
+    in one transaction. Sets written before bodies were stored get theirs
+    rendered from the tree first. Returns the number of sets archived.
+    """
+    set_ids = list(db.execute(
+        select(RecommendationSet.id)
+        .where(RecommendationSet.created_at < cutoff, RecommendationSet.archived_at.is_(None))
+        .order_by(RecommendationSet.created_at)
+        .limit(batch_size)
+    ).scalars())
+    if not set_ids:
+        return 0
+    try:
+        with_body = set(db.execute(select(RecommendationBody.set_id).where(RecommendationBody.set_id.in_(set_ids))).scalars())
+        for set_id in set_ids:
+            if set_id not in with_body:
+                response = recommendation_set_to_response(get_recommendation_set(db, set_id))
+                db.add(RecommendationBody(**body_row(set_id, response)))
+        db.flush()
+        _delete_trees(db, set_ids)
+        db.execute(
+            update(RecommendationSet)
+            .where(RecommendationSet.id.in_(set_ids))
+            .values(archived_at=datetime.utcnow())
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    # The loaded trees are gone; don't let the next batch see them
+    db.expunge_all()
+    return len(set_ids)
+
+def delete_sets(db: Session, cutoff: datetime, batch_size: int = 200) -> int:
+    """
+    Deletes up to `batch_size` of the oldest sets created before `cutoff`,
+    archived or not, with everything stored for them. Jobs that produced
+    them keep their status but lose the link. Returns the number deleted.
+    """
+    set_ids = list(db.execute(
+        select(RecommendationSet.id)
+        .where(RecommendationSet.created_at < cutoff)
+        .order_by(RecommendationSet.created_at)
+        .limit(batch_size)
+    ).scalars())
+    if not set_ids:
+        return 0
+    try:
+        _delete_trees(db, set_ids)
+        remove_documents(db, set_ids)
+        db.execute(delete(RecommendationBody).where(RecommendationBody.set_id.in_(set_ids)))
+        db.execute(
+            update(RecommendationJob)
+            .where(RecommendationJob.recommendation_set_id.in_(set_ids))
+            .values(recommendation_set_id=None)
+        )
+        db.execute(delete(RecommendationSet).where(RecommendationSet.id.in_(set_ids)))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(set_ids)
+
+def delete_finished_jobs(db: Session, cutoff: datetime) -> int:
+    """Deletes succeeded and failed jobs that finished before `cutoff`"""
+    result = db.execute(
+        delete(RecommendationJob)
+        .where(RecommendationJob.status.in_(("succeeded", "failed")), RecommendationJob.finished_at < cutoff)
+    )
+    db.commit()
+    return result.rowcount
+
+def prune_catalog(db: Session, batch_size: int = 200) -> int:
+    """
+    Deletes up to `batch_size` catalog products no category links to, with
+    their details and store links, then any texts no detail uses. The
+    candidates are read before the transaction takes the write lock, so
+    every delete re-checks that a product is still unlinked; a set written
+    in between keeps its products whole. Returns the number of products.
+    """
+    unlinked = ~exists().where(CategoryProduct.catalog_product_id == CatalogProduct.id)
+    product_ids = list(db.execute(select(CatalogProduct.id).where(unlinked).limit(batch_size)).scalars())
+    if not product_ids:
+        return 0
+    still_unlinked = select(CatalogProduct.id).where(CatalogProduct.id.in_(product_ids), unlinked)
+    try:
+        db.execute(delete(CatalogProductDetail).where(CatalogProductDetail.catalog_product_id.in_(still_unlinked)))
+        db.execute(delete(CatalogStoreLink).where(CatalogStoreLink.catalog_product_id.in_(still_unlinked)))
+        pruned = db.execute(delete(CatalogProduct).where(CatalogProduct.id.in_(product_ids), unlinked)).rowcount
+        db.execute(delete(CatalogText).where(~exists().where(CatalogProductDetail.text_id == CatalogText.id)))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return pruned
+
+def claim_maintenance_run(db: Session, name: str, interval: float) -> bool:
+    """
+    Starts a run of the task `name` unless one started within the last
+    `interval` seconds, in this process or another. Returns whether this
+    caller should run it.
+    """
+    now = datetime.utcnow()
+    claimed = db.execute(
+        update(MaintenanceRun)
+        .where(MaintenanceRun.name == name, MaintenanceRun.started_at < now - timedelta(seconds=interval))
+        .values(started_at=now)
+    ).rowcount == 1
+    if not claimed and db.get(MaintenanceRun, name) is None:
+        db.add(MaintenanceRun(name=name, started_at=now))
+        try:
+            db.flush()
+            claimed = True
+        except IntegrityError:
+            db.rollback()
+            return False
+    db.commit()
+    return claimed
+
+def finish_maintenance_run(db: Session, name: str, summary: str) -> None:
+    """Records the end of a run and what it did (JSON)"""
+    db.execute(
+        update(MaintenanceRun)
+        .where(MaintenanceRun.name == name)
+        .values(finished_at=datetime.utcnow(), summary=summary)
+    )
+    db.commit()
+
+def compact(db: Session, vacuum_pages: int = 10000) -> Dict[str, Any]:
+    """
+    SQLite only (a no-op elsewhere): releases up to `vacuum_pages` free
+    pages with an incremental vacuum, merges the search index, refreshes
+    planner statistics and truncates the WAL. A database created before
+    auto_vacuum was turned on is converted with one full VACUUM first.
+    Returns the page counts before and after.
+    """
+    engine = db.get_bind()
+    if engine.dialect.name != "sqlite":
+        return {}
+    if search_supported(engine):
+        optimize_search_index(db)
+    db.close()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        pragma = lambda statement: conn.exec_driver_sql(f"PRAGMA {statement}").scalar()
+        before = {"pages": pragma("page_count"), "free_pages": pragma("freelist_count")}
+        if pragma("auto_vacuum") != 2:
+            logger.info("Converting the database to incremental auto-vacuum (one full VACUUM)")
+            conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+        # Each step of the pragma frees one page and the sqlite3 module only
+        # steps it once, so it is run per page; a chunk per transaction
+        # lets writers in
+        remaining = min(vacuum_pages, pragma("freelist_count"))
+        while remaining > 0:
+            chunk = min(remaining, VACUUM_CHUNK_PAGES)
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            for _ in range(chunk):
+                conn.exec_driver_sql("PRAGMA incremental_vacuum(1)")
+            conn.exec_driver_sql("COMMIT")
+            remaining -= chunk
+        # analysis_limit keeps ANALYZE to a sample of each index on large tables
+        conn.exec_driver_sql("PRAGMA analysis_limit=1000")
+        conn.exec_driver_sql("ANALYZE")
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)").all()
+        after = {"pages": pragma("page_count"), "free_pages": pragma("freelist_count")}
+    return {"before": before, "after": after}
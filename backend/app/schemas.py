@@ -6,6 +6,7 @@ from datetime import datetime
 class RecommendationRequest(BaseModel):
     prompt: str
     userId: str
+    bypassCache: bool = False  # Skip the response cache and always call Gemini
 
 # Response schemas
 class ProductDetail(BaseModel):
@@ -32,3 +33,22 @@ class HistoryItem(BaseModel):
     id: str
     prompt_text: str
     created_at: str
+
+class SearchResult(BaseModel):
+    id: str
+    prompt_text: str
+    created_at: str
+    score: float  # BM25 relevance, higher is better
+    snippet: str  # best matching passage, matches wrapped in [ ]
+
+class BatchRecommendationRequest(BaseModel):
+    items: List[RecommendationRequest]
+
+class JobResponse(BaseModel):
+    id: str
+    status: str  # queued, running, succeeded or failed
+    prompt_text: str
+    created_at: str
+    finished_at: Optional[str] = None
+    recommendation_set_id: Optional[str] = None  # set once the job succeeded
+    error: Optional[str] = None  # set once the job failed
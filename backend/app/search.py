@@ -0,0 +1,241 @@
+"""
+Full-text search over recommendation sets (SQLite FTS5).
+
+recommendation_search holds one row per set: its prompt and the name,
+brand, description, highlight and price range of every product it
+recommended, exactly as that set displayed them, plus a single-token hash
+of its user so that user scoping is part of the FTS match rather than a
+filter over every match. Rows are written in the
+same transaction as the set (crud.insert_recommendation_rows); init_db
+creates the table and indexes any sets that predate it.
+"""
+import base64
+import binascii
+import hashlib
+import logging
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.orm import Session, selectinload
+
+from .catalog import category_item_to_product
+from .metrics import STAGE_SECONDS, timed
+from .models import Category, CategoryProduct, CatalogProduct, CatalogProductDetail, RecommendationSet
+from .schemas import SearchResult
+
+SEARCH_TABLE = "recommendation_search"
+BACKFILL_BATCH_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+# Quoted phrases or single words; everything else (operators, punctuation) is dropped
+_QUERY_TOKEN = re.compile(r'"([^"]*)"|(\w+)', re.UNICODE)
+
+def search_supported(bind) -> bool:
+    """FTS5 is SQLite-only; other databases run without search"""
+    return bind.dialect.name == "sqlite"
+
+def _search_table_exists(db: Session) -> bool:
+    return db.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": SEARCH_TABLE}
+    ).first() is not None
+
+def user_key(user_id: str) -> str:
+    """One alphanumeric token per user, so a match on it is exact"""
+    return "u" + hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:24]
+
+def _products_text(products: Iterable[Dict[str, Any]]) -> str:
+    return "\n".join(
+        " ".join(filter(None, (p.get("brand"), p.get("name"), p.get("description"), p.get("highlight"), p.get("priceRange"))))
+        for p in products
+    )
+
+def search_document(set_id: str, user_id: str, prompt_text: str, products: Iterable[Dict[str, Any]]) -> Dict[str, str]:
+    """The index row for one set"""
+    return {
+        "set_id": set_id,
+        "user_key": user_key(user_id),
+        "prompt_text": prompt_text or "",
+        "products": _products_text(products),
+    }
+
+def index_documents(db: Session, documents: List[Dict[str, str]]) -> None:
+    """Adds index rows in the caller's transaction (no commit)"""
+    if documents and search_supported(db.get_bind()):
+        db.execute(
+            text(
+                f"INSERT INTO {SEARCH_TABLE} (set_id, user_key, prompt_text, products) "
+                "VALUES (:set_id, :user_key, :prompt_text, :products)"
+            ),
+            documents,
+        )
+
+def remove_documents(db: Session, set_ids: List[str]) -> None:
+    """Drops the index rows of deleted sets in the caller's transaction (no commit)"""
+    if set_ids and search_supported(db.get_bind()) and _search_table_exists(db):
+        db.execute(
+            text(f"DELETE FROM {SEARCH_TABLE} WHERE set_id IN :set_ids").bindparams(bindparam("set_ids", expanding=True)),
+            {"set_ids": set_ids},
+        )
+
+def optimize_search_index(db: Session) -> None:
+    """Merges the index's b-trees into one, which deletes and many small inserts fragment"""
+    if search_supported(db.get_bind()) and _search_table_exists(db):
+        db.execute(text(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')"))
+        db.commit()
+
+def ensure_search_index(db: Session, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """
+    Creates the FTS5 table if it is missing and indexes every stored set.
+
+    DDL is transactional in SQLite, so the table and its backfill commit
+    together: an interrupted backfill leaves no table behind and is simply
+    redone on the next start. Returns the number of sets indexed.
+    """
+    if not search_supported(db.get_bind()) or _search_table_exists(db):
+        return 0
+    db.execute(text(
+        f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+        "set_id UNINDEXED, user_key, prompt_text, products, tokenize = 'unicode61 remove_diacritics 2')"
+    ))
+    # Rank on the prompt and products only; the user token must not add to the score
+    db.execute(text(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rank) VALUES ('rank', 'bm25(0.0, 0.0, 1.0, 1.0)')"))
+
+    options = selectinload(RecommendationSet.categories)\
+        .selectinload(Category.items)\
+        .selectinload(CategoryProduct.catalog_product)
+    indexed = 0
+    last_id = ""
+    try:
+        while True:
+            sets = db.execute(
+                select(RecommendationSet)
+                .options(
+                    options.selectinload(CatalogProduct.details).joinedload(CatalogProductDetail.text),
+                    options.selectinload(CatalogProduct.store_links),
+                )
+                .where(RecommendationSet.id > last_id)
+                .order_by(RecommendationSet.id)
+                .limit(batch_size)
+            ).scalars().all()
+            if not sets:
+                break
+            index_documents(db, [
+                search_document(
+                    rs.id,
+                    rs.user_id,
+                    rs.prompt_text,
+                    (category_item_to_product(item) for category in rs.categories for item in category.items),
+                )
+                for rs in sets
+            ])
+            db.expunge_all()
+            indexed += len(sets)
+            last_id = sets[-1].id
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if indexed:
+        logger.info("Indexed %d existing recommendation sets for search", indexed)
+    return indexed
+
+def build_match_query(query: str, match_all: bool = True) -> str:
+    """
+    Turns free text into a safe FTS5 expression: words and "quoted phrases"
+    become quoted terms, joined with AND (or OR when match_all is False).
+    Raises ValueError when nothing searchable is left.
+    """
+    terms = []
+    for phrase, word in _QUERY_TOKEN.findall(query):
+        term = (phrase or word).replace('"', "").strip()
+        if term:
+            terms.append(f'"{term}"')
+    if not terms:
+        raise ValueError("Search query has no searchable terms")
+    # Only the text columns are searched; user_key is matched explicitly
+    return "{prompt_text products} : (" + (" AND " if match_all else " OR ").join(terms) + ")"
+
+def encode_search_cursor(rank: float, rowid: int) -> str:
+    """Encode a search position as an opaque, URL-safe cursor"""
+    raw = f"{rank!r}|{rowid}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    """Decode a search cursor; raises ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        rank, rowid = raw.split("|", 1)
+        return float(rank), int(rowid)
+    except (UnicodeError, binascii.Error, ValueError) as e:
+        raise ValueError("Invalid search cursor") from e
+
+@timed(STAGE_SECONDS, stage="db_read")
+def search_recommendation_sets(
+    db: Session,
+    query: str,
+    user_id: Optional[str] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    match_all: bool = True
+) -> Tuple[List[SearchResult], Optional[str]]:
+    """
+    One page of sets matching `query`, best match first (BM25).
+
+    Pages are keyed on (rank, rowid), like history's (created_at, id), so
+    later pages never re-read the rows before them. Returns the results and
+    the cursor for the next page (None on the last page). Raises ValueError
+    for a bad cursor or an empty query.
+    """
+    if not search_supported(db.get_bind()):
+        raise NotImplementedError("Search requires SQLite with FTS5")
+    after = ""
+    params: Dict[str, Any] = {"limit": limit + 1}
+    if cursor:
+        params["rank"], params["rowid"] = decode_search_cursor(cursor)
+        after = " AND (rank > :rank OR (rank = :rank AND rowid > :rowid))"
+
+    match = build_match_query(query, match_all)
+    if user_id is not None:
+        match = f'user_key : "{user_key(user_id)}" AND {match}'
+    params["match"] = match
+
+    # Rank first, then build snippets and join the set rows for this page
+    # only; snippet() over every match would cost as much as the search
+    page = db.execute(
+        text(f"SELECT rowid, rank FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match{after} "
+             "ORDER BY rank, rowid LIMIT :limit"),
+        params,
+    ).all()
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_search_cursor(page[-1].rank, page[-1].rowid)
+    if not page:
+        return [], None
+
+    ranks = {row.rowid: row.rank for row in page}
+    rows = db.execute(
+        text(
+            f"SELECT s.rowid, s.set_id, rs.prompt_text, rs.created_at, "
+            f"snippet({SEARCH_TABLE}, -1, '[', ']', '...', 12) AS snippet "
+            f"FROM {SEARCH_TABLE} AS s JOIN recommendation_sets AS rs ON rs.id = s.set_id "
+            f"WHERE {SEARCH_TABLE} MATCH :match AND s.rowid IN :rowids"
+        ).bindparams(bindparam("rowids", expanding=True)).columns(created_at=RecommendationSet.created_at.type),
+        {"match": match, "rowids": list(ranks)},
+    ).all()
+    by_rowid = {row.rowid: row for row in rows}
+
+    results = [
+        SearchResult(
+            id=row.set_id,
+            prompt_text=row.prompt_text,
+            created_at=row.created_at.isoformat(),
+            score=-ranks[rowid],
+            snippet=row.snippet,
+        )
+        for rowid, row in ((rowid, by_rowid.get(rowid)) for rowid in ranks)
+        if row is not None
+    ]
+    return results, next_cursor
@@ -0,0 +1,229 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from sqlalchemy import case, delete, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+
+from ..database import SHARED_CACHE, SessionLocal
+from ..metrics import ADMISSION_REJECTIONS, UPSTREAM_QUEUE_DEPTH, UPSTREAM_QUEUE_WAIT_SECONDS
+from ..models import RateLimitBucket
+
+# Per-user rate limit on recommendation requests; 0 disables it
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", "60"))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "20"))
+RATE_LIMIT_MAX_USERS = int(os.environ.get("RATE_LIMIT_MAX_USERS", "100000"))
+
+# Global cap on concurrent Gemini calls and the queue in front of it
+UPSTREAM_MAX_CONCURRENT = int(os.environ.get("GEMINI_MAX_CONCURRENT_CALLS", "16"))
+UPSTREAM_QUEUE_SIZE = int(os.environ.get("GEMINI_QUEUE_SIZE", "64"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("GEMINI_QUEUE_TIMEOUT", "30"))
+
+# Worker processes serving the app; run_server.py --production sets it, and
+# the upstream cap and queue are split between them
+SERVER_WORKERS = max(1, int(os.environ.get("SERVER_WORKERS", "1")))
+
+# Lower values are served first
+INTERACTIVE = 0
+BATCH = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+# Priority of the upstream calls made for the current task; the batch
+# service lowers it for its items
+upstream_priority: ContextVar[int] = ContextVar("upstream_priority", default=INTERACTIVE)
+
+
+class AdmissionRejectedError(Exception):
+    """Raised when a request is shed; `retry_after` is the suggested wait in seconds"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """
+    Token bucket per key: up to `burst` requests at once, refilled at
+    `per_minute`. Full buckets carry no state, so they are dropped once more
+    than `max_keys` keys are tracked.
+
+    With `shared` the buckets live in the rate_limit_buckets table instead,
+    so a user's limit holds across worker processes; each acquire is one
+    conditional UPDATE.
+    """
+
+    def __init__(
+        self,
+        per_minute: float = RATE_LIMIT_PER_MINUTE,
+        burst: int = RATE_LIMIT_BURST,
+        max_keys: int = RATE_LIMIT_MAX_USERS,
+        shared: bool = SHARED_CACHE
+    ):
+        self.enabled = per_minute > 0
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self.shared = shared
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+
+    def _tokens(self, key: str, now: float) -> float:
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def _take(self, key: str, cost: float) -> Optional[float]:
+        """Takes the tokens from the in-memory bucket; returns the tokens left if there are too few"""
+        now = time.monotonic()
+        tokens = self._tokens(key, now)
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            return tokens
+        self._buckets[key] = (tokens - cost, now)
+        if len(self._buckets) > self.max_keys:
+            for full in [k for k in self._buckets if self._tokens(k, now) >= self.burst]:
+                del self._buckets[full]
+        return None
+
+    def _take_shared(self, key: str, cost: float) -> Optional[float]:
+        """Takes the tokens from the key's row; returns the tokens left if there are too few"""
+        now = time.time()
+        refilled = RateLimitBucket.tokens + (now - RateLimitBucket.updated_at) * self.rate
+        tokens = case((refilled > self.burst, self.burst), else_=refilled)
+        with SessionLocal() as db:
+            taken = db.execute(
+                update(RateLimitBucket)
+                .where(RateLimitBucket.key == key, tokens >= cost)
+                .values(tokens=tokens - cost, updated_at=now)
+            ).rowcount
+            if taken:
+                db.commit()
+                return None
+            row = db.get(RateLimitBucket, key)
+            if row is not None:
+                return min(self.burst, row.tokens + (now - row.updated_at) * self.rate)
+            # Buckets untouched for burst / rate seconds are full again; drop them
+            db.execute(delete(RateLimitBucket).where(RateLimitBucket.updated_at < now - self.burst / self.rate))
+            db.add(RateLimitBucket(key=key, tokens=self.burst - cost, updated_at=now))
+            try:
+                db.commit()
+            except IntegrityError:
+                # Another worker created the row first
+                db.rollback()
+                return self._take_shared(key, cost)
+        return None
+
+    async def acquire(self, key: str, cost: float = 1.0) -> None:
+        """Takes `cost` tokens from the key's bucket or raises AdmissionRejectedError"""
+        if not self.enabled:
+            return
+        if self.shared:
+            tokens = await run_in_threadpool(self._take_shared, key, cost)
+        else:
+            tokens = self._take(key, cost)
+        if tokens is not None:
+            ADMISSION_REJECTIONS.inc(reason="rate_limit")
+            raise AdmissionRejectedError("Too many requests, please slow down.", (cost - tokens) / self.rate)
+
+
+class UpstreamLimiter:
+    """
+    Caps concurrent upstream calls at `max_concurrent`.
+
+    Callers over the cap wait in a priority queue: interactive before batch,
+    first come first served within a priority. A caller is turned away at
+    once when `max_queue` callers of the same or higher priority are
+    already waiting, and after waiting `queue_timeout` seconds without a
+    slot. Rejections carry a Retry-After estimate based on how long calls
+    have recently held a slot.
+    """
+
+    def __init__(self, max_concurrent: int = UPSTREAM_MAX_CONCURRENT, max_queue: int = UPSTREAM_QUEUE_SIZE, queue_timeout: float = UPSTREAM_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_use = 0
+        self._waiters: List[list] = []  # heap of [priority, sequence, future]
+        self._sequence = itertools.count()
+        self._hold_seconds = 5.0  # moving average of how long a slot is held
+
+    def _waiting(self, priority: int) -> int:
+        return sum(1 for waiter in self._waiters if waiter[0] <= priority and not waiter[2].done())
+
+    def retry_after(self) -> float:
+        """Seconds until a new caller could expect a slot"""
+        return max(1.0, math.ceil(self._hold_seconds * (len(self._waiters) + 1) / self.max_concurrent))
+
+    def check(self, priority: Optional[int] = None) -> None:
+        """Raises AdmissionRejectedError if a call at `priority` would be shed now"""
+        priority = upstream_priority.get() if priority is None else priority
+        if self.in_use >= self.max_concurrent and self._waiting(priority) >= self.max_queue:
+            ADMISSION_REJECTIONS.inc(reason="queue_full")
+            raise AdmissionRejectedError("The AI service is busy, please try again shortly.", self.retry_after())
+
+    @asynccontextmanager
+    async def slot(self, priority: Optional[int] = None) -> AsyncIterator[None]:
+        """Holds one upstream slot for the duration of the with-block"""
+        priority = upstream_priority.get() if priority is None else priority
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        queued_at = time.monotonic()
+        if self.in_use < self.max_concurrent and not self._waiters:
+            self.in_use += 1
+        else:
+            self.check(priority)
+            waiter = [priority, next(self._sequence), asyncio.get_running_loop().create_future()]
+            heapq.heappush(self._waiters, waiter)
+            UPSTREAM_QUEUE_DEPTH.inc(priority=name)
+            try:
+                await asyncio.wait_for(waiter[2], self.queue_timeout)
+            except BaseException as e:
+                if waiter[2].done() and not waiter[2].cancelled():
+                    # The slot was handed over just as we gave up on it
+                    self._release()
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                if isinstance(e, asyncio.TimeoutError):
+                    ADMISSION_REJECTIONS.inc(reason="queue_timeout")
+                    raise AdmissionRejectedError("The AI service is busy, please try again shortly.", self.retry_after()) from None
+                raise
+            finally:
+                UPSTREAM_QUEUE_DEPTH.dec(priority=name)
+        acquired_at = time.monotonic()
+        UPSTREAM_QUEUE_WAIT_SECONDS.observe(acquired_at - queued_at, priority=name)
+        try:
+            yield
+        finally:
+            self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * (time.monotonic() - acquired_at)
+            self._release()
+
+    def _release(self) -> None:
+        # Hand the slot straight to the next waiter, so nobody can jump the queue
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_use -= 1
+
+    def stats(self) -> Dict[str, int]:
+        """Returns slot usage and queue length"""
+        return {
+            "upstream_slots_in_use": self.in_use,
+            "upstream_max_concurrent": self.max_concurrent,
+            "upstream_queued": len(self._waiters),
+        }
+
+
+# Shared by every request handled by this process; with several workers each
+# gets its share of the upstream cap and queue
+user_rate_limiter = RateLimiter()
+upstream_limiter = UpstreamLimiter(
+    max_concurrent=max(1, UPSTREAM_MAX_CONCURRENT // SERVER_WORKERS),
+    max_queue=math.ceil(UPSTREAM_QUEUE_SIZE / SERVER_WORKERS),
+)
@@ -0,0 +1,134 @@
+import os
+import json
+import asyncio
+import logging
+import uuid
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from ..crud import build_recommendation_rows, write_recommendation_sets
+from ..database import run_db, session_scope
+from ..schemas import RecommendationRequest
+from .admission import BATCH, AdmissionRejectedError, upstream_priority, user_rate_limiter
+from .cache_service import get_recommendations_cached
+from .gemini_service import USAGE_KEY
+
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_WRITE_SIZE = int(os.environ.get("BATCH_WRITE_SIZE", "20"))
+# Longest a finished item waits for its group to fill before it is saved and sent
+BATCH_WRITE_INTERVAL = float(os.environ.get("BATCH_WRITE_INTERVAL", "0.5"))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "1000"))
+
+logger = logging.getLogger(__name__)
+
+ItemResult = Tuple[int, RecommendationRequest, Optional[Dict[str, Any]], Optional[str]]
+
+
+def _line(data: Dict[str, Any]) -> str:
+    return json.dumps(data) + "\n"
+
+
+async def _fetch_item(semaphore: asyncio.Semaphore, index: int, item: RecommendationRequest) -> ItemResult:
+    """
+    Fetches one item under the shared concurrency limit; never raises.
+
+    Each item takes a token from its user's rate limit bucket. Batch items
+    queue for upstream slots behind interactive requests, and when the rate
+    limit or the queue sheds them they wait as advised and try again
+    instead of failing.
+    """
+    upstream_priority.set(BATCH)
+    async with semaphore:
+        while True:
+            try:
+                await user_rate_limiter.acquire(item.userId)
+                break
+            except AdmissionRejectedError as e:
+                await asyncio.sleep(e.retry_after)
+        while True:
+            try:
+                recommendations = await get_recommendations_cached(item.prompt, bypass_cache=item.bypassCache)
+                return index, item, recommendations, None
+            except AdmissionRejectedError as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                return index, item, None, str(e)
+
+
+async def _write_results(results: List[ItemResult]) -> List[str]:
+    """Persists finished items in one transaction and returns their NDJSON lines"""
+    rows_list = []
+    responses = []
+    for index, item, recommendations, _ in results:
+        set_id = str(uuid.uuid4())
+        created_at = datetime.utcnow()
+        usage = recommendations.pop(USAGE_KEY, None)
+        rows_list.append(build_recommendation_rows(
+            item.userId, item.prompt, recommendations, set_id=set_id, created_at=created_at, usage=usage
+        ))
+        response = dict(recommendations)
+        response["id"] = set_id
+        response["prompt_text"] = item.prompt
+        response["created_at"] = created_at.isoformat()
+        responses.append(response)
+
+    try:
+        async with session_scope() as db:
+            await run_db(db, write_recommendation_sets, rows_list)
+    except Exception as e:
+        logger.exception("Batch write of %d sets failed", len(results))
+        return [
+            _line({"index": index, "userId": item.userId, "status": "error", "error": f"Failed to save recommendations: {e}"})
+            for index, item, _, _ in results
+        ]
+
+    return [
+        _line({"index": index, "userId": item.userId, "status": "ok", "result": response})
+        for (index, item, _, _), response in zip(results, responses)
+    ]
+
+
+async def run_batch(
+    items: List[RecommendationRequest],
+    concurrency: int = BATCH_CONCURRENCY,
+    write_size: int = BATCH_WRITE_SIZE,
+    write_interval: float = BATCH_WRITE_INTERVAL
+) -> AsyncIterator[str]:
+    """
+    Fans a batch out to Gemini with at most `concurrency` calls in flight and
+    yields one NDJSON line per item in completion order. Successful items are
+    saved in groups, each in a single transaction, before their lines are
+    sent: a group is written once it has `write_size` items or its first
+    item has waited `write_interval` seconds. Failures are reported per item.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.create_task(_fetch_item(semaphore, i, item)) for i, item in enumerate(items)]
+    pending = set(tasks)
+    pending_writes: List[ItemResult] = []
+    write_at = 0.0
+    try:
+        while pending:
+            timeout = max(0.0, write_at - loop.time()) if pending_writes else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                index, item, recommendations, error = result
+                if error is not None:
+                    yield _line({"index": index, "userId": item.userId, "status": "error", "error": error})
+                    continue
+                if not pending_writes:
+                    write_at = loop.time() + write_interval
+                pending_writes.append(result)
+
+            if pending_writes and (len(pending_writes) >= write_size or loop.time() >= write_at or not pending):
+                results, pending_writes = pending_writes, []
+                for line in await _write_results(results):
+                    yield line
+    finally:
+        # Keep what already finished if the client goes away, then stop the
+        # outstanding upstream calls
+        if pending_writes:
+            await _write_results(pending_writes)
+        for task in tasks:
+            task.cancel()
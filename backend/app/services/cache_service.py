@@ -0,0 +1,196 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from ..crud import get_recommendation_body, get_recommendation_set, recommendation_set_to_response
+from ..database import SHARED_CACHE, SessionLocal
+from ..metrics import CACHE_LOOKUPS
+from ..models import CachedResponse
+from ..response_bodies import negotiate_body
+from ..similarity import find_similar_set, prompt_index
+from .gemini_service import USAGE_KEY, fetch_recommendations, normalize_prompt, get_config_fingerprint
+
+CACHE_TTL_SECONDS = int(os.environ.get("RECOMMENDATION_CACHE_TTL", "86400"))
+CACHE_MAX_ENTRIES = int(os.environ.get("RECOMMENDATION_CACHE_MAX_ENTRIES", "1000"))
+CACHE_ENABLED = os.environ.get("RECOMMENDATION_CACHE_ENABLED", "true").lower() == "true"
+
+
+class RecommendationCache:
+    """
+    Two-level cache for Gemini responses: a size-bounded in-memory LRU in
+    front of a SQLite table that survives restarts.
+
+    With `shared` the in-memory level is skipped and every lookup goes to
+    the table, so worker processes share one warm cache and a replaced or
+    cleared entry is never served stale from another worker's memory.
+    """
+
+    def __init__(self, ttl_seconds: int = CACHE_TTL_SECONDS, max_entries: int = CACHE_MAX_ENTRIES, shared: bool = SHARED_CACHE):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.max_entries = max_entries
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def make_key(self, user_prompt: str) -> str:
+        """Builds the cache key from the normalized prompt and config fingerprint"""
+        raw = f"{get_config_fingerprint()}:{normalize_prompt(user_prompt)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _is_fresh(self, created_at: datetime) -> bool:
+        return datetime.utcnow() - created_at < self.ttl
+
+    def _remember(self, key: str, response_json: str, created_at: datetime) -> None:
+        if self.shared:
+            return
+        with self._lock:
+            self._memory[key] = (response_json, created_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns a fresh copy of the cached response, or None"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._is_fresh(entry[1]):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    CACHE_LOOKUPS.inc(result="hit")
+                    return json.loads(entry[0])
+                del self._memory[key]
+
+        db = SessionLocal()
+        try:
+            row = db.query(CachedResponse).filter(CachedResponse.key == key).first()
+            if row and self._is_fresh(row.created_at):
+                self._remember(key, row.response_json, row.created_at)
+                with self._lock:
+                    self.hits += 1
+                CACHE_LOOKUPS.inc(result="hit")
+                return json.loads(row.response_json)
+            if row:
+                db.delete(row)
+                db.commit()
+        finally:
+            db.close()
+
+        with self._lock:
+            self.misses += 1
+        CACHE_LOOKUPS.inc(result="miss")
+        return None
+
+    def set(self, key: str, response: Dict[str, Any]) -> None:
+        """Stores a response in memory and in the persistent table"""
+        response_json = json.dumps(response)
+        created_at = datetime.utcnow()
+        self._remember(key, response_json, created_at)
+
+        db = SessionLocal()
+        try:
+            db.merge(CachedResponse(key=key, response_json=response_json, created_at=created_at))
+            # Drop expired rows so the table does not grow without bound
+            db.query(CachedResponse)\
+                .filter(CachedResponse.created_at < created_at - self.ttl)\
+                .delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def clear(self) -> None:
+        """Removes every cached response"""
+        with self._lock:
+            self._memory.clear()
+        db = SessionLocal()
+        try:
+            db.query(CachedResponse).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns hit/miss counters and current size"""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "backend": "database" if self.shared else "memory+database",
+            "memory_entries": len(self._memory),
+            "max_entries": self.max_entries,
+            "ttl_seconds": int(self.ttl.total_seconds()),
+        }
+
+
+recommendation_cache = RecommendationCache()
+
+
+def reuse_similar_answer(user_prompt: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns the stored answer of the most similar past prompt, with the set
+    it came from and the similarity under USAGE_KEY, or None if no past
+    prompt is close enough.
+    """
+    with SessionLocal() as db:
+        set_id, similarity = find_similar_set(db, user_prompt)
+        if set_id is None:
+            return None
+        body = get_recommendation_body(db, set_id)
+        if body is not None:
+            response = json.loads(negotiate_body(body.body, body.encoding, None)[0])
+        else:
+            stored = get_recommendation_set(db, set_id)
+            if stored is None:
+                return None
+            response = recommendation_set_to_response(stored)
+    return {"categories": response["categories"], USAGE_KEY: {"reused_from": set_id, "similarity": round(similarity, 4)}}
+
+
+async def lookup_cached_recommendations(user_prompt: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns the cached response for a prompt, else the answer to a similar
+    past prompt when similarity reuse is on, or None on a miss
+    """
+    # The SQLite tier does blocking I/O, so keep it off the event loop
+    if CACHE_ENABLED:
+        cached = await run_in_threadpool(recommendation_cache.get, recommendation_cache.make_key(user_prompt))
+        if cached is not None:
+            return cached
+    if prompt_index is not None:
+        return await run_in_threadpool(reuse_similar_answer, user_prompt)
+    return None
+
+
+async def store_cached_recommendations(user_prompt: str, recommendations: Dict[str, Any]) -> None:
+    """Caches a fresh upstream response for a prompt"""
+    if CACHE_ENABLED:
+        # Token usage belongs to the call that produced the answer, not to cache hits
+        response = {k: v for k, v in recommendations.items() if k != USAGE_KEY}
+        await run_in_threadpool(recommendation_cache.set, recommendation_cache.make_key(user_prompt), response)
+
+
+async def get_recommendations_cached(user_prompt: str, bypass_cache: bool = False) -> Dict[str, Any]:
+    """
+    Returns recommendations for a prompt, serving repeated prompts from the
+    cache and near-duplicates from similar past sets. With bypass_cache the
+    upstream is always called and the fresh response replaces the cached one.
+    """
+    if not bypass_cache:
+        cached = await lookup_cached_recommendations(user_prompt)
+        if cached is not None:
+            return cached
+
+    recommendations = await fetch_recommendations(user_prompt)
+    await store_cached_recommendations(user_prompt, recommendations)
+    return recommendations
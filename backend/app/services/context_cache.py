@@ -0,0 +1,202 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+import httpx
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
+
+from ..database import SHARED_CACHE, SessionLocal
+from ..metrics import CONTEXT_CACHE_EVENTS
+from ..models import ContextCacheEntry
+from .upstream import get_client
+
+CONTEXT_CACHE_ENABLED = os.environ.get("GEMINI_CONTEXT_CACHE_ENABLED", "false").lower() == "true"
+CONTEXT_CACHE_TTL = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+CONTEXT_CACHE_REFRESH_MARGIN = int(os.environ.get("GEMINI_CONTEXT_CACHE_REFRESH_MARGIN", "300"))
+CONTEXT_CACHE_RETRY_AFTER = int(os.environ.get("GEMINI_CONTEXT_CACHE_RETRY_AFTER", "300"))
+# Gemini rejects cachedContents below a per-model input size (1,024 tokens
+# for 2.5 Flash, more for Pro); smaller prompts are not worth a create call
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+# Rough characters per token, for estimating the prompt's size
+CHARS_PER_TOKEN = 4
+
+logger = logging.getLogger(__name__)
+
+
+class ContextCache:
+    """
+    Keeps the system instruction registered as a Gemini cachedContents entry
+    so requests can reference it instead of resending it.
+
+    name() returns the entry to use, creating it on first use, extending its
+    TTL once it is within `refresh_margin` seconds of expiring and replacing
+    it when the instruction (or model) changes. When the entry cannot be
+    created it returns None, the caller sends the instruction inline, and
+    creation is not attempted again for `retry_after` seconds. Instructions
+    estimated below `min_tokens` are always sent inline.
+
+    With `shared` the entry in use is also recorded in the database, so
+    worker processes adopt the one another worker created or refreshed
+    instead of each registering their own copy.
+    """
+
+    def __init__(
+        self,
+        api_base: str,
+        api_key: str,
+        model: str,
+        enabled: bool = CONTEXT_CACHE_ENABLED,
+        ttl: int = CONTEXT_CACHE_TTL,
+        refresh_margin: int = CONTEXT_CACHE_REFRESH_MARGIN,
+        retry_after: int = CONTEXT_CACHE_RETRY_AFTER,
+        min_tokens: int = CONTEXT_CACHE_MIN_TOKENS,
+        shared: bool = SHARED_CACHE,
+    ):
+        self.api_base = api_base
+        self.api_key = api_key
+        self.model = model
+        self.enabled = enabled
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self.min_tokens = min_tokens
+        self.shared = shared
+        self._rejected: Optional[str] = None
+        self._name: Optional[str] = None
+        self._hash: Optional[str] = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _headers(self) -> dict:
+        # In a header rather than the query string, so it never shows up in logged URLs
+        return {"x-goog-api-key": self.api_key}
+
+    def _prompt_hash(self, system_prompt: str) -> str:
+        return hashlib.sha256(f"{self.model}\n{system_prompt}".encode("utf-8")).hexdigest()
+
+    def _valid(self, prompt_hash: str, now: float, margin: float = 0.0) -> bool:
+        return self._name is not None and self._hash == prompt_hash and now < self._expires_at - margin
+
+    async def name(self, system_prompt: str) -> Optional[str]:
+        """The cachedContents name to reference, or None to send the prompt inline"""
+        if not self.enabled or len(system_prompt) // CHARS_PER_TOKEN < self.min_tokens:
+            return None
+        prompt_hash = self._prompt_hash(system_prompt)
+        if self._valid(prompt_hash, time.monotonic(), self.refresh_margin):
+            return self._name
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            if self._valid(prompt_hash, now, self.refresh_margin):
+                return self._name
+            if self.shared and await self._adopt_shared(prompt_hash, now):
+                return self._name
+            if now < self._retry_at:
+                return self._name if self._valid(prompt_hash, now) else None
+            try:
+                if not (self._valid(prompt_hash, now) and await self._refresh(now)):
+                    await self._create(system_prompt, prompt_hash, now)
+                if self.shared:
+                    await self._save_shared(now)
+                return self._name
+            except (httpx.HTTPError, KeyError, ValueError) as e:
+                CONTEXT_CACHE_EVENTS.inc(event="failure")
+                logger.warning("Context cache unavailable, sending the system prompt inline: %s", e)
+                self._retry_at = now + self.retry_after
+                # A failed refresh keeps using the entry until it actually expires
+                return self._name if self._valid(prompt_hash, now) else None
+
+    def invalidate(self, name: str) -> None:
+        """Forgets an entry the upstream no longer recognizes"""
+        if self._name == name:
+            CONTEXT_CACHE_EVENTS.inc(event="invalidated")
+            logger.warning("Context cache %s was rejected upstream; recreating it", name)
+            self._rejected = name
+            self._name = None
+            self._expires_at = 0.0
+
+    async def _adopt_shared(self, prompt_hash: str, now: float) -> bool:
+        """Takes over the entry another worker recorded, if it is still good"""
+        def load():
+            with SessionLocal() as db:
+                row = db.get(ContextCacheEntry, self.model)
+                return (row.prompt_hash, row.name, row.expires_at) if row else None
+        try:
+            entry = await run_in_threadpool(load)
+        except SQLAlchemyError as e:
+            logger.warning("Could not read the shared context cache entry: %s", e)
+            return False
+        # An entry this worker saw rejected is not taken back from the table
+        if entry is None or entry[0] != prompt_hash or entry[1] == self._rejected:
+            return False
+        remaining = (entry[2] - datetime.utcnow()).total_seconds()
+        if remaining <= self.refresh_margin:
+            return False
+        self._name, self._hash, self._expires_at = entry[1], prompt_hash, now + remaining
+        return True
+
+    async def _save_shared(self, now: float) -> None:
+        """Records the entry in use for the other workers"""
+        entry = ContextCacheEntry(
+            model=self.model,
+            prompt_hash=self._hash,
+            name=self._name,
+            expires_at=datetime.utcnow() + timedelta(seconds=self._expires_at - now),
+        )
+        def save():
+            with SessionLocal() as db:
+                db.merge(entry)
+                db.commit()
+        try:
+            await run_in_threadpool(save)
+        except SQLAlchemyError as e:
+            logger.warning("Could not record the shared context cache entry: %s", e)
+
+    async def _create(self, system_prompt: str, prompt_hash: str, now: float) -> None:
+        client = await get_client()
+        response = await client.post(
+            f"{self.api_base}/cachedContents",
+            headers=self._headers(),
+            json={
+                "model": f"models/{self.model}",
+                "displayName": "slopeselector-system-prompt",
+                "systemInstruction": {"parts": [{"text": system_prompt}]},
+                "ttl": f"{self.ttl}s",
+            },
+        )
+        response.raise_for_status()
+        old_name = self._name
+        self._name = response.json()["name"]
+        self._hash = prompt_hash
+        self._expires_at = now + self.ttl
+        CONTEXT_CACHE_EVENTS.inc(event="create")
+        logger.info("Created context cache %s", self._name)
+        if old_name and old_name != self._name:
+            # The old instruction is no longer used; stop paying to store it
+            try:
+                await client.delete(f"{self.api_base}/{old_name}", headers=self._headers())
+            except httpx.HTTPError:
+                pass
+
+    async def _refresh(self, now: float) -> bool:
+        """Extends the entry's TTL; returns False if it is already gone upstream"""
+        client = await get_client()
+        response = await client.patch(
+            f"{self.api_base}/{self._name}?updateMask=ttl",
+            headers=self._headers(),
+            json={"ttl": f"{self.ttl}s"},
+        )
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        self._expires_at = now + self.ttl
+        CONTEXT_CACHE_EVENTS.inc(event="refresh")
+        return True
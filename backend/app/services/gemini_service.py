@@ -1,12 +1,75 @@
 import os
 import httpx
 import json
-import time
-from typing import Dict, Any
+import copy
+import asyncio
+import hashlib
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, Any, Optional
+
+from pydantic import ValidationError
+
+from ..metrics import STAGE_SECONDS, UPSTREAM_CALLS_SAVED, UPSTREAM_IN_FLIGHT, UPSTREAM_RETRIES, UPSTREAM_TOKENS
+from ..schemas import ApiResponse
+from .admission import upstream_limiter
+from .context_cache import ContextCache
+from .hedging import HEDGE_ENABLED, LatencyTracker, hedged
+from .upstream import (
+    CircuitBreaker,
+    RETRYABLE_STATUS_CODES,
+    get_client,
+    sleep_before_retry,
+)
+
+logger = logging.getLogger(__name__)
 
 # Your API key should be loaded from environment variables
 API_KEY = os.environ.get("GEMINI_API_KEY", "")
-API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-pro:generateContent?key={API_KEY}"
+# Point GEMINI_API_BASE at a local stand-in (see benchmarks/fake_gemini.py) to run without quota
+API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+# Model tiers: the primary answers every request; with GEMINI_HEDGE_ENABLED a
+# request the primary is slow to answer is also sent to the hedge model (a
+# faster Flash variant by default, or the primary model again)
+MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.5-pro")
+HEDGE_MODEL = os.environ.get("GEMINI_HEDGE_MODEL", "gemini-2.5-flash")
+
+
+class ModelTier:
+    """A model the service can call, with its own endpoints, breaker and context cache"""
+
+    def __init__(self, name: str, model: str, context_cache: Optional[ContextCache] = None):
+        self.name = name
+        self.model = model
+        self.url = f"{API_BASE}/models/{model}:generateContent"
+        self.stream_url = f"{API_BASE}/models/{model}:streamGenerateContent?alt=sse"
+        # One tier failing must not make the other fail fast
+        self.circuit_breaker = CircuitBreaker()
+        # cachedContents entries are bound to a model
+        self.context_cache = context_cache or ContextCache(API_BASE, API_KEY, model)
+
+
+PRIMARY_TIER = ModelTier("primary", MODEL)
+HEDGE_TIER = ModelTier(
+    "hedge", HEDGE_MODEL, PRIMARY_TIER.context_cache if HEDGE_MODEL == MODEL else None
+)
+
+# The primary tier's endpoints, circuit breaker and system-prompt cache
+API_URL = PRIMARY_TIER.url
+STREAM_API_URL = PRIMARY_TIER.stream_url
+circuit_breaker = PRIMARY_TIER.circuit_breaker
+context_cache = PRIMARY_TIER.context_cache
+
+# Recent primary latencies, which set how long to wait before hedging
+primary_latency = LatencyTracker()
+
+# The key goes in a header rather than the query string, so it never shows
+# up in logged URLs or in the text of httpx errors
+API_HEADERS = {"x-goog-api-key": API_KEY}
+
+# Token usage and model tier of the call that produced an answer travel with
+# it under this key until they are stored on the set; they are never cached
+# or sent to clients
+USAGE_KEY = "_usage"
 
 # The JSON schema to enforce
 GENERATION_CONFIG = {
@@ -82,38 +145,349 @@ IMPORTANT NOTES:
 
 Format Output: You MUST return ONLY a valid JSON object adhering to the specified schema. Do not include any text, backticks, or explanations outside of the JSON."""
 
-async def fetch_recommendations(user_prompt: str) -> Dict[str, Any]:
+def normalize_prompt(user_prompt: str) -> str:
+    """Normalizes a prompt so trivially different spellings share cache entries"""
+    return " ".join(user_prompt.lower().split())
+
+def get_config_fingerprint() -> str:
+    """Returns a hash of the system prompt and generation config.
+
+    Any edit to either changes the fingerprint, which invalidates responses
+    that were generated under the old prompt or schema.
     """
-    Fetches recommendations from the Gemini API with exponential backoff.
+    prompt_hash = hashlib.sha256(get_system_prompt().encode("utf-8")).hexdigest()
+    config_hash = hashlib.sha256(
+        json.dumps(GENERATION_CONFIG, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    return f"{prompt_hash}:{config_hash}"
+
+def build_payload(user_prompt: str, cached_content: Optional[str] = None) -> Dict[str, Any]:
+    """Builds the generateContent request body for a user prompt.
+
+    With cached_content the system prompt is referenced instead of inlined.
+    The response schema is always sent: cachedContents cannot hold a
+    generationConfig.
     """
-    if not API_KEY:
-        raise Exception("GEMINI_API_KEY environment variable is not set")
-    
     payload = {
         "contents": [{"parts": [{"text": user_prompt}]}],
-        "systemInstruction": {"parts": [{"text": get_system_prompt()}]},
         "generationConfig": GENERATION_CONFIG
     }
+    if cached_content:
+        payload["cachedContent"] = cached_content
+    else:
+        payload["systemInstruction"] = {"parts": [{"text": get_system_prompt()}]}
+    return payload
+
+def extract_text(result: Dict[str, Any]) -> str:
+    """Returns the generated text of the first candidate, or an empty string"""
+    candidates = result.get("candidates") or [{}]
+    parts = candidates[0].get("content", {}).get("parts") or [{}]
+    return parts[0].get("text", "")
+
+def parse_object(text: str) -> Dict[str, Any]:
+    """json.loads for text that must hold a JSON object; raises ValueError otherwise"""
+    value = json.loads(text)
+    if not isinstance(value, dict):
+        raise ValueError(f"Expected a JSON object, got {type(value).__name__}")
+    return value
+
+def extract_usage(result: Dict[str, Any]) -> Optional[Dict[str, int]]:
+    """Returns prompt, cached and output (incl. thinking) token counts, if reported"""
+    usage = result.get("usageMetadata")
+    if not usage:
+        return None
+    return {
+        "prompt_tokens": usage.get("promptTokenCount", 0),
+        "cached_tokens": usage.get("cachedContentTokenCount", 0),
+        "output_tokens": usage.get("candidatesTokenCount", 0) + usage.get("thoughtsTokenCount", 0),
+    }
+
+def record_usage(usage: Optional[Dict[str, int]]) -> None:
+    """Observes one call's token usage in the metrics"""
+    if usage:
+        for kind in ("prompt", "cached", "output"):
+            UPSTREAM_TOKENS.observe(usage[f"{kind}_tokens"], kind=kind)
+
+def call_metadata(tier: ModelTier, usage: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """What is stored on a set about the call that produced it"""
+    return {"model_tier": tier.name, "model": tier.model, **(usage or {})}
+
+def is_valid_answer(recommendations: Dict[str, Any]) -> bool:
+    """True when an answer conforms to the response schema and has categories"""
+    try:
+        ApiResponse.model_validate(recommendations)
+    except ValidationError:
+        return False
+    return bool(recommendations.get("categories"))
+
+def _rejected_cached_content(e: httpx.HTTPStatusError, cached_content: Optional[str]) -> bool:
+    """True when a request referencing a cache entry failed because of the entry"""
+    return bool(cached_content) and e.response.status_code in (400, 403, 404)
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key onto one in-flight task.
+
+    Waiters await the shared task through asyncio.shield, so one caller
+    disconnecting does not cancel the call for the others; the task is only
+    cancelled once every waiter has gone away.
+    """
+
+    def __init__(self):
+        self.upstream_calls = 0
+        self.calls_saved = 0
+        self._calls: Dict[str, Dict[str, Any]] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = {"task": asyncio.ensure_future(fn()), "waiters": 0}
+            self._calls[key] = call
+            call["task"].add_done_callback(lambda _: self._forget(key, call))
+            self.upstream_calls += 1
+        else:
+            self.calls_saved += 1
+            UPSTREAM_CALLS_SAVED.inc()
+        
+        call["waiters"] += 1
+        try:
+            result = await asyncio.shield(call["task"])
+        finally:
+            call["waiters"] -= 1
+            if call["waiters"] == 0 and not call["task"].done():
+                # Every caller was cancelled; nobody is left to use the result
+                self._forget(key, call)
+                call["task"].cancel()
+        # Callers add their own set id and timestamp, so each gets a copy
+        return copy.deepcopy(result)
+
+    def _forget(self, key: str, call: Dict[str, Any]) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def drain(self, timeout: float) -> None:
+        """Waits up to `timeout` seconds for in-flight upstream calls to finish"""
+        tasks = [call["task"] for call in self._calls.values()]
+        if tasks:
+            logger.info("Waiting for %d in-flight Gemini calls", len(tasks))
+            await asyncio.wait(tasks, timeout=timeout)
+
+    def stats(self) -> Dict[str, int]:
+        """Returns upstream call and coalescing counters"""
+        return {
+            "upstream_calls": self.upstream_calls,
+            "upstream_calls_saved": self.calls_saved,
+            "in_flight": len(self._calls),
+        }
+
+# Identical prompts submitted at the same time share one upstream call
+single_flight = SingleFlight()
+
+async def fetch_recommendations(user_prompt: str) -> Dict[str, Any]:
+    """
+    Fetches recommendations, coalescing concurrent calls for the same
+    normalized prompt into a single upstream request. Only the caller that
+    started the call gets its token usage, so it is stored once; the
+    others keep just the model tier.
+    """
+    started = False
+
+    def start():
+        nonlocal started
+        started = True
+        return _fetch_upstream(user_prompt)
+
+    result = await single_flight.do(normalize_prompt(user_prompt), start)
+    if not started and USAGE_KEY in result:
+        result[USAGE_KEY] = {key: result[USAGE_KEY][key] for key in ("model_tier", "model")}
+    return result
+
+def _describe(error: httpx.HTTPError) -> str:
+    """An upstream error without its URL: the status and reason, or the error type"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return f"HTTP {error.response.status_code} {error.response.reason_phrase}"
+    return type(error).__name__
+
+async def _fetch_upstream(user_prompt: str) -> Dict[str, Any]:
+    """
+    Fetches recommendations from the primary model tier. With hedging
+    enabled, a prompt the primary has not answered by the latency deadline
+    (or has failed) is also sent to the hedge tier; the first valid answer
+    is used and the other call cancelled.
+
+    Each call waits for a slot under the global upstream concurrency cap
+    and raises AdmissionRejectedError when it is shed.
+    """
+    if not API_KEY:
+        raise Exception("GEMINI_API_KEY environment variable is not set")
+    async with upstream_limiter.slot():
+        if not HEDGE_ENABLED:
+            return await _call_tier(PRIMARY_TIER, user_prompt)
+
+        _, recommendations = await hedged(
+            lambda: _call_tier(PRIMARY_TIER, user_prompt),
+            lambda: _call_tier(HEDGE_TIER, user_prompt),
+            primary_latency.deadline(),
+            is_valid_answer,
+            on_primary_done=primary_latency.observe,
+        )
+        return recommendations
+
+async def _call_tier(tier: ModelTier, user_prompt: str) -> Dict[str, Any]:
+    """
+    Calls one model tier over the shared pooled client, retrying with
+    jittered backoff and failing fast while the tier's circuit is open.
+    """
+    cached_content = await tier.context_cache.name(get_system_prompt())
+    payload = build_payload(user_prompt, cached_content)
     
     max_retries = 5
-    delay = 1.0  # seconds
+    client = await get_client()
+    retries = 0
     
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        for attempt in range(max_retries):
-            try:
-                response = await client.post(API_URL, json=payload)
-                response.raise_for_status()  # Raise an exception for bad status codes
-                
-                result = response.json()
-                json_text = result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "{}")
-                
-                return json.loads(json_text)
+    with UPSTREAM_IN_FLIGHT.track_in_progress():
+        try:
+            attempt = 0
+            while attempt < max_retries:
+                retries = attempt
+                tier.circuit_breaker.before_call()
+                response = None
+                try:
+                    with STAGE_SECONDS.time(stage="upstream"):
+                        response = await client.post(tier.url, json=payload, headers=API_HEADERS)
+                    response.raise_for_status()  # Raise an exception for bad status codes
+                    tier.circuit_breaker.record_success()
+                    
+                    with STAGE_SECONDS.time(stage="json_parse"):
+                        result = parse_object(response.text)
+                        recommendations = parse_object(extract_text(result) or "{}")
+                    usage = extract_usage(result)
+                    record_usage(usage)
+                    recommendations[USAGE_KEY] = call_metadata(tier, usage)
+                    return recommendations
 
-            except (httpx.RequestError, httpx.HTTPStatusError, json.JSONDecodeError) as e:
-                print(f"API call attempt {attempt + 1} failed: {e}")
-                if attempt + 1 == max_retries:
-                    raise Exception("Failed to get recommendations from AI after several attempts.") from e
+                except httpx.HTTPStatusError as e:
+                    if _rejected_cached_content(e, cached_content):
+                        # The cache entry expired or was deleted; resend inline now,
+                        # without counting it as an attempt (this happens at most once)
+                        tier.circuit_breaker.record_success()
+                        tier.context_cache.invalidate(cached_content)
+                        cached_content = None
+                        payload = build_payload(user_prompt)
+                        continue
+                    if e.response.status_code not in RETRYABLE_STATUS_CODES:
+                        # The upstream is healthy, the request itself was rejected
+                        tier.circuit_breaker.record_success()
+                        logger.warning("API call to %s was rejected: %s", tier.model, _describe(e), extra={"status": e.response.status_code})
+                        raise Exception("AI service rejected the request.") from e
+                    tier.circuit_breaker.record_failure()
+                    logger.warning("API call to %s attempt %d failed: %s", tier.model, attempt + 1, _describe(e), extra={"status": e.response.status_code})
+                    if attempt + 1 == max_retries:
+                        raise Exception("Failed to get recommendations from AI after several attempts.") from e
+                except httpx.RequestError as e:
+                    tier.circuit_breaker.record_failure()
+                    logger.warning("API call to %s attempt %d failed: %s", tier.model, attempt + 1, _describe(e))
+                    if attempt + 1 == max_retries:
+                        raise Exception("Failed to get recommendations from AI after several attempts.") from e
+                except ValueError as e:
+                    logger.warning("API call to %s attempt %d returned invalid JSON: %s", tier.model, attempt + 1, e)
+                    if attempt + 1 == max_retries:
+                        raise Exception("Failed to get recommendations from AI after several attempts.") from e
+                finally:
+                    tier.circuit_breaker.release_trial()
                 
-                # Exponential backoff
-                time.sleep(delay)
-                delay *= 2
+                # Jittered exponential backoff, without blocking the event loop
+                await sleep_before_retry(attempt, response)
+                attempt += 1
+        finally:
+            UPSTREAM_RETRIES.observe(retries)
+
+async def stream_recommendations(user_prompt: str, usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """
+    Streams the generated JSON text from streamGenerateContent as it arrives.
+
+    Connection failures are retried like fetch_recommendations, but only until
+    the first fragment has been yielded; after that an error is raised to the
+    caller, which has already forwarded partial output. For the same reason
+    streams are not hedged and always use the primary tier. When `usage` is
+    given it is filled with the call's token usage and tier once the stream
+    ends. The stream holds an upstream slot until it finishes.
+    """
+    if not API_KEY:
+        raise Exception("GEMINI_API_KEY environment variable is not set")
+    
+    async with upstream_limiter.slot():
+        async for text in _stream_upstream(user_prompt, usage):
+            yield text
+
+async def _stream_upstream(user_prompt: str, usage: Optional[Dict[str, Any]]) -> AsyncIterator[str]:
+    cached_content = await PRIMARY_TIER.context_cache.name(get_system_prompt())
+    payload = build_payload(user_prompt, cached_content)
+    
+    max_retries = 5
+    client = await get_client()
+    
+    attempt = 0
+    while attempt < max_retries:
+        circuit_breaker.before_call()
+        response = None
+        started = False
+        try:
+            with UPSTREAM_IN_FLIGHT.track_in_progress():
+                async with client.stream("POST", STREAM_API_URL, json=payload, headers=API_HEADERS) as response:
+                    if response.status_code >= 400:
+                        await response.aread()
+                    response.raise_for_status()
+                    circuit_breaker.record_success()
+                    
+                    # Each server-sent event carries a partial GenerateContentResponse;
+                    # usageMetadata is cumulative, so the last one seen is the total
+                    stream_usage = None
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        event = parse_object(line[len("data:"):])
+                        stream_usage = extract_usage(event) or stream_usage
+                        text = extract_text(event)
+                        if text:
+                            started = True
+                            yield text
+                    record_usage(stream_usage)
+                    if usage is not None:
+                        usage.update(call_metadata(PRIMARY_TIER, stream_usage))
+                    return
+
+        except httpx.HTTPStatusError as e:
+            if _rejected_cached_content(e, cached_content):
+                # Resent inline without counting as an attempt, as in _call_tier
+                circuit_breaker.record_success()
+                context_cache.invalidate(cached_content)
+                cached_content = None
+                payload = build_payload(user_prompt)
+                continue
+            if e.response.status_code not in RETRYABLE_STATUS_CODES:
+                circuit_breaker.record_success()
+                logger.warning("Streaming API call was rejected: %s", _describe(e), extra={"status": e.response.status_code})
+                raise Exception("AI service rejected the request.") from e
+            circuit_breaker.record_failure()
+            logger.warning("Streaming API call attempt %d failed: %s", attempt + 1, _describe(e), extra={"status": e.response.status_code})
+            if attempt + 1 == max_retries:
+                raise Exception("Failed to get recommendations from AI after several attempts.") from e
+        except httpx.RequestError as e:
+            circuit_breaker.record_failure()
+            logger.warning("Streaming API call attempt %d failed: %s", attempt + 1, _describe(e))
+            if started:
+                raise Exception("AI response stream was interrupted.") from e
+            if attempt + 1 == max_retries:
+                raise Exception("Failed to get recommendations from AI after several attempts.") from e
+        except ValueError as e:
+            logger.warning("Streaming API call attempt %d returned an invalid event: %s", attempt + 1, e)
+            if started:
+                raise Exception("AI response stream was interrupted.") from e
+            if attempt + 1 == max_retries:
+                raise Exception("Failed to get recommendations from AI after several attempts.") from e
+        finally:
+            circuit_breaker.release_trial()
+        
+        await sleep_before_retry(attempt, response)
+        attempt += 1
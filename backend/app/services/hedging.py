@@ -0,0 +1,125 @@
+import os
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+from ..metrics import UPSTREAM_HEDGE_DELAY, UPSTREAM_HEDGES
+
+HEDGE_ENABLED = os.environ.get("GEMINI_HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.environ.get("GEMINI_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY = float(os.environ.get("GEMINI_HEDGE_MIN_DELAY", "2"))
+HEDGE_MAX_DELAY = float(os.environ.get("GEMINI_HEDGE_MAX_DELAY", "45"))
+HEDGE_INITIAL_DELAY = float(os.environ.get("GEMINI_HEDGE_INITIAL_DELAY", "20"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.environ.get("GEMINI_HEDGE_WINDOW", "500"))
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """
+    Sliding window of recent primary call latencies that sets the hedge
+    deadline at their `percentile`, clamped to [min_delay, max_delay].
+
+    Until `min_samples` calls have been observed the deadline is
+    `initial_delay`. Calls cut short by a winning hedge are recorded with
+    the time they had run, a lower bound of their real latency, so that
+    hedging does not hide the slow calls and drag the deadline down.
+    """
+
+    def __init__(
+        self,
+        percentile: float = HEDGE_PERCENTILE,
+        min_delay: float = HEDGE_MIN_DELAY,
+        max_delay: float = HEDGE_MAX_DELAY,
+        initial_delay: float = HEDGE_INITIAL_DELAY,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+        window: int = HEDGE_WINDOW,
+    ):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def deadline(self) -> float:
+        """Seconds to wait for the primary before sending the hedge"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            delay = self.initial_delay
+        else:
+            index = min(len(samples) - 1, int(len(samples) * self.percentile / 100))
+            delay = samples[index]
+        delay = min(self.max_delay, max(self.min_delay, delay))
+        UPSTREAM_HEDGE_DELAY.set(delay)
+        return delay
+
+
+async def hedged(
+    primary: Callable[[], Awaitable[Any]],
+    hedge: Callable[[], Awaitable[Any]],
+    delay: float,
+    is_valid: Callable[[Any], bool],
+    on_primary_done: Optional[Callable[[float], None]] = None,
+) -> Tuple[str, Any]:
+    """
+    Runs primary() and, if it has not returned a valid result within
+    `delay` seconds (or failed earlier), hedge() alongside it.
+
+    The first valid result wins and the other call is cancelled. Returns
+    ("primary" or "hedge", result). When neither result is valid the
+    primary's is returned if it has one, otherwise the hedge's, and when
+    both calls raised, the primary's exception is re-raised.
+    `on_primary_done` receives how long the primary ran, finished or not.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    primary_task = asyncio.ensure_future(primary())
+    hedge_task = None
+
+    def primary_finished(task: asyncio.Future) -> None:
+        # Failed calls say nothing about how long an answer takes
+        if on_primary_done is not None and not task.cancelled() and task.exception() is None:
+            on_primary_done(loop.time() - started)
+
+    primary_task.add_done_callback(primary_finished)
+    try:
+        done, _ = await asyncio.wait([primary_task], timeout=delay)
+        if done and primary_task.exception() is None and is_valid(primary_task.result()):
+            return "primary", primary_task.result()
+        reason = "failure" if done else "deadline"
+        logger.info("Primary model %s after %.1fs; sending hedge request",
+                    "gave no valid answer" if done else "missed its deadline", loop.time() - started)
+
+        hedge_task = asyncio.ensure_future(hedge())
+        tasks = {primary_task: "primary", hedge_task: "hedge"}
+        pending = {task for task in tasks if not task.done()}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda t: tasks[t] != "primary"):
+                if task.exception() is None and is_valid(task.result()):
+                    UPSTREAM_HEDGES.inc(reason=reason, winner=tasks[task])
+                    return tasks[task], task.result()
+
+        UPSTREAM_HEDGES.inc(reason=reason, winner="none")
+        for task in (primary_task, hedge_task):
+            if task.exception() is None:
+                return tasks[task], task.result()
+        raise primary_task.exception()
+    finally:
+        if not primary_task.done():
+            primary_task.remove_done_callback(primary_finished)
+            primary_task.cancel()
+            if on_primary_done is not None:
+                on_primary_done(loop.time() - started)
+        if hedge_task is not None and not hedge_task.done():
+            hedge_task.cancel()
@@ -0,0 +1,181 @@
+import os
+import asyncio
+import logging
+import socket
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from ..crud import (
+    build_recommendation_rows, claim_job, complete_job, fail_job, has_unfinished_jobs, renew_job_lease, requeue_job,
+)
+from ..database import run_db, session_scope
+from ..metrics import JOB_EVENTS, JOB_QUEUE_SECONDS
+from .admission import AdmissionRejectedError
+from .cache_service import get_recommendations_cached
+from .gemini_service import USAGE_KEY
+
+# Per process, started on the first job; 0 only accepts jobs
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "60"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "5"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+async def _call(fn: Callable, *args, **kwargs) -> Any:
+    async with session_scope() as db:
+        return await run_db(db, fn, *args, **kwargs)
+
+
+class JobWorkerPool:
+    """
+    Background workers answering queued recommendation jobs.
+
+    Jobs live in the recommendation_jobs table, so any worker of any
+    process can take them. A worker claims one under a lease of
+    `lease_seconds` and renews it while Gemini is working on it; if the
+    worker dies the lease runs out and another worker claims the job again,
+    up to `max_attempts` claims. The set is written in the same transaction
+    that marks the job succeeded, and only while the lease is still held.
+    Failed calls are retried with exponential backoff; calls shed by
+    admission control wait as advised without using up an attempt.
+
+    Workers only start once there is a job: at startup if unfinished jobs
+    are left in the table, otherwise on the first submission, so a
+    deployment that never uses jobs never polls for them.
+    """
+
+    def __init__(
+        self,
+        workers: int = JOB_WORKERS,
+        lease_seconds: float = JOB_LEASE_SECONDS,
+        poll_interval: float = JOB_POLL_INTERVAL,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+        retry_delay: float = JOB_RETRY_DELAY,
+    ):
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.busy = 0
+        self._tasks: List[asyncio.Task] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    async def start(self) -> None:
+        """Starts the workers"""
+        self._spawn()
+
+    async def start_if_pending(self) -> None:
+        """Starts the workers if jobs are still queued or running, e.g. from before a restart"""
+        if self.workers > 0 and await _call(has_unfinished_jobs):
+            self._spawn()
+
+    def _spawn(self) -> None:
+        if not self._tasks and self.workers > 0:
+            self._stopping = False
+            self._wake = asyncio.Event()
+            self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float) -> None:
+        """
+        Lets jobs in progress finish for up to `timeout` seconds, then stops
+        the workers; jobs still unanswered go back to the queue.
+        """
+        if not self._tasks:
+            return
+        self._stopping = True
+        self._wake.set()
+        _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self) -> None:
+        """
+        Wakes an idle worker in this process for a job just submitted,
+        starting the workers for the first one. Workers that were stopped
+        stay stopped.
+        """
+        if not self._tasks and not self._stopping:
+            self._spawn()
+        if self._wake is not None:
+            self._wake.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns worker counts"""
+        return {"job_workers": len(self._tasks), "job_workers_busy": self.busy}
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                job = await _call(claim_job, self.owner, self.lease_seconds, self.max_attempts)
+            except Exception as e:
+                logger.warning("Claiming a job failed: %s", e)
+                job = None
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            JOB_EVENTS.inc(event="claimed")
+            if job.attempts == 1:
+                JOB_QUEUE_SECONDS.observe((datetime.utcnow() - job.created_at).total_seconds())
+            self.busy += 1
+            try:
+                await self._process(job)
+            except Exception:
+                logger.exception("Job %s could not be processed", job.id)
+            finally:
+                self.busy -= 1
+
+    async def _answer(self, job) -> Dict[str, List[dict]]:
+        recommendations = await get_recommendations_cached(job.prompt_text, bypass_cache=job.bypass_cache)
+        usage = recommendations.pop(USAGE_KEY, None)
+        return build_recommendation_rows(job.user_id, job.prompt_text, recommendations, usage=usage)
+
+    async def _process(self, job) -> None:
+        work = asyncio.ensure_future(self._answer(job))
+        try:
+            # Keep the lease while Gemini works; give up if another worker took over
+            while not work.done():
+                await asyncio.wait({work}, timeout=self.lease_seconds / 3)
+                if not work.done() and not await _call(renew_job_lease, job.id, self.owner, self.lease_seconds):
+                    logger.warning("Lost the lease on job %s; abandoning it", job.id)
+                    JOB_EVENTS.inc(event="lease_lost")
+                    work.cancel()
+                    return
+            rows = work.result()
+            if await _call(complete_job, job.id, self.owner, rows):
+                JOB_EVENTS.inc(event="succeeded")
+            else:
+                logger.warning("Lost the lease on job %s before saving its answer", job.id)
+                JOB_EVENTS.inc(event="lease_lost")
+        except AdmissionRejectedError as e:
+            await _call(requeue_job, job.id, self.owner, e.retry_after, count_attempt=False)
+        except asyncio.CancelledError:
+            work.cancel()
+            # Stopped mid-job: hand it back rather than leave it until the lease runs out
+            await asyncio.shield(_call(requeue_job, job.id, self.owner, 0, count_attempt=False))
+            raise
+        except Exception as e:
+            if job.attempts < self.max_attempts:
+                delay = self.retry_delay * 2 ** (job.attempts - 1)
+                logger.warning("Job %s failed (attempt %d), retrying in %.0fs: %s", job.id, job.attempts, delay, e)
+                await _call(requeue_job, job.id, self.owner, delay, error=str(e))
+                JOB_EVENTS.inc(event="retried")
+            else:
+                logger.error("Job %s failed after %d attempts: %s", job.id, job.attempts, e)
+                await _call(fail_job, job.id, self.owner, str(e))
+                JOB_EVENTS.inc(event="failed")
+
+
+job_workers = JobWorkerPool()
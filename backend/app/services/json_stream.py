@@ -0,0 +1,101 @@
+import json
+from typing import Any, Iterable, List, Optional, Tuple
+
+Path = Tuple[Any, ...]
+
+
+class IncrementalJSONParser:
+    """
+    Incremental JSON scanner for model output that arrives in fragments.
+
+    Text is fed in arbitrary chunks; whenever an object, array or string whose
+    path matches one of `emit_paths` is complete, it is decoded and returned
+    from feed() as a (path, value) pair. Paths are tuples of object keys and
+    array indexes, and "*" in a pattern matches any array index, e.g.
+    ("categories", "*", "products", "*") for every product of every category.
+    """
+
+    def __init__(self, emit_paths: Iterable[Path]):
+        self.emit_paths = [tuple(p) for p in emit_paths]
+        self._text = ""
+        self._pos = 0
+        self._stack: List[dict] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string: Optional[str] = None
+
+    def _matches(self, path: Path) -> bool:
+        for pattern in self.emit_paths:
+            if len(pattern) == len(path) and all(
+                p == "*" and isinstance(k, int) or p == k for p, k in zip(pattern, path)
+            ):
+                return True
+        return False
+
+    def _child_path(self) -> Path:
+        if not self._stack:
+            return ()
+        frame = self._stack[-1]
+        if frame["kind"] == "[":
+            return frame["path"] + (frame["index"],)
+        return frame["path"] + (frame["key"],)
+
+    def feed(self, chunk: str) -> List[Tuple[Path, Any]]:
+        """Adds a chunk of text and returns the values completed by it"""
+        self._text += chunk
+        completed = []
+        text = self._text
+
+        for i in range(self._pos, len(text)):
+            c = text[i]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    raw = text[self._string_start:i + 1]
+                    frame = self._stack[-1] if self._stack else None
+                    if frame is not None and frame["kind"] == "{" and frame["expect_key"]:
+                        self._last_string = json.loads(raw)
+                    else:
+                        path = self._child_path()
+                        if self._matches(path):
+                            completed.append((path, json.loads(raw)))
+                continue
+
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in "{[":
+                self._stack.append({
+                    "kind": c,
+                    "start": i,
+                    "path": self._child_path(),
+                    "index": 0,
+                    "key": None,
+                    "expect_key": c == "{",
+                })
+            elif c in "}]":
+                frame = self._stack.pop()
+                if self._matches(frame["path"]):
+                    completed.append((frame["path"], json.loads(text[frame["start"]:i + 1])))
+            elif c == ":" and self._stack:
+                self._stack[-1]["key"] = self._last_string
+                self._stack[-1]["expect_key"] = False
+            elif c == "," and self._stack:
+                frame = self._stack[-1]
+                if frame["kind"] == "[":
+                    frame["index"] += 1
+                else:
+                    frame["expect_key"] = True
+
+        self._pos = len(text)
+        return completed
+
+    def result(self) -> Any:
+        """Decodes the complete document once all chunks have been fed"""
+        return json.loads(self._text)
@@ -0,0 +1,133 @@
+import os
+import asyncio
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from ..database import SessionLocal
+from ..metrics import MAINTENANCE_ROWS, MAINTENANCE_SECONDS
+from ..retention import (
+    archive_sets, claim_maintenance_run, compact, delete_finished_jobs, delete_sets, finish_maintenance_run,
+    prune_catalog,
+)
+
+MAINTENANCE_ENABLED = os.environ.get("MAINTENANCE_ENABLED", "false").lower() == "true"
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL", "3600"))
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", "90"))  # 0 keeps every tree
+DELETE_AFTER_DAYS = float(os.environ.get("DELETE_AFTER_DAYS", "0"))  # 0 keeps sets forever
+JOB_RETENTION_DAYS = float(os.environ.get("JOB_RETENTION_DAYS", "7"))
+MAINTENANCE_BATCH_SIZE = int(os.environ.get("MAINTENANCE_BATCH_SIZE", "200"))
+MAINTENANCE_VACUUM_PAGES = int(os.environ.get("MAINTENANCE_VACUUM_PAGES", "10000"))
+# Gives request writers a turn at the database between batches
+BATCH_PAUSE = 0.05
+RUN_NAME = "retention"
+
+# Set on shutdown so a pass in progress stops after its current batch
+_stopping = threading.Event()
+
+logger = logging.getLogger(__name__)
+
+
+def _batches(step: Callable[[], int]) -> int:
+    total = 0
+    while True:
+        done = step()
+        total += done
+        if done < MAINTENANCE_BATCH_SIZE or _stopping.is_set():
+            return total
+        time.sleep(BATCH_PAUSE)
+
+
+def run_once(force: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    One maintenance pass: delete, archive, drop old jobs, prune the catalog,
+    then compact. Skipped (returns None) when another process started one
+    within MAINTENANCE_INTERVAL, unless `force`. Blocking; returns what the
+    pass did, which is also stored in the maintenance_runs table.
+    """
+    now = datetime.utcnow()
+    with SessionLocal() as db:
+        if not claim_maintenance_run(db, RUN_NAME, 0 if force else MAINTENANCE_INTERVAL):
+            return None
+        summary: Dict[str, Any] = {}
+        steps = [
+            # Deleting first spares archiving sets that are about to go
+            ("delete", "deleted", DELETE_AFTER_DAYS,
+             lambda cutoff: _batches(lambda: delete_sets(db, cutoff, MAINTENANCE_BATCH_SIZE))),
+            ("archive", "archived", ARCHIVE_AFTER_DAYS,
+             lambda cutoff: _batches(lambda: archive_sets(db, cutoff, MAINTENANCE_BATCH_SIZE))),
+            ("jobs", "jobs_deleted", JOB_RETENTION_DAYS, lambda cutoff: delete_finished_jobs(db, cutoff)),
+        ]
+        for step, action, days, run in steps:
+            if days > 0:
+                with MAINTENANCE_SECONDS.time(step=step):
+                    summary[action] = run(now - timedelta(days=days))
+                MAINTENANCE_ROWS.inc(summary[action], action=action)
+        with MAINTENANCE_SECONDS.time(step="catalog"):
+            summary["catalog_pruned"] = _batches(lambda: prune_catalog(db, MAINTENANCE_BATCH_SIZE))
+        MAINTENANCE_ROWS.inc(summary["catalog_pruned"], action="catalog_pruned")
+        if not _stopping.is_set():
+            with MAINTENANCE_SECONDS.time(step="compact"):
+                summary["compact"] = compact(db, MAINTENANCE_VACUUM_PAGES)
+        summary["seconds"] = round((datetime.utcnow() - now).total_seconds(), 3)
+        finish_maintenance_run(db, RUN_NAME, json.dumps(summary))
+    logger.info("Maintenance finished", extra={"summary": summary})
+    return summary
+
+
+class MaintenanceScheduler:
+    """
+    Runs run_once() every `interval` seconds in the background. Every
+    worker process runs a scheduler; the claim in the maintenance_runs
+    table lets only one of them do each pass.
+    """
+
+    def __init__(self, interval: float = MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    async def start(self) -> None:
+        """Starts the scheduler"""
+        if self._task is None:
+            _stopping.clear()
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stops the scheduler once a pass in progress finishes its current batch"""
+        if self._task is None:
+            return
+        _stopping.set()
+        self._wake.set()
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        while not _stopping.is_set():
+            try:
+                await run_in_threadpool(run_once)
+            except Exception:
+                logger.exception("Maintenance pass failed")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+maintenance_scheduler = MaintenanceScheduler()
+
+
+if __name__ == "__main__":
+    # One pass now, whatever the schedule: python -m app.services.maintenance
+    from ..database import init_db
+    from ..logging_config import configure_logging
+
+    configure_logging()
+    init_db()
+    print(json.dumps(run_once(force=True), indent=2))
@@ -0,0 +1,160 @@
+import os
+import time
+import random
+import asyncio
+import httpx
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Optional
+
+# Connection pool settings for the shared upstream client
+UPSTREAM_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "60"))
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("GEMINI_MAX_CONNECTIONS", "20"))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("GEMINI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("GEMINI_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_HTTP2 = os.environ.get("GEMINI_HTTP2", "true").lower() == "true"
+
+# Retry and circuit breaker settings
+RETRY_BASE_DELAY = float(os.environ.get("GEMINI_RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.environ.get("GEMINI_RETRY_MAX_DELAY", "16.0"))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("GEMINI_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("GEMINI_BREAKER_RESET_TIMEOUT", "30"))
+
+# Status codes worth retrying; anything else in the 4xx range is a caller error
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+class UpstreamUnavailableError(Exception):
+    """Raised when the circuit breaker rejects a call without trying it"""
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+async def start_client() -> httpx.AsyncClient:
+    """Creates the shared keep-alive client"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=UPSTREAM_TIMEOUT,
+            http2=UPSTREAM_HTTP2 and _http2_available(),
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _client
+
+
+async def close_client() -> None:
+    """Closes the shared client"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def get_client() -> httpx.AsyncClient:
+    """Returns the shared client, creating it lazily outside the app lifespan"""
+    if _client is None:
+        return await start_client()
+    return _client
+
+
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    """Returns the Retry-After delay in seconds, if the response carries one"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+    Full-jitter exponential backoff. A server-provided Retry-After wins when it
+    is longer than the computed delay.
+    """
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, RETRY_MAX_DELAY * 4))
+    return delay
+
+
+async def sleep_before_retry(attempt: int, response: Optional[httpx.Response] = None) -> float:
+    """Waits without blocking the event loop and returns the delay used"""
+    retry_after = None
+    if response is not None and response.status_code in (429, 503):
+        retry_after = parse_retry_after(response)
+    delay = backoff_delay(attempt, retry_after)
+    await asyncio.sleep(delay)
+    return delay
+
+
+class CircuitBreaker:
+    """
+    Closed -> open after `failure_threshold` consecutive failures. While open,
+    calls fail fast until `reset_timeout` has passed; then a single trial call
+    is let through (half-open) and its outcome closes or re-opens the circuit.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+    def before_call(self) -> None:
+        """Raises UpstreamUnavailableError if the call should not be attempted"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise UpstreamUnavailableError("AI service is temporarily unavailable, please try again shortly.")
+            self.state = self.HALF_OPEN
+            self._trial_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                raise UpstreamUnavailableError("AI service is temporarily unavailable, please try again shortly.")
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def release_trial(self) -> None:
+        """
+        Frees the half-open trial slot of a call that ended without an
+        outcome (cancelled, or failed on something other than the upstream),
+        so the next call becomes the trial; call it when every call exits.
+        """
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
@@ -0,0 +1,162 @@
+import os
+import asyncio
+import copy
+import logging
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from ..crud import build_recommendation_rows, write_recommendation_sets
+from ..database import run_db, session_scope
+from ..metrics import WRITE_BEHIND_FAILURES, WRITE_BEHIND_QUEUED
+
+WRITE_BEHIND_ENABLED = os.environ.get("WRITE_BEHIND_ENABLED", "false").lower() == "true"
+WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get("WRITE_BEHIND_QUEUE_SIZE", "1000"))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "50"))
+WRITE_BEHIND_BATCH_WINDOW = float(os.environ.get("WRITE_BEHIND_BATCH_WINDOW", "0.05"))
+WRITE_BEHIND_ENQUEUE_TIMEOUT = float(os.environ.get("WRITE_BEHIND_ENQUEUE_TIMEOUT", "5"))
+# Failed attempts after which a batch is logged as an error; it is retried
+# until it is written, waiting at most WRITE_BEHIND_MAX_BACKOFF in between
+WRITE_BEHIND_MAX_ATTEMPTS = 3
+WRITE_BEHIND_MAX_BACKOFF = float(os.environ.get("WRITE_BEHIND_MAX_BACKOFF", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+class WriteQueueFullError(Exception):
+    """Raised when the writer cannot accept a set within the enqueue timeout"""
+
+
+class WriteBehindQueue:
+    """
+    Bounded queue of recommendation sets waiting to be persisted.
+
+    Callers get the set's id and timestamp immediately. A single background
+    task drains the queue, coalescing up to `batch_size` sets into one
+    transaction, and retries a failed batch until it is written. Sets stay
+    readable through get_pending() until committed.
+    """
+
+    def __init__(
+        self,
+        max_size: int = WRITE_BEHIND_QUEUE_SIZE,
+        batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+        batch_window: float = WRITE_BEHIND_BATCH_WINDOW,
+    ):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.written = 0
+        self.failed = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Starts the background writer"""
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Drains every queued set to the database, then stops the writer"""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def submit(
+        self,
+        user_id: str,
+        prompt_text: str,
+        recommendations: Dict[str, Any],
+        usage: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Queues a set for writing and returns the API response for it.
+
+        Waits for room when the queue is full (backpressure) and raises
+        WriteQueueFullError if none frees up within the enqueue timeout.
+        """
+        set_id = str(uuid.uuid4())
+        created_at = datetime.utcnow()
+        rows = build_recommendation_rows(
+            user_id, prompt_text, recommendations, set_id=set_id, created_at=created_at, usage=usage
+        )
+
+        response = dict(recommendations)
+        response["id"] = set_id
+        response["prompt_text"] = prompt_text
+        response["created_at"] = created_at.isoformat()
+
+        self._pending[set_id] = copy.deepcopy(response)
+        try:
+            await asyncio.wait_for(self._queue.put(rows), timeout=WRITE_BEHIND_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._pending.pop(set_id, None)
+            raise WriteQueueFullError("Too many pending writes, please try again shortly.")
+        WRITE_BEHIND_QUEUED.set(self._queue.qsize())
+        return response
+
+    def get_pending(self, set_id: str) -> Optional[Dict[str, Any]]:
+        """Returns a queued set that has not been committed yet"""
+        response = self._pending.get(set_id)
+        return copy.deepcopy(response) if response is not None else None
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns queue depth and write counters"""
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "pending": len(self._pending),
+            "written": self.written,
+            "failed": self.failed,
+        }
+
+    async def _next_batch(self) -> List[Dict[str, List[dict]]]:
+        batch = [await self._queue.get()]
+        # Give concurrent requests a moment to join this transaction
+        if self.batch_window > 0 and self._queue.empty():
+            await asyncio.sleep(self.batch_window)
+        while len(batch) < self.batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        WRITE_BEHIND_QUEUED.set(self._queue.qsize())
+        return batch
+
+    async def _write(self, batch: List[Dict[str, List[dict]]]) -> None:
+        # Callers already hold these ids, so the batch is never dropped
+        attempt = 0
+        while True:
+            try:
+                async with session_scope() as db:
+                    await run_db(db, write_recommendation_sets, batch)
+                self.written += len(batch)
+                return
+            except Exception as e:
+                attempt += 1
+                self.failed += 1
+                WRITE_BEHIND_FAILURES.inc()
+                if attempt < WRITE_BEHIND_MAX_ATTEMPTS:
+                    logger.warning("Write-behind batch of %d sets failed (attempt %d): %s", len(batch), attempt, e)
+                else:
+                    set_ids = [rows["recommendation_sets"][0]["id"] for rows in batch]
+                    logger.error("Write-behind batch of %d sets failed (attempt %d), retrying: %s; set ids: %s",
+                                 len(batch), attempt, e, ", ".join(set_ids))
+                await asyncio.sleep(min(0.5 * 2 ** min(attempt - 1, 10), WRITE_BEHIND_MAX_BACKOFF))
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._write(batch)
+            finally:
+                for rows in batch:
+                    self._pending.pop(rows["recommendation_sets"][0]["id"], None)
+                    self._queue.task_done()
+
+
+write_behind_queue = WriteBehindQueue()
@@ -0,0 +1,239 @@
+"""
+Reuse of past answers for near-duplicate prompts.
+
+PromptIndex keeps the prompts of recent recommendation sets as rows of an
+in-memory NumPy matrix: hashed word and character 3-5-gram counts, TF-IDF
+weighted and L2-normalized, so a single matrix-vector product gives the
+cosine similarity of a new prompt to every stored one. Sets are added as
+they are committed (crud) and picked up from the database every
+SIMILARITY_SYNC_INTERVAL seconds, so sets written by other worker processes
+are found too.
+
+A stored answer is reused when the similarity reaches SIMILARITY_THRESHOLD
+and both prompts mention the same numbers: "skis under $500" and "skis
+under $900" share almost every n-gram but not their answer. Only sets that
+came from the model are indexed, so reuse never chains away from the
+prompt an answer was generated for.
+"""
+import logging
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from .metrics import SIMILARITY_LOOKUPS, SIMILARITY_SCORES
+from .models import RecommendationSet
+
+try:
+    import numpy as np
+except ImportError:  # optional dependency
+    np = None
+
+logger = logging.getLogger(__name__)
+
+SIMILARITY_REUSE_ENABLED = os.environ.get("SIMILARITY_REUSE_ENABLED", "false").lower() == "true"
+SIMILARITY_THRESHOLD = float(os.environ.get("SIMILARITY_THRESHOLD", "0.95"))
+SIMILARITY_MAX_ENTRIES = int(os.environ.get("SIMILARITY_MAX_ENTRIES", "10000"))
+SIMILARITY_DIMENSIONS = int(os.environ.get("SIMILARITY_DIMENSIONS", "1024"))
+SIMILARITY_SYNC_INTERVAL = float(os.environ.get("SIMILARITY_SYNC_INTERVAL", "30"))
+if SIMILARITY_REUSE_ENABLED and np is None:
+    logger.warning("SIMILARITY_REUSE_ENABLED is set but numpy is not installed; similarity reuse is off")
+    SIMILARITY_REUSE_ENABLED = False
+
+# Write-behind stamps sets before they are committed, so syncs look back this far
+SYNC_LOOKBACK = timedelta(seconds=60)
+# IDF weights are recomputed once this share of the rows was added since the last time
+REWEIGHT_AFTER = 0.25
+# Best-scoring rows checked for matching numbers
+CANDIDATES = 5
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+_NGRAM_SIZES = (3, 4, 5)
+
+def prompt_key(prompt: str) -> str:
+    """Prompts that differ only in case, spacing or punctuation share a row"""
+    return " ".join(_WORD.findall(prompt.lower()))
+
+def prompt_features(prompt: str, dimensions: int) -> Dict[int, float]:
+    """Sublinear counts of the prompt's hashed words and character n-grams"""
+    counts: Dict[int, int] = {}
+    for word in _WORD.findall(prompt.lower()):
+        padded = f" {word} "
+        grams = [f"w:{word}"] + [padded[i:i + n] for n in _NGRAM_SIZES for i in range(len(padded) - n + 1)]
+        for gram in grams:
+            bucket = zlib.crc32(gram.encode("utf-8")) % dimensions
+            counts[bucket] = counts.get(bucket, 0) + 1
+    return {bucket: 1.0 + math.log(count) for bucket, count in counts.items()}
+
+def prompt_numbers(prompt: str) -> frozenset:
+    """Budgets, lengths and other numbers in the prompt ("1,500" and "1500.00" are equal)"""
+    return frozenset(float(n) for n in _NUMBER.findall(prompt.replace(",", "")))
+
+
+class PromptIndex:
+    """
+    Nearest-neighbour index over prompts, bounded at `max_entries` rows;
+    once full, the oldest row is replaced. Safe to use from several threads.
+    """
+
+    def __init__(self, dimensions: int = SIMILARITY_DIMENSIONS, max_entries: int = SIMILARITY_MAX_ENTRIES, threshold: float = SIMILARITY_THRESHOLD):
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._matrix = np.zeros((0, dimensions), dtype=np.float32)
+        self._df = np.zeros(dimensions, dtype=np.float64)
+        self._idf = np.ones(dimensions, dtype=np.float32)
+        # Per row: the set answering it, its prompt key, numbers and raw features
+        self._set_ids: List[str] = []
+        self._keys: List[str] = []
+        self._numbers: List[frozenset] = []
+        self._features: List[Tuple[Any, Any]] = []
+        self._rows: Dict[str, int] = {}
+        self._next = 0  # row replaced next once the index is full
+        self._weighted_rows = 0
+        self._added = 0
+        self.synced_at: Optional[datetime] = None
+        self._last_sync = 0.0
+
+    def __len__(self) -> int:
+        return len(self._set_ids)
+
+    def _arrays(self, prompt: str) -> Tuple[Any, Any]:
+        features = prompt_features(prompt, self.dimensions)
+        return (np.fromiter(features.keys(), dtype=np.intp, count=len(features)),
+                np.fromiter(features.values(), dtype=np.float32, count=len(features)))
+
+    def _vector(self, features: Tuple[Any, Any]) -> Any:
+        buckets, counts = features
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        vector[buckets] = counts * self._idf[buckets]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _add(self, set_id: str, prompt: str) -> None:
+        key = prompt_key(prompt)
+        row = self._rows.get(key)
+        if row is not None:
+            # The newest set answers for a repeated prompt
+            self._set_ids[row] = set_id
+            return
+        features = self._arrays(prompt)
+        if len(self._set_ids) < self.max_entries:
+            row = len(self._set_ids)
+            if row == len(self._matrix):
+                grown = np.zeros((min(max(2 * row, 64), self.max_entries), self.dimensions), dtype=np.float32)
+                grown[:row] = self._matrix
+                self._matrix = grown
+            self._set_ids.append(set_id)
+            self._keys.append(key)
+            self._numbers.append(prompt_numbers(prompt))
+            self._features.append(features)
+        else:
+            row = self._next
+            self._next = (row + 1) % self.max_entries
+            self._df[self._features[row][0]] -= 1
+            del self._rows[self._keys[row]]
+            self._set_ids[row] = set_id
+            self._keys[row] = key
+            self._numbers[row] = prompt_numbers(prompt)
+            self._features[row] = features
+        self._rows[key] = row
+        self._df[features[0]] += 1
+        self._matrix[row] = self._vector(features)
+        self._added += 1
+
+    def _reweight(self) -> None:
+        rows = len(self._set_ids)
+        self._idf = (np.log((1 + rows) / (1 + self._df)) + 1).astype(np.float32)
+        for row, features in enumerate(self._features):
+            self._matrix[row] = self._vector(features)
+        self._weighted_rows = rows
+        self._added = 0
+
+    def add(self, entries: Iterable[Tuple[str, str]]) -> None:
+        """Adds (set id, prompt) pairs"""
+        with self._lock:
+            for set_id, prompt in entries:
+                if prompt:
+                    self._add(set_id, prompt)
+            if self._added > self._weighted_rows * REWEIGHT_AFTER:
+                self._reweight()
+
+    def lookup(self, prompt: str) -> Tuple[Optional[str], float]:
+        """
+        Returns the set whose answer can be reused for `prompt` (None if
+        there is none) and the similarity of the best match found.
+        """
+        features = self._arrays(prompt)
+        numbers = prompt_numbers(prompt)
+        with self._lock:
+            rows = len(self._set_ids)
+            if not rows or not len(features[0]):
+                return None, 0.0
+            scores = self._matrix[:rows] @ self._vector(features)
+            k = min(CANDIDATES, rows)
+            top = np.argpartition(scores, rows - k)[rows - k:]
+            top = top[np.argsort(scores[top])[::-1]]
+            for row in top:
+                if scores[row] < self.threshold:
+                    break
+                if self._numbers[row] == numbers:
+                    return self._set_ids[row], min(1.0, float(scores[row]))
+            return None, min(1.0, float(scores[top[0]]))
+
+    def sync_due(self) -> bool:
+        return time.monotonic() - self._last_sync >= SIMILARITY_SYNC_INTERVAL
+
+    def sync(self, db: Session) -> int:
+        """
+        Adds model-answered sets written since the last sync, by this process
+        or another; the first sync loads the newest `max_entries` sets.
+        """
+        query = db.query(RecommendationSet.id, RecommendationSet.prompt_text, RecommendationSet.created_at)\
+            .filter(RecommendationSet.reused_from.is_(None))
+        if self.synced_at is None:
+            rows = query.order_by(RecommendationSet.created_at.desc()).limit(self.max_entries).all()[::-1]
+        else:
+            rows = query.filter(RecommendationSet.created_at > self.synced_at - SYNC_LOOKBACK)\
+                .order_by(RecommendationSet.created_at).all()
+        self.add((row.id, row.prompt_text) for row in rows)
+        if rows:
+            self.synced_at = max(self.synced_at or rows[-1].created_at, rows[-1].created_at)
+        self._last_sync = time.monotonic()
+        return len(rows)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the index size and threshold"""
+        return {
+            "similarity_entries": len(self),
+            "similarity_max_entries": self.max_entries,
+            "similarity_threshold": self.threshold,
+        }
+
+
+# Shared by every request handled by this process; None when reuse is off
+prompt_index = PromptIndex() if SIMILARITY_REUSE_ENABLED else None
+
+def index_sets(rows_list: List[Dict[str, List[dict]]]) -> None:
+    """Adds freshly committed sets (crud.build_recommendation_rows mappings) to the index"""
+    if prompt_index is None:
+        return
+    sets = (rows["recommendation_sets"][0] for rows in rows_list)
+    prompt_index.add((row["id"], row["prompt_text"]) for row in sets if row.get("reused_from") is None)
+
+def find_similar_set(db: Session, prompt: str) -> Tuple[Optional[str], float]:
+    """Looks a prompt up in the index, syncing it with the database first when due"""
+    if prompt_index.sync_due():
+        prompt_index.sync(db)
+    set_id, similarity = prompt_index.lookup(prompt)
+    SIMILARITY_SCORES.observe(similarity)
+    SIMILARITY_LOOKUPS.inc(result="hit" if set_id else "miss")
+    return set_id, similarity
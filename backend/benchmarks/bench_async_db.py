@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Concurrency benchmark for the persistence layer.
+
+Runs a set of "in-flight requests" that only await I/O (standing in for
+requests waiting on Gemini) while other tasks write recommendation sets.
+Reports how late the waiting requests finish in three modes:
+
+    blocking  - sync crud called directly on the event loop (the old handlers)
+    threaded  - async_crud with a plain Session (USE_ASYNC_DB=false)
+    async     - async_crud with an aiosqlite AsyncSession (USE_ASYNC_DB=true)
+
+Usage (from the backend directory):
+    python benchmarks/bench_async_db.py --writes 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from app.database import Base
+from app import models  # noqa: F401  (registers tables)
+from app.search import ensure_search_index
+from app import crud, async_crud
+from bench_create_recommendation_set import make_recommendations
+
+WAIT_SECONDS = 0.02  # simulated upstream wait per in-flight request
+
+
+async def in_flight_request(latencies):
+    """An unrelated request that just awaits I/O; records its extra latency"""
+    start = time.perf_counter()
+    await asyncio.sleep(WAIT_SECONDS)
+    latencies.append((time.perf_counter() - start - WAIT_SECONDS) * 1000)
+
+
+async def run_mode(mode, writes, writers, waiters):
+    recommendations = make_recommendations()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=engine)
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        with SessionLocal() as db:
+            ensure_search_index(db)
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+        with SessionLocal() as db:
+            crud.create_user(db, "bench-user")
+
+        async def writer(count):
+            for i in range(count):
+                if mode == "blocking":
+                    with SessionLocal() as db:
+                        crud.create_recommendation_set(db, "bench-user", f"prompt {i}", recommendations)
+                elif mode == "threaded":
+                    with SessionLocal() as db:
+                        await async_crud.create_recommendation_set(db, "bench-user", f"prompt {i}", recommendations)
+                else:
+                    async with AsyncSessionLocal() as db:
+                        await async_crud.create_recommendation_set(db, "bench-user", f"prompt {i}", recommendations)
+                await asyncio.sleep(0)
+
+        async def waiter_loop(latencies, stop):
+            while not stop.is_set():
+                await asyncio.gather(*(in_flight_request(latencies) for _ in range(waiters)))
+
+        latencies = []
+        stop = asyncio.Event()
+        waiting = asyncio.create_task(waiter_loop(latencies, stop))
+        start = time.perf_counter()
+        await asyncio.gather(*(writer(writes // writers) for _ in range(writers)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await waiting
+
+        await async_engine.dispose()
+        engine.dispose()
+
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0.0
+    print(
+        f"{mode:<9} writes: {elapsed:6.2f}s   added latency of in-flight requests: "
+        f"median {statistics.median(latencies):6.2f} ms  p99 {p99:7.2f} ms  max {latencies[-1]:7.2f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=200)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--waiters", type=int, default=50)
+    args = parser.parse_args()
+
+    for mode in ("blocking", "threaded", "async"):
+        asyncio.run(run_mode(mode, args.writes, args.writers, args.waiters))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Storage report for the canonical product catalog.
+
+Generates a synthetic history in which sets keep recommending products from
+a limited pool (as real Gemini answers do), writes it with the legacy
+per-set product copies, migrates that file with
+catalog.migrate_legacy_products, and compares the VACUUMed file sizes. Every
+set is read back after the migration and must serialize byte-for-byte like
+the original answer.
+
+Usage (from the backend directory):
+    python benchmarks/bench_catalog_storage.py --sets 2000 --pool 150
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app import models  # noqa: F401  (registers tables)
+from app.models import RecommendationSet, Category, Product, ProductDetail, StoreLink
+from app.catalog import migrate_legacy_products
+from app.crud import create_user, get_recommendation_set, recommendation_set_to_response
+from app.schemas import ApiResponse
+
+PROS = ["Stable at speed", "Easy to turn", "Great value", "Lightweight", "Playful in bumps",
+        "Grippy on ice", "Forgiving flex", "Floats in powder", "Durable topsheet", "Warm and dry"]
+CONS = ["Heavy", "Soft in powder", "Pricey", "Chatters at speed", "Runs small", "Limited sizes"]
+STORES = ["https://www.rei.com/product/{}", "https://www.evo.com/product/{}", "https://www.backcountry.com/p/{}"]
+
+
+def make_pool(size: int, rng: random.Random) -> list:
+    """Products Gemini keeps coming back to"""
+    pool = []
+    for i in range(size):
+        pool.append({
+            "name": f"Experience {80 + i % 30} Model {i}",
+            "brand": f"Brand {i % 25}",
+            "description": f"{80 + i % 30}mm waist, {150 + i % 40}cm length, intermediate flex, rockered tip and tail.",
+            "priceRange": f"${300 + 50 * (i % 10)}-{350 + 50 * (i % 10)}",
+            "pros": rng.sample(PROS, 3),
+            "cons": rng.sample(CONS, 2),
+            "highlight": rng.choice(["Best Value", "Best Overall", "Best for Beginners", "Editor's Pick"]),
+            "storeLink": [store.format(i) for store in rng.sample(STORES, 2)],
+        })
+    return pool
+
+
+def make_answer(pool: list, categories: int, products: int, variation: float, rng: random.Random) -> dict:
+    """One set; a fraction of products is worded differently from the pool copy"""
+    answer = {"categories": []}
+    for c in range(categories):
+        items = []
+        for product in rng.sample(pool, products):
+            product = json.loads(json.dumps(product))
+            if rng.random() < variation:
+                product["description"] += " Updated for this season."
+                product["name"] = product["name"].upper()
+            items.append(product)
+        answer["categories"].append({"categoryTitle": f"Category {c}", "products": items})
+    return answer
+
+
+def write_legacy(db, user_id: str, answers: list) -> list:
+    """Bulk-writes answers in the legacy layout; returns the set ids"""
+    start = datetime(2025, 1, 1)
+    rows = {"sets": [], "categories": [], "products": [], "links": [], "details": []}
+    set_ids = []
+    for i, answer in enumerate(answers):
+        set_id = str(uuid.uuid4())
+        set_ids.append(set_id)
+        rows["sets"].append({"id": set_id, "user_id": user_id, "prompt_text": f"prompt {i}",
+                             "created_at": start + timedelta(minutes=i)})
+        for category in answer["categories"]:
+            category_id = str(uuid.uuid4())
+            rows["categories"].append({"id": category_id, "recommendation_set_id": set_id,
+                                       "title": category["categoryTitle"]})
+            for product in category["products"]:
+                product_id = str(uuid.uuid4())
+                rows["products"].append({
+                    "id": product_id, "category_id": category_id, "name": product["name"],
+                    "brand": product["brand"], "description": product["description"],
+                    "price_range": product["priceRange"], "highlight": product["highlight"],
+                })
+                rows["links"].extend({"id": str(uuid.uuid4()), "product_id": product_id, "url": url,
+                                      "store_name": "Unknown"} for url in product["storeLink"])
+                rows["details"].extend({"id": str(uuid.uuid4()), "product_id": product_id, "type": "pro",
+                                        "text": text} for text in product["pros"])
+                rows["details"].extend({"id": str(uuid.uuid4()), "product_id": product_id, "type": "con",
+                                        "text": text} for text in product["cons"])
+    for key, model in (("sets", RecommendationSet), ("categories", Category), ("products", Product),
+                       ("links", StoreLink), ("details", ProductDetail)):
+        db.execute(insert(model), rows[key])
+    db.commit()
+    return set_ids
+
+
+def vacuum_and_measure(path: str) -> tuple:
+    """File size after VACUUM, and bytes per table/index when dbstat is available"""
+    conn = sqlite3.connect(path)
+    conn.execute("VACUUM")
+    try:
+        tables = dict(conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY 2 DESC"))
+    except sqlite3.OperationalError:
+        tables = {}
+    conn.close()
+    return os.path.getsize(path), tables
+
+
+def print_tables(tables: dict) -> None:
+    for name, size in tables.items():
+        if size > 8192:
+            print(f"    {name:<42} {size / 1024:>10.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sets", type=int, default=2000)
+    parser.add_argument("--pool", type=int, default=150, help="distinct products across all sets")
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--products", type=int, default=3)
+    parser.add_argument("--variation", type=float, default=0.1, help="fraction of products worded differently")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pool = make_pool(args.pool, rng)
+    answers = [make_answer(pool, args.categories, args.products, args.variation, rng) for _ in range(args.sets)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.db")
+        engine = create_engine(f"sqlite:///{legacy_path}")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+        create_user(db, "bench-user")
+        set_ids = write_legacy(db, "bench-user", answers)
+        db.close()
+        engine.dispose()
+        before, before_tables = vacuum_and_measure(legacy_path)
+
+        catalog_path = os.path.join(tmp, "catalog.db")
+        shutil.copy(legacy_path, catalog_path)
+        engine = create_engine(f"sqlite:///{catalog_path}")
+        db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+        migrated = migrate_legacy_products(db)
+        after, after_tables = vacuum_and_measure(catalog_path)
+
+        mismatches = 0
+        for set_id, answer in zip(set_ids, answers):
+            response = recommendation_set_to_response(get_recommendation_set(db, set_id))
+            expected = dict(answer, id=response["id"], prompt_text=response["prompt_text"],
+                            created_at=response["created_at"])
+            if ApiResponse(**response).model_dump_json() != ApiResponse(**expected).model_dump_json():
+                mismatches += 1
+            db.expunge_all()
+        catalog_products = db.query(models.CatalogProduct).count()
+        db.close()
+        engine.dispose()
+
+    print(f"{args.sets} sets, {args.sets * args.categories * args.products} product mentions, "
+          f"{args.pool} distinct products, {args.variation:.0%} reworded")
+    print(f"legacy   {before / 1024 / 1024:8.2f} MiB")
+    print_tables(before_tables)
+    print(f"catalog  {after / 1024 / 1024:8.2f} MiB  ({migrated} products migrated into {catalog_products} catalog entries)")
+    print_tables(after_tables)
+    print(f"storage reduction: {(1 - after / before) * 100:.1f}%  ({before / after:.1f}x smaller)")
+    print(f"read-back check: {'ok' if not mismatches else f'{mismatches} sets differ'}")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
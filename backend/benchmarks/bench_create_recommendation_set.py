@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the recommendation set write path.
+
+Compares the original per-row commit implementation against the bulk,
+single-transaction crud.create_recommendation_set on a file-backed SQLite
+database (so commit fsyncs are included in the timings).
+
+Usage (from the backend directory):
+    python benchmarks/bench_create_recommendation_set.py --sets 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app import models  # noqa: F401  (registers tables)
+from app.search import ensure_search_index
+from app.models import RecommendationSet, Category, Product, ProductDetail, StoreLink
+from app.crud import create_user, create_recommendation_set
+
+
+def make_recommendations(categories: int = 4, products: int = 3) -> dict:
+    """Builds a typical Gemini answer: C categories x P products"""
+    return {
+        "categories": [
+            {
+                "categoryTitle": f"Category {c}",
+                "products": [
+                    {
+                        "name": f"Product {c}-{p}",
+                        "brand": "Brand",
+                        "description": "88mm waist, 170cm length, intermediate flex",
+                        "priceRange": "$400-500",
+                        "pros": ["Stable at speed", "Easy to turn", "Great value"],
+                        "cons": ["Heavy", "Soft in powder"],
+                        "highlight": "Best Value",
+                        "storeLink": ["https://www.rei.com/product/1", "https://www.evo.com/product/2"],
+                    }
+                    for p in range(products)
+                ],
+            }
+            for c in range(categories)
+        ]
+    }
+
+
+def legacy_create_recommendation_set(db, user_id, prompt_text, recommendations_data):
+    """The original implementation: commit + refresh per set, category and product"""
+    recommendation_set = RecommendationSet(user_id=user_id, prompt_text=prompt_text)
+    db.add(recommendation_set)
+    db.commit()
+    db.refresh(recommendation_set)
+    for category_data in recommendations_data.get("categories", []):
+        category = Category(recommendation_set_id=recommendation_set.id, title=category_data["categoryTitle"])
+        db.add(category)
+        db.commit()
+        db.refresh(category)
+        for product_data in category_data.get("products", []):
+            product = Product(
+                category_id=category.id,
+                name=product_data["name"],
+                brand=product_data["brand"],
+                description=product_data["description"],
+                price_range=product_data.get("priceRange", ""),
+                highlight=product_data["highlight"],
+            )
+            db.add(product)
+            db.commit()
+            db.refresh(product)
+            for store_link in product_data.get("storeLink", []):
+                store_name = "Unknown"
+                if "rei.com" in store_link:
+                    store_name = "REI"
+                elif "evo.com" in store_link:
+                    store_name = "Evo"
+                elif "backcountry.com" in store_link:
+                    store_name = "Backcountry"
+                db.add(StoreLink(product_id=product.id, url=store_link, store_name=store_name))
+            for pro in product_data.get("pros", []):
+                db.add(ProductDetail(product_id=product.id, type="pro", text=pro))
+            for con in product_data.get("cons", []):
+                db.add(ProductDetail(product_id=product.id, type="con", text=con))
+    db.commit()
+    return recommendation_set
+
+
+def run(label, write_fn, sets, recommendations):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+        ensure_search_index(db)
+        create_user(db, "bench-user")
+        start = time.perf_counter()
+        for i in range(sets):
+            write_fn(db, "bench-user", f"prompt {i}", recommendations)
+        elapsed = time.perf_counter() - start
+        db.close()
+        engine.dispose()
+    per_set_ms = elapsed / sets * 1000
+    print(f"{label:<8} {sets} sets in {elapsed:.3f}s  ->  {per_set_ms:.2f} ms/set")
+    return per_set_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sets", type=int, default=200)
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--products", type=int, default=3)
+    args = parser.parse_args()
+
+    recommendations = make_recommendations(args.categories, args.products)
+    before = run("before", legacy_create_recommendation_set, args.sets, recommendations)
+    after = run("after", create_recommendation_set, args.sets, recommendations)
+    print(f"speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
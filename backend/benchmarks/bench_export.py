@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Memory and throughput of the history export (app/export.py).
+
+For each history size, writes that many sets (a quarter of them archived)
+and exports them all to a null sink, reporting sets/s and the peak Python
+memory allocated during the export (tracemalloc). The same histories are
+then loaded the old way, through the ORM with their whole trees, for
+comparison. Export memory should stay flat as the history grows.
+
+Before measuring, the exported records are checked against the per-set
+GET responses, the Parquet output (when pyarrow is installed) is read
+back, and GET /api/export is checked to require its token and to honour
+its userId filter and X-Export-Watermark. Exits with code 1 if a check fails.
+
+Usage (from the backend directory):
+    python benchmarks/bench_export.py --sizes 1000,4000,16000
+"""
+import argparse
+import asyncio
+import io
+import json
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import httpx
+
+from check_harness import check_environment, expect, finish
+
+check_environment("export", EXPORT_SETTLE_SECONDS="0", EXPORT_TOKEN="export-token")
+
+from sqlalchemy.orm import selectinload
+
+from app.crud import build_recommendation_rows, recommendation_set_to_response, write_recommendation_sets
+from app.database import SessionLocal, engine, init_db
+from app.export import encode_export, iter_export_chunks, pa
+from app import main as app_main
+from app.main import app
+from app.models import Category, CategoryProduct, CatalogProduct, RecommendationSet
+from app.retention import archive_sets
+
+BASE = datetime(2025, 1, 1)
+
+
+def answer(i: int) -> dict:
+    """Four categories of three products drawn from a pool of 300"""
+    return {"categories": [{
+        "categoryTitle": f"Category {c}",
+        "products": [{
+            "name": f"Product {(i * 7 + c * 3 + p) % 300}",
+            "brand": f"Brand {(i + p) % 20}",
+            "description": "88mm waist, 170cm length, intermediate flex, rockered tip and tail",
+            "priceRange": "$400-500",
+            "pros": ["Stable at speed", "Easy to turn", f"Great value {p}"],
+            "cons": ["Heavy", "Soft in powder"],
+            "highlight": "Best Value",
+            "storeLink": [f"https://www.rei.com/product/{(i * 7 + c * 3 + p) % 300}"],
+        } for p in range(3)],
+    } for c in range(4)]}
+
+
+def grow_history(total: int, written: int) -> None:
+    """Writes sets until there are `total`, a second apart; archives the oldest quarter"""
+    with SessionLocal() as db:
+        for first in range(written, total, 200):
+            rows = [
+                build_recommendation_rows(f"user-{i % 50}", f"prompt {i}", answer(i), created_at=BASE + timedelta(seconds=i))
+                for i in range(first, min(first + 200, total))
+            ]
+            write_recommendation_sets(db, rows)
+        while archive_sets(db, BASE + timedelta(seconds=total // 4), 200):
+            pass
+
+
+def export_all(export_format: str) -> int:
+    exported = 0
+    with SessionLocal() as db:
+        for piece in encode_export(iter_export_chunks(db, until=datetime.utcnow()), export_format):
+            exported += len(piece)
+    return exported
+
+
+def orm_load_all() -> int:
+    items = selectinload(RecommendationSet.categories).selectinload(Category.items)
+    catalog = items.selectinload(CategoryProduct.catalog_product)
+    with SessionLocal() as db:
+        sets = db.query(RecommendationSet).options(
+            catalog.selectinload(CatalogProduct.details), catalog.selectinload(CatalogProduct.store_links),
+            selectinload(RecommendationSet.response_body),
+        ).all()
+        return len(json.dumps([recommendation_set_to_response(s) for s in sets]))
+
+
+def measure(fn, *args) -> tuple:
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 2**20
+
+
+def check_records() -> None:
+    with SessionLocal() as db:
+        records = [record for chunk in iter_export_chunks(db, chunk_size=37, until=datetime.utcnow()) for record in chunk]
+        mismatched = 0
+        for record in records[::50]:
+            stored = db.get(RecommendationSet, record["id"])
+            mismatched += recommendation_set_to_response(stored)["categories"] != record["categories"]
+            db.expunge_all()
+    archived = sum(record["archived"] for record in records)
+    expect(len(records) == 1000 and archived == 250 and mismatched == 0,
+           f"records match the per-set responses, archived sets included ({len(records)} sets, {archived} archived)")
+    expect([r["created_at"] for r in records] == sorted(r["created_at"] for r in records), "records come oldest first")
+    if pa is not None:
+        import pyarrow.parquet as pq
+        with SessionLocal() as db:
+            data = b"".join(encode_export(iter_export_chunks(db, chunk_size=100, until=datetime.utcnow()), "parquet"))
+        table = pq.read_table(io.BytesIO(data))
+        parquet_file = pq.ParquetFile(io.BytesIO(data))
+        expect(table.num_rows == 1000 and parquet_file.num_row_groups == 10
+               and table.slice(0, 1).to_pylist()[0]["categories"] == records[0]["categories"],
+               f"Parquet reads back with one row group per chunk ({len(data) / 1024:.0f} KiB)")
+    else:
+        print("     (pyarrow not installed; Parquet not checked)")
+
+
+async def check_endpoint() -> None:
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://app") as client:
+        missing = await client.get("/api/export")
+        wrong = await client.get("/api/export", headers={"Authorization": "Bearer not-the-token"})
+        expect(missing.status_code == 401 and wrong.status_code == 401 and "WWW-Authenticate" in wrong.headers,
+               "an export without the token is refused")
+        app_main.EXPORT_TOKEN = ""
+        disabled = await client.get("/api/export", headers={"Authorization": "Bearer "})
+        app_main.EXPORT_TOKEN = "export-token"
+        expect(disabled.status_code == 404, "without EXPORT_TOKEN the endpoint does not exist")
+
+        client.headers["Authorization"] = "Bearer export-token"
+        first = await client.get("/api/export", params={"userId": "user-7"})
+        lines = [json.loads(line) for line in first.text.splitlines()]
+        expect(first.headers["content-type"].startswith("application/x-ndjson")
+               and len(lines) == 20 and {line["user_id"] for line in lines} == {"user-7"},
+               "GET /api/export streams one user's sets as NDJSON")
+
+        with SessionLocal() as db:
+            write_recommendation_sets(db, [build_recommendation_rows("user-7", "newer prompt", answer(0))])
+        await asyncio.sleep(0.01)
+        watermark = first.headers["X-Export-Watermark"]
+        again = await client.get("/api/export", params={"userId": "user-7", "since": watermark})
+        expect([json.loads(line)["prompt_text"] for line in again.text.splitlines()] == ["newer prompt"],
+               "the watermark of one export makes the next return only newer sets")
+        bad = await client.get("/api/export", params={"format": "csv"})
+        expect(bad.status_code == 422, "an unknown format is rejected")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,4000,16000")
+    parser.add_argument("--format", choices=("ndjson", "parquet"), default="ndjson")
+    args = parser.parse_args()
+    # The checks run on the first 1000 sets
+    sizes = sorted({1000} | {int(size) for size in args.sizes.split(",")})
+
+    init_db()
+    written = 0
+    print(f"{'sets':>7}  {'export s':>8}  {'sets/s':>8}  {'export peak MiB':>15}  {'ORM load peak MiB':>17}")
+    for size in sizes:
+        grow_history(size, written)
+        written = size
+        if size == 1000:
+            check_records()
+            asyncio.run(check_endpoint())
+        elapsed, export_peak = measure(export_all, args.format)
+        _, orm_peak = measure(orm_load_all)
+        print(f"{size:>7}  {elapsed:>8.2f}  {size / elapsed:>8.0f}  {export_peak:>15.1f}  {orm_peak:>17.1f}")
+    engine.dispose()
+    finish()
+
+
+if __name__ == "__main__":
+    main()
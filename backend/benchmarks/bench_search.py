@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Latency benchmark for GET /api/search (search.search_recommendation_sets).
+
+Writes a synthetic history through crud.write_recommendation_sets, so the
+FTS5 index is filled by the normal write path, then times a mix of global
+and user-scoped queries and the pages of a broad query followed by cursor.
+
+Usage (from the backend directory):
+    python benchmarks/bench_search.py --sets 20000 --users 500
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app import models  # noqa: F401  (registers tables)
+from app.crud import build_recommendation_rows, write_recommendation_sets
+from app.search import ensure_search_index, search_recommendation_sets
+from bench_catalog_storage import make_answer, make_pool
+
+QUERIES = [
+    "skis under 700",
+    "\"Model 42\"",
+    "brand 7 best value",
+    "beginner forgiving",
+    "experience 95",
+]
+PROMPTS = ["powder skis for a {} skier", "all-mountain skis under ${}", "beginner snowboard, budget {}",
+           "touring setup for {} days a season", "park skis that are forgiving, {}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sets", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--pool", type=int, default=400)
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--products", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=50, help="timed runs per query")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    pool = make_pool(args.pool, rng)
+    start = datetime(2025, 1, 1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+        ensure_search_index(db)
+
+        write_start = time.perf_counter()
+        batch = []
+        for i in range(args.sets):
+            prompt = rng.choice(PROMPTS).format(rng.choice(["expert", "intermediate", 500, 700, 900, 30]))
+            answer = make_answer(pool, args.categories, args.products, 0.1, rng)
+            batch.append(build_recommendation_rows(
+                f"user-{i % args.users}", prompt, answer, created_at=start + timedelta(minutes=i)
+            ))
+            if len(batch) == 500 or i == args.sets - 1:
+                write_recommendation_sets(db, batch)
+                db.expunge_all()
+                batch = []
+        print(f"wrote {args.sets} sets ({args.sets * args.categories * args.products} product rows) "
+              f"in {time.perf_counter() - write_start:.1f}s")
+
+        for query in QUERIES:
+            for user_id in (None, "user-7"):
+                timings = []
+                for _ in range(args.repeat):
+                    t = time.perf_counter()
+                    results, next_cursor = search_recommendation_sets(db, query, user_id=user_id, limit=20)
+                    timings.append((time.perf_counter() - t) * 1000)
+                timings.sort()
+                scope = "user" if user_id else "all"
+                print(f"{query!r:<26} {scope:<4} {len(results):>3} results{'+' if next_cursor else ' '}  "
+                      f"median {statistics.median(timings):7.2f} ms  p95 {timings[int(len(timings) * 0.95) - 1]:7.2f} ms")
+
+        # Keyset cursors: a deep page should cost about what the first one does
+        cursor, page = None, 0
+        while page < 25:
+            t = time.perf_counter()
+            results, cursor = search_recommendation_sets(db, "skis", limit=20, cursor=cursor)
+            page += 1
+            if page in (1, 5, 25) or cursor is None:
+                print(f"'skis' page {page:>2}  {len(results):>3} results  {(time.perf_counter() - t) * 1000:7.2f} ms")
+            if cursor is None:
+                break
+
+        db.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Read-path benchmark for GET /api/recommendations/{setId}.
+
+Compares, per request:
+    rebuild  - load the ORM tree, convert, validate and serialize (the old path)
+    stored   - fetch the body stored at write time and send it as-is
+    etag     - answer If-None-Match with 304 from the stored ETag alone
+
+Usage (from the backend directory):
+    python benchmarks/bench_set_fetch.py --sets 200 --reads 2000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app import models  # noqa: F401  (registers tables)
+from app.search import ensure_search_index
+from app.crud import (
+    create_user, create_recommendation_set, get_recommendation_set, recommendation_set_to_response,
+    get_recommendation_body, get_recommendation_etag,
+)
+from app.response_bodies import negotiate_body
+from app.schemas import ApiResponse
+from bench_create_recommendation_set import make_recommendations
+
+
+def rebuild(db, set_id):
+    return ApiResponse.model_validate(recommendation_set_to_response(get_recommendation_set(db, set_id))).model_dump_json()
+
+
+def stored(db, set_id):
+    row = get_recommendation_body(db, set_id)
+    return negotiate_body(row.body, row.encoding, "gzip, deflate, br")
+
+
+def etag(db, set_id):
+    return get_recommendation_etag(db, set_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sets", type=int, default=200)
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--products", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+        ensure_search_index(db)
+        create_user(db, "bench-user")
+        recommendations = make_recommendations(args.categories, args.products)
+        set_ids = [create_recommendation_set(db, "bench-user", f"prompt {i}", recommendations).id for i in range(args.sets)]
+
+        results = {}
+        for label, fn in (("rebuild", rebuild), ("stored", stored), ("etag", etag)):
+            order = [random.choice(set_ids) for _ in range(args.reads)]
+            start = time.perf_counter()
+            for set_id in order:
+                fn(db, set_id)
+                db.expunge_all()
+            results[label] = (time.perf_counter() - start) / args.reads * 1000
+            print(f"{label:<8} {results[label]:7.3f} ms/read")
+        print(f"stored body: {results['rebuild'] / results['stored']:.1f}x faster, "
+              f"304: {results['rebuild'] / results['etag']:.1f}x faster than rebuilding")
+        db.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
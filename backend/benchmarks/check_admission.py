@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Check for per-user rate limiting and the upstream priority queue.
+
+Runs services/admission against scripted callers (token buckets, also
+shared through the database by two limiters as two workers would; priority
+order, queue bound, queue timeout, cancellation), then drives the app
+in-process against benchmarks/fake_gemini.py with a small upstream cap and
+checks that a hammering user gets 429 with Retry-After, that a burst over
+the queue is shed at once, and that queue depth and wait time reach /metrics.
+Exits with code 1 if any expectation fails.
+
+Usage (from the backend directory):
+    python benchmarks/check_admission.py
+"""
+import asyncio
+import time
+
+import httpx
+
+from check_harness import check_environment, expect, fake_gemini, finish, free_port
+
+PORT = free_port()
+check_environment(
+    "admission", PORT,
+    GEMINI_MAX_CONCURRENT_CALLS="2",
+    GEMINI_QUEUE_SIZE="2",
+    RATE_LIMIT_PER_MINUTE="6",
+    RATE_LIMIT_BURST="3",
+    RECOMMENDATION_CACHE_ENABLED="false",
+)
+
+from app.database import init_db
+from app.main import app
+from app.metrics import ADMISSION_REJECTIONS
+from app.services.admission import BATCH, INTERACTIVE, AdmissionRejectedError, RateLimiter, UpstreamLimiter
+from app.services.upstream import close_client, start_client
+
+
+
+async def hold(limiter: UpstreamLimiter, priority: int, order: list, name: str, seconds: float = 0.05):
+    async with limiter.slot(priority):
+        order.append(name)
+        await asyncio.sleep(seconds)
+
+
+async def check_limiter() -> None:
+    limiter = RateLimiter(per_minute=60, burst=3, shared=False)
+    for _ in range(3):
+        await limiter.acquire("user")
+    try:
+        await limiter.acquire("user")
+        expect(False, "the bucket runs dry after the burst")
+    except AdmissionRejectedError as e:
+        expect(0.9 < e.retry_after <= 1.0, f"the bucket runs dry after the burst (retry after {e.retry_after:.2f}s)")
+    await limiter.acquire("other-user")
+    await asyncio.sleep(1.05)
+    await limiter.acquire("user")
+    expect(True, "users have separate buckets that refill over time")
+
+    # Two workers' limiters over the same table
+    init_db()
+    workers = [RateLimiter(per_minute=60, burst=3, shared=True) for _ in range(2)]
+    for i in range(3):
+        await workers[i % 2].acquire("shared-user")
+    try:
+        await workers[1].acquire("shared-user")
+        expect(False, "a shared bucket holds across workers")
+    except AdmissionRejectedError as e:
+        await asyncio.sleep(1.05)
+        await workers[0].acquire("shared-user")
+        expect(0.9 < e.retry_after <= 1.0, f"a shared bucket holds across workers and refills (retry after {e.retry_after:.2f}s)")
+
+    upstream = UpstreamLimiter(max_concurrent=1, max_queue=2, queue_timeout=5)
+    order = []
+    first = asyncio.ensure_future(hold(upstream, INTERACTIVE, order, "running", 0.2))
+    await asyncio.sleep(0.01)
+    waiters = [asyncio.ensure_future(hold(upstream, BATCH, order, f"batch-{i}")) for i in range(2)]
+    await asyncio.sleep(0.01)
+    waiters.append(asyncio.ensure_future(hold(upstream, INTERACTIVE, order, "interactive")))
+    await asyncio.sleep(0.01)
+    expect(upstream.stats()["upstream_queued"] == 3, "batch waiters do not count against the interactive queue bound")
+    try:
+        upstream.check(BATCH)
+        expect(False, "a full queue sheds new batch calls")
+    except AdmissionRejectedError:
+        expect(True, "a full queue sheds new batch calls")
+    await asyncio.gather(first, *waiters)
+    expect(order == ["running", "interactive", "batch-0", "batch-1"], f"interactive calls go first: {order}")
+
+    upstream = UpstreamLimiter(max_concurrent=1, max_queue=5, queue_timeout=0.1)
+    blocker = asyncio.ensure_future(hold(upstream, INTERACTIVE, [], "running", 0.5))
+    await asyncio.sleep(0.01)
+    try:
+        await hold(upstream, INTERACTIVE, [], "late")
+        expect(False, "a call that waits too long is shed")
+    except AdmissionRejectedError as e:
+        expect(e.retry_after >= 1, "a call that waits too long is shed with a Retry-After")
+    cancelled = asyncio.ensure_future(hold(upstream, INTERACTIVE, [], "cancelled"))
+    await asyncio.sleep(0.01)
+    cancelled.cancel()
+    await asyncio.gather(blocker, cancelled, return_exceptions=True)
+    expect(upstream.in_use == 0 and upstream.stats()["upstream_queued"] == 0,
+           "timed-out and cancelled waiters give everything back")
+
+
+async def check_app() -> None:
+    init_db()
+    await start_client()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://app", timeout=60) as client:
+            statuses = []
+            for i in range(4):
+                response = await client.post("/api/recommendations", json={"prompt": f"hammer {i}", "userId": "hammer"})
+                statuses.append(response.status_code)
+            expect(statuses == [200, 200, 200, 429] and 1 <= int(response.headers.get("Retry-After", 0)) <= 10,
+                   f"a hammering user is rate limited: {statuses}, Retry-After {response.headers.get('Retry-After')}")
+
+            async def recommend(i):
+                start = time.perf_counter()
+                response = await client.post("/api/recommendations", json={"prompt": f"burst {i}", "userId": f"user-{i}"})
+                return response.status_code, time.perf_counter() - start
+            shed_before = ADMISSION_REJECTIONS.value(reason="queue_full")
+            results = await asyncio.gather(*(recommend(i) for i in range(8)))
+            ok = [elapsed for status, elapsed in results if status == 200]
+            shed = [elapsed for status, elapsed in results if status == 429]
+            expect(len(ok) == 4 and len(shed) == 4, f"2 running + 2 queued are served, the rest shed ({len(ok)} ok, {len(shed)} 429)")
+            expect(max(shed) < 0.5, f"shed requests are answered at once ({max(shed):.3f}s)")
+
+            metrics = (await client.get("/metrics")).text
+            expect('slopeselector_upstream_queue_wait_seconds_count{priority="interactive"}' in metrics
+                   and 'slopeselector_upstream_queue_depth{priority="interactive"} 0' in metrics
+                   and ADMISSION_REJECTIONS.value(reason="queue_full") == shed_before + 4,
+                   "queue depth, wait time and rejections are exported")
+    finally:
+        await close_client()
+
+
+def main():
+    asyncio.run(check_limiter())
+    with fake_gemini(PORT, "--latency", "0.5", "--latency-jitter", "0"):
+        asyncio.run(check_app())
+    finish()
+
+
+if __name__ == "__main__":
+    main()
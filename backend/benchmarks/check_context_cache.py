@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Check for system-prompt context caching and token accounting.
+
+Starts benchmarks/fake_gemini.py, points the Gemini service at it and walks
+through the cache lifecycle: creation, reuse, refresh before expiry,
+recreation after a system prompt change, inline fallback when the entry
+disappears upstream, back-off when it cannot be created, and prompts below
+the minimum cacheable size being sent inline. Also checks
+that token usage reaches the metrics and the recommendation_sets row, and
+that init_db adds the usage columns to an existing database.
+Exits with code 1 if any expectation fails.
+
+Usage (from the backend directory):
+    python benchmarks/check_context_cache.py
+"""
+import asyncio
+import os
+import sqlite3
+import time
+
+import httpx
+
+from check_harness import check_environment, expect, fake_gemini, finish, free_port
+
+PORT = free_port()
+DB_PATH = os.path.join(check_environment(
+    "cache", PORT,
+    GEMINI_CONTEXT_CACHE_ENABLED="true",
+    # The system prompt is below Gemini's minimum; fake_gemini.py has none
+    GEMINI_CONTEXT_CACHE_MIN_TOKENS="0",
+    RECOMMENDATION_CACHE_ENABLED="false",
+), "check.db")
+
+from app.database import SessionLocal, init_db
+from app.crud import create_recommendation_set, create_user
+from app.metrics import UPSTREAM_TOKENS
+from app.services import gemini_service
+from app.services.context_cache import ContextCache
+from app.services.gemini_service import USAGE_KEY, context_cache, fetch_recommendations
+from app.services.upstream import close_client, start_client
+
+
+async def fake_stats() -> dict:
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"http://127.0.0.1:{PORT}/stats")).json()
+
+
+async def run_checks() -> None:
+    await start_client()
+    try:
+        result = await fetch_recommendations("first prompt")
+        stats = await fake_stats()
+        expect(stats["caches_created"] == 1 and stats["cached_requests"] == 1, "first call creates and uses the cache")
+        usage = result.get(USAGE_KEY) or {}
+        expect(usage.get("cached_tokens") == 700 and usage.get("output_tokens") == 900,
+               f"usage is returned with the answer: {usage}")
+        expect(UPSTREAM_TOKENS.count(kind="cached") == 1, "token usage is observed in the metrics")
+
+        await fetch_recommendations("second prompt")
+        stats = await fake_stats()
+        expect(stats["caches_created"] == 1 and stats["cached_requests"] == 2, "later calls reuse the entry")
+
+        context_cache._expires_at = time.monotonic() + context_cache.refresh_margin / 2
+        await fetch_recommendations("third prompt")
+        stats = await fake_stats()
+        expect(stats["caches_refreshed"] == 1 and stats["caches_created"] == 1, "entry is refreshed before it expires")
+
+        original = gemini_service.get_system_prompt
+        gemini_service.get_system_prompt = lambda: original() + "\nAlways mention wax."
+        try:
+            await fetch_recommendations("fourth prompt")
+        finally:
+            gemini_service.get_system_prompt = original
+        stats = await fake_stats()
+        expect(stats["caches_created"] == 2 and stats["caches_deleted"] == 1,
+               "changed system prompt recreates the entry and deletes the old one")
+        await fetch_recommendations("fifth prompt")  # original prompt again
+
+        async with httpx.AsyncClient() as client:
+            await client.post(f"http://127.0.0.1:{PORT}/admin/drop-caches")
+        before = await fake_stats()
+        result = await fetch_recommendations("sixth prompt")
+        after = await fake_stats()
+        expect(bool(result.get("categories")) and after["inline_requests"] == before["inline_requests"] + 1,
+               "a vanished entry falls back to an inline request")
+        await fetch_recommendations("seventh prompt")
+        stats = await fake_stats()
+        expect(stats["caches_created"] == before["caches_created"] + 1 and stats["cached_requests"] > after["cached_requests"],
+               "the entry is recreated on the next call")
+
+        broken = ContextCache(f"http://127.0.0.1:{PORT}/v1beta/missing", "fake-key", gemini_service.MODEL,
+                              enabled=True, retry_after=60)
+        first = await broken.name("prompt")
+        retry_at = broken._retry_at
+        second = await broken.name("prompt")
+        expect(first is None and second is None and broken._retry_at == retry_at,
+               "creation failures fall back to inline and back off")
+
+        before = await fake_stats()
+        small = ContextCache(f"http://127.0.0.1:{PORT}/v1beta", "fake-key", gemini_service.MODEL,
+                             enabled=True, min_tokens=1024)
+        name = await small.name(gemini_service.get_system_prompt())
+        expect(name is None and (await fake_stats())["caches_created"] == before["caches_created"],
+               "a system prompt below the minimum cacheable size is sent inline without a create call")
+    finally:
+        await close_client()
+
+
+def check_database() -> None:
+    # A recommendation_sets table from before the usage columns existed
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("CREATE TABLE users (id VARCHAR PRIMARY KEY, created_at DATETIME)")
+    conn.execute("CREATE TABLE recommendation_sets (id VARCHAR PRIMARY KEY, user_id VARCHAR, prompt_text TEXT, created_at DATETIME)")
+    conn.commit()
+    conn.close()
+
+    init_db()
+    columns = {row[1] for row in sqlite3.connect(DB_PATH).execute("PRAGMA table_info(recommendation_sets)")}
+    expect({"prompt_tokens", "cached_tokens", "output_tokens"} <= columns, "init_db adds the usage columns")
+
+    with SessionLocal() as db:
+        create_user(db, "check-user")
+        usage = {"prompt_tokens": 712, "cached_tokens": 700, "output_tokens": 900}
+        recommendation_set = create_recommendation_set(db, "check-user", "prompt", {"categories": []}, usage=usage)
+        stored = (recommendation_set.prompt_tokens, recommendation_set.cached_tokens, recommendation_set.output_tokens)
+    expect(stored == (712, 700, 900), f"usage is stored on the set: {stored}")
+
+
+def main():
+    with fake_gemini(PORT, "--latency", "0", "--latency-jitter", "0"):
+        check_database()
+        asyncio.run(run_checks())
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Scaffolding shared by the check scripts: a scratch directory and database,
+the settings the app reads when it is imported, benchmarks/fake_gemini.py
+and ok/FAIL reporting.
+
+Import it, and call check_environment(), before anything from `app`.
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from load_test import free_port, wait_until_up
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.abspath(os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BACKEND_DIR)
+
+failures = 0
+
+
+def expect(condition: bool, message: str) -> None:
+    global failures
+    print(f"{'ok  ' if condition else 'FAIL'} {message}")
+    failures += not condition
+
+
+def finish() -> None:
+    """Exits with code 1 if any expectation failed"""
+    sys.exit(1 if failures else 0)
+
+
+def check_environment(name: str, fake_port: Optional[int] = None, **settings: str) -> str:
+    """
+    Creates a scratch directory with the database `check.db` in it and sets
+    the environment the app reads: a fake API key, that database, quiet
+    logging, fake_gemini.py on `fake_port` when given, then `settings`.
+    Returns the directory.
+    """
+    tmp = tempfile.mkdtemp(prefix=f"slopeselector-{name}-check-")
+    env = {
+        "GEMINI_API_KEY": "fake-key",
+        "DATABASE_URL": f"sqlite:///{os.path.join(tmp, 'check.db')}",
+        "LOG_LEVEL": "ERROR",
+    }
+    if fake_port is not None:
+        env["GEMINI_API_BASE"] = f"http://127.0.0.1:{fake_port}/v1beta"
+    env.update(settings)
+    os.environ.update(env)
+    return tmp
+
+
+@contextmanager
+def fake_gemini(port: int, *args: str) -> Iterator[str]:
+    """Runs benchmarks/fake_gemini.py on `port` with extra `args` until the block ends; yields its URL"""
+    url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "fake_gemini.py"), "--port", str(port), *args])
+    try:
+        asyncio.run(wait_until_up(f"{url}/stats"))
+        yield url
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Check for hedged requests across model tiers.
+
+Runs services/hedging.hedged() against scripted calls (fast primary, slow
+primary, failing and invalid primaries, both failing), checks that the
+deadline follows the latency percentile, then starts
+benchmarks/fake_gemini.py with a slow primary model and a fast hedge model
+and checks that a recommendation is answered by the hedge tier, the slow
+call is cancelled, the hedge metric counts it, a cancelled half-open trial does not leave
+the primary's circuit breaker stuck and the tier is stored on the set. Exits with code 1 if any expectation fails.
+
+Usage (from the backend directory):
+    python benchmarks/check_hedging.py
+"""
+import asyncio
+import time
+
+from check_harness import check_environment, expect, fake_gemini, finish, free_port
+
+PORT = free_port()
+check_environment(
+    "hedge", PORT,
+    GEMINI_MODEL="gemini-2.5-pro",
+    GEMINI_HEDGE_MODEL="gemini-2.5-flash",
+    GEMINI_HEDGE_ENABLED="true",
+    GEMINI_HEDGE_INITIAL_DELAY="0.5",
+    GEMINI_HEDGE_MIN_DELAY="0.1",
+)
+
+from app.database import SessionLocal, init_db
+from app.crud import create_recommendation_set, create_user
+from app.metrics import UPSTREAM_HEDGES
+from app.services.gemini_service import USAGE_KEY, circuit_breaker, fetch_recommendations, is_valid_answer
+from app.services.hedging import LatencyTracker, hedged
+from app.services.upstream import UpstreamUnavailableError, close_client, start_client
+
+VALID = {"categories": [{"categoryTitle": "Skis", "products": []}]}
+
+
+def scripted(delay: float, result=None, error: Exception = None, log: list = None, name: str = ""):
+    async def call():
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            if log is not None:
+                log.append(f"{name} cancelled")
+            raise
+        if error is not None:
+            raise error
+        return result
+    return call
+
+
+async def check_race() -> None:
+    observed = []
+    winner, _ = await hedged(scripted(0.01, VALID), scripted(0.01, VALID), 0.2, is_valid_answer, observed.append)
+    await asyncio.sleep(0)
+    expect(winner == "primary" and len(observed) == 1, "a primary inside the deadline sends no hedge")
+
+    log, observed = [], []
+    start = time.perf_counter()
+    winner, _ = await hedged(scripted(5, VALID, log=log, name="primary"), scripted(0.05, VALID), 0.1,
+                             is_valid_answer, observed.append)
+    elapsed = time.perf_counter() - start
+    await asyncio.sleep(0)
+    expect(winner == "hedge" and elapsed < 1 and log == ["primary cancelled"],
+           f"a slow primary loses to the hedge and is cancelled ({elapsed:.2f}s)")
+    expect(len(observed) == 1 and observed[0] >= 0.1, "the cancelled primary is recorded as a lower bound")
+
+    winner, _ = await hedged(scripted(0.01, error=RuntimeError("boom")), scripted(0.05, VALID), 5, is_valid_answer)
+    expect(winner == "hedge", "a failed primary is hedged at once, without waiting for the deadline")
+
+    winner, _ = await hedged(scripted(0.01, {"categories": []}), scripted(0.05, VALID), 5, is_valid_answer)
+    expect(winner == "hedge", "an answer that does not conform to the schema does not win")
+
+    winner, _ = await hedged(scripted(0.3, VALID), scripted(0.05, error=RuntimeError("hedge down")), 0.1,
+                             is_valid_answer)
+    expect(winner == "primary", "a failed hedge leaves the primary to answer")
+
+    try:
+        await hedged(scripted(0.01, error=RuntimeError("primary")), scripted(0.01, error=RuntimeError("hedge")), 1,
+                     is_valid_answer)
+        expect(False, "both calls failing raises")
+    except RuntimeError as e:
+        expect(str(e) == "primary", "both calls failing raises the primary's error")
+
+    tracker = LatencyTracker(percentile=95, min_delay=0.5, max_delay=30, initial_delay=20, min_samples=20)
+    expect(tracker.deadline() == 20, "the initial deadline is used until there are enough samples")
+    for i in range(100):
+        tracker.observe(1 + i / 10)
+    expect(abs(tracker.deadline() - 10.5) < 1e-9, f"the deadline is the 95th percentile ({tracker.deadline():.2f}s)")
+
+
+async def check_upstream() -> None:
+    await start_client()
+    try:
+        fired = UPSTREAM_HEDGES.value(reason="deadline", winner="hedge")
+        start = time.perf_counter()
+        result = await fetch_recommendations("slow primary prompt")
+        elapsed = time.perf_counter() - start
+        usage = result.get(USAGE_KEY) or {}
+        expect(usage.get("model_tier") == "hedge" and usage.get("model") == "gemini-2.5-flash",
+               f"the hedge tier answers a slow primary ({elapsed:.2f}s, {usage.get('model')})")
+        expect(elapsed < 2, "the answer arrives well before the primary would have")
+        expect(UPSTREAM_HEDGES.value(reason="deadline", winner="hedge") == fired + 1, "the hedge metric counts it")
+
+        # The slow primary is the half-open trial call, and the hedge cancels it
+        circuit_breaker.state = circuit_breaker.OPEN
+        circuit_breaker.opened_at = time.monotonic() - circuit_breaker.reset_timeout - 1
+        await fetch_recommendations("slow primary prompt, half-open")
+        await asyncio.sleep(0.05)
+        try:
+            circuit_breaker.before_call()
+            released = True
+        except UpstreamUnavailableError:
+            released = False
+        circuit_breaker.record_success()
+        expect(released, "a cancelled half-open trial lets the next call through as the trial")
+
+        init_db()
+        with SessionLocal() as db:
+            create_user(db, "check-user")
+            usage = result.pop(USAGE_KEY)
+            stored = create_recommendation_set(db, "check-user", "slow primary prompt", result, usage=usage)
+            expect((stored.model_tier, stored.model) == ("hedge", "gemini-2.5-flash"), "the tier is stored on the set")
+    finally:
+        await close_client()
+
+
+def main():
+    asyncio.run(check_race())
+    with fake_gemini(PORT, "--latency", "0", "--latency-jitter", "0",
+                     "--model-latency", "gemini-2.5-pro=5", "--model-latency", "gemini-2.5-flash=0.1"):
+        asyncio.run(check_upstream())
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Check for asynchronous recommendation jobs.
+
+Drives the app in-process against benchmarks/fake_gemini.py (1.5 s per
+call, longer than the 1 s job lease) and checks that:
+
+    - no workers run before the first job; POST /api/recommendations/jobs
+      starts them, answers 202 at once and the job can be polled until it
+      points at its recommendation set
+    - an Idempotency-Key resubmission returns the same job and calls Gemini
+      once; reusing the key for another prompt is a 409
+    - a job claimed by a worker that died is picked up again once its lease
+      expires, and fails after JOB_MAX_ATTEMPTS claims
+    - a worker whose lease was taken over writes nothing
+    - stopping the workers hands an unfinished job back to the queue, and
+      workers started for it at the next startup answer it
+
+Exits with code 1 if any expectation fails.
+
+Usage (from the backend directory):
+    python benchmarks/check_jobs.py
+"""
+import asyncio
+import time
+
+import httpx
+
+from check_harness import check_environment, expect, fake_gemini, finish, free_port
+
+PORT = free_port()
+check_environment(
+    "jobs", PORT,
+    RECOMMENDATION_CACHE_ENABLED="false",
+    JOB_WORKERS="2",
+    JOB_LEASE_SECONDS="1",
+    JOB_POLL_INTERVAL="0.1",
+    JOB_MAX_ATTEMPTS="3",
+)
+
+from app.crud import claim_job, create_job
+from app.database import SessionLocal, init_db
+from app.main import app
+from app.metrics import JOB_EVENTS
+from app.models import RecommendationJob, RecommendationSet
+from app.services.job_queue import job_workers
+from app.services.upstream import close_client, start_client
+
+
+def job_row(job_id: str) -> RecommendationJob:
+    with SessionLocal() as db:
+        return db.get(RecommendationJob, job_id)
+
+
+async def wait_for(job_id: str, statuses=("succeeded", "failed"), timeout: float = 20) -> RecommendationJob:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = job_row(job_id)
+        if job.status in statuses:
+            return job
+        await asyncio.sleep(0.1)
+    return job_row(job_id)
+
+
+async def check_api(client: httpx.AsyncClient, fake: httpx.AsyncClient) -> None:
+    await job_workers.start_if_pending()
+    expect(job_workers.stats()["job_workers"] == 0, "no workers run while there are no jobs")
+    start = time.perf_counter()
+    response = await client.post("/api/recommendations/jobs", json={"prompt": "powder skis", "userId": "check-user"})
+    elapsed = time.perf_counter() - start
+    job = response.json()
+    expect(response.status_code == 202 and job["status"] == "queued"
+           and response.headers["Location"] == f"/api/recommendations/jobs/{job['id']}",
+           f"a job is accepted with 202 in {elapsed * 1000:.0f} ms")
+
+    statuses = set()
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        polled = (await client.get(f"/api/recommendations/jobs/{job['id']}")).json()
+        statuses.add(polled["status"])
+        if polled["status"] in ("succeeded", "failed"):
+            break
+        await asyncio.sleep(0.2)
+    set_response = await client.get(f"/api/recommendations/{polled['recommendation_set_id']}")
+    expect(polled["status"] == "succeeded" and "running" in statuses and set_response.status_code == 200
+           and job_workers.stats()["job_workers"] == 2,
+           f"the first job starts the workers; polling shows it running, then its set ({sorted(statuses)})")
+    expect((await client.get("/api/recommendations/jobs/missing")).status_code == 404, "an unknown job is a 404")
+
+    calls = (await fake.get("/stats")).json()["requests"]
+    headers = {"Idempotency-Key": "order-42"}
+    first = await client.post("/api/recommendations/jobs", json={"prompt": "carving skis", "userId": "check-user"}, headers=headers)
+    again = await client.post("/api/recommendations/jobs", json={"prompt": "carving skis", "userId": "check-user"}, headers=headers)
+    expect(first.json()["id"] == again.json()["id"] and again.status_code == 202, "a resubmitted key returns the same job")
+    await wait_for(first.json()["id"])
+    expect((await fake.get("/stats")).json()["requests"] == calls + 1, "and Gemini is called once")
+    other_user = await client.post("/api/recommendations/jobs", json={"prompt": "carving skis", "userId": "other-user"}, headers=headers)
+    conflict = await client.post("/api/recommendations/jobs", json={"prompt": "park skis", "userId": "check-user"}, headers=headers)
+    expect(other_user.json()["id"] != first.json()["id"] and conflict.status_code == 409,
+           "keys are per user, and reusing one for another request is a 409")
+    await wait_for(other_user.json()["id"])
+
+
+async def check_leases() -> None:
+    loop = asyncio.get_running_loop()
+
+    def crash(prompt: str, claims: int, lease_seconds: float) -> str:
+        # Claims always take the oldest claimable job, which is this one
+        with SessionLocal() as db:
+            job, _ = create_job(db, "check-user", prompt)
+            for _ in range(claims):
+                time.sleep(0.01)
+                claim_job(db, "crashed-worker", lease_seconds, 3)
+            return job.id
+
+    # Workers are stopped while a crashed worker "holds" the jobs
+    await job_workers.stop(5)
+    exhausted = await loop.run_in_executor(None, crash, "exhausted job", 3, 0)
+    crashed = await loop.run_in_executor(None, crash, "crashed worker job", 1, 0.5)
+    await job_workers.start()
+    job = await wait_for(crashed)
+    expect(job.status == "succeeded" and job.attempts == 2, f"an expired lease is claimed again ({job.status}, {job.attempts} attempts)")
+    job = await wait_for(exhausted)
+    expect(job.status == "failed" and job.attempts == 3, f"a job whose leases keep expiring fails ({job.status}, {job.attempts} attempts)")
+
+    lost = JOB_EVENTS.value(event="lease_lost")
+    with SessionLocal() as db:
+        stolen_id = create_job(db, "check-user", "stolen lease job")[0].id
+    job_workers.notify()
+    await wait_for(stolen_id, ("running",))
+    with SessionLocal() as db:
+        db.query(RecommendationJob).filter(RecommendationJob.id == stolen_id).update({"lease_owner": "other-worker"})
+        db.commit()
+    await asyncio.sleep(2)
+    with SessionLocal() as db:
+        written = db.query(RecommendationSet).filter(RecommendationSet.prompt_text == "stolen lease job").count()
+    expect(JOB_EVENTS.value(event="lease_lost") == lost + 1 and written == 0, "a worker that lost its lease writes nothing")
+    job = await wait_for(stolen_id)
+    expect(job.status == "succeeded", "and the job is answered once the other lease expires")
+
+    with SessionLocal() as db:
+        stopped_id = create_job(db, "check-user", "job at shutdown")[0].id
+    job_workers.notify()
+    await wait_for(stopped_id, ("running",))
+    await job_workers.stop(0.2)
+    job = job_row(stopped_id)
+    expect(job.status == "queued" and job.attempts == 0 and job.lease_owner is None,
+           f"stopping the workers hands an unfinished job back ({job.status}, {job.attempts} attempts)")
+    await job_workers.start_if_pending()
+    job = await wait_for(stopped_id)
+    expect(job.status == "succeeded", "and workers started for jobs left at startup answer it")
+
+
+async def main_async() -> None:
+    init_db()
+    await start_client()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://app", timeout=60) as client, \
+                httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}") as fake:
+            await check_api(client, fake)
+            await check_leases()
+    finally:
+        await job_workers.stop(0)
+        await close_client()
+
+
+def main():
+    with fake_gemini(PORT, "--latency", "1.5", "--latency-jitter", "0"):
+        asyncio.run(main_async())
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Check for run_server.py's production mode.
+
+Starts benchmarks/fake_gemini.py and `run_server.py --production --workers 2`
+on a fresh SQLite file, then checks that:
+
+    - the database was initialized (in WAL mode) before the workers started
+    - the caches and rate limits run on the shared database backend, and
+      each worker takes its share of the upstream cap
+    - one Gemini context cache entry serves every worker
+    - a request still waiting on Gemini when the server is stopped is answered
+      and stored before the process exits
+
+Exits with code 1 if any expectation fails.
+
+Usage (from the backend directory):
+    python benchmarks/check_production_server.py
+"""
+import asyncio
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+
+import httpx
+
+from check_harness import BACKEND_DIR, check_environment, expect, fake_gemini, finish, free_port, wait_until_up
+
+
+async def drive(app_url: str, fake_url: str, server: subprocess.Popen, db_path: str) -> None:
+    async with httpx.AsyncClient(base_url=app_url, timeout=60) as client:
+        stats = (await client.get("/api/cache/stats")).json()
+        expect(stats.get("backend") == "database", f"caches use the shared backend ({stats.get('backend')})")
+        expect(stats.get("upstream_max_concurrent") == 8,
+               f"each worker takes half the upstream cap ({stats.get('upstream_max_concurrent')} of 16)")
+
+        first = await client.post("/api/recommendations", json={"prompt": "warm-up prompt", "userId": "check-user"})
+        # A new connection per request, so the requests spread over both workers
+        async def recommend(i):
+            async with httpx.AsyncClient(base_url=app_url, timeout=60) as fresh:
+                return await fresh.post("/api/recommendations", json={"prompt": f"prompt {i}", "userId": "check-user"})
+        responses = await asyncio.gather(*(recommend(i) for i in range(12)))
+        expect(first.status_code == 200 and all(r.status_code == 200 for r in responses), "requests are served")
+        bucket = sqlite3.connect(db_path).execute("SELECT tokens FROM rate_limit_buckets WHERE key = 'check-user'").fetchone()
+        left = bucket[0] if bucket else float("nan")
+        expect(left < 10, f"both workers charge the user's one rate limit bucket ({left:.1f} of 20 left)")
+
+        fake = (await httpx.AsyncClient().get(f"{fake_url}/stats")).json()
+        expect(fake["caches_created"] == 1 and fake["cached_requests"] == 13,
+               f"workers share one context cache entry (created {fake['caches_created']}, "
+               f"cached requests {fake['cached_requests']})")
+
+        pending = asyncio.ensure_future(client.post("/api/recommendations", json={"prompt": "in flight at shutdown", "userId": "check-user"}))
+        await asyncio.sleep(0.5)
+        server.send_signal(signal.SIGTERM)
+        response = await pending
+        expect(response.status_code == 200, f"a request in flight at shutdown is answered ({response.status_code})")
+
+    await asyncio.get_running_loop().run_in_executor(None, server.wait, 60)
+    stored = sqlite3.connect(db_path).execute(
+        "SELECT COUNT(*) FROM recommendation_sets WHERE prompt_text = 'in flight at shutdown'"
+    ).fetchone()[0]
+    expect(stored == 1, "and its set is stored before the server exits")
+
+
+def main():
+    fake_port, app_port = free_port(), free_port()
+    # The server processes inherit this environment
+    tmp = check_environment(
+        "production", fake_port,
+        GEMINI_CONTEXT_CACHE_ENABLED="true",
+        # The system prompt is below Gemini's minimum; fake_gemini.py has none
+        GEMINI_CONTEXT_CACHE_MIN_TOKENS="0",
+        LOG_LEVEL="INFO",
+    )
+    db_path = os.path.join(tmp, "check.db")
+    log_path = os.path.join(tmp, "server.log")
+    with fake_gemini(fake_port, "--latency", "1.5", "--latency-jitter", "0") as fake_url:
+        with open(log_path, "w") as log:
+            server = subprocess.Popen([sys.executable, "run_server.py", "--production", "--workers", "2",
+                                       "--host", "127.0.0.1", "--port", str(app_port)],
+                                      cwd=BACKEND_DIR, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            asyncio.run(wait_until_up(f"http://127.0.0.1:{app_port}/"))
+            journal_mode = sqlite3.connect(db_path).execute("PRAGMA journal_mode").fetchone()[0]
+            expect(journal_mode == "wal", f"the database is in WAL mode ({journal_mode})")
+            asyncio.run(drive(f"http://127.0.0.1:{app_port}", fake_url, server, db_path))
+        finally:
+            if server.poll() is None:
+                server.terminate()
+                server.wait(timeout=30)
+
+    with open(log_path) as f:
+        output = f.read()
+    workers = output.count("Application startup complete")
+    expect(workers == 2, f"both workers started ({workers})")
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Query-count regression check for the recommendation set read path.
+
+Loads sets of increasing size through crud.get_recommendation_set and
+crud.recommendation_set_to_response and fails (exit code 1) if the number
+of SQL statements grows with the size of the set or exceeds the budget.
+
+Usage (from the backend directory):
+    python benchmarks/check_query_counts.py
+"""
+from check_harness import expect, finish
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from app.database import Base
+from app import models  # noqa: F401  (registers tables)
+from app.search import ensure_search_index
+from app.crud import create_user, create_recommendation_set, get_recommendation_set, recommendation_set_to_response
+from bench_create_recommendation_set import make_recommendations
+
+# set + categories + category products + catalog products + details (with text) + store links
+READ_QUERY_BUDGET = 6
+
+
+def count_read_queries(engine, db, set_id):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        db.expunge_all()
+        response = recommendation_set_to_response(get_recommendation_set(db, set_id))
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements), response
+
+
+def main():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    ensure_search_index(db)
+    create_user(db, "check-user")
+
+    for categories, products in [(1, 1), (4, 3), (8, 6)]:
+        recommendations = make_recommendations(categories, products)
+        recommendation_set = create_recommendation_set(db, "check-user", "prompt", recommendations)
+        queries, response = count_read_queries(engine, db, recommendation_set.id)
+        expect(queries <= READ_QUERY_BUDGET and response["categories"] == recommendations["categories"],
+               f"{categories}x{products} set: {queries} queries (budget {READ_QUERY_BUDGET})")
+
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Check for history retention, archival and compaction.
+
+Writes a history of sets aged 1 to 500 days (one of them from before
+stored bodies existed) to a database file created without incremental
+auto-vacuum, runs one maintenance pass (app/services/maintenance.run_once)
+and checks that:
+
+    - sets past ARCHIVE_AFTER_DAYS lose their category rows but are served
+      with the same body and ETag, and still appear in history and search
+    - sets past DELETE_AFTER_DAYS are gone everywhere, recent sets untouched
+    - catalog products only archived sets used are pruned, shared ones kept,
+      and a set written while a prune is under way keeps its products whole
+    - finished jobs past JOB_RETENTION_DAYS are deleted
+    - the file is converted to incremental auto-vacuum and its free pages
+      are released
+    - a second pass within MAINTENANCE_INTERVAL is skipped
+
+Exits with code 1 if any expectation fails.
+
+Usage (from the backend directory):
+    python benchmarks/check_retention.py
+"""
+import asyncio
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import httpx
+
+from check_harness import check_environment, expect, finish
+
+DB_PATH = os.path.join(check_environment(
+    "retention",
+    ARCHIVE_AFTER_DAYS="30",
+    DELETE_AFTER_DAYS="365",
+    JOB_RETENTION_DAYS="7",
+    MAINTENANCE_BATCH_SIZE="25",
+), "check.db")
+
+from app.crud import create_job, create_recommendation_set, get_recommendation_set, recommendation_set_to_response
+from app.database import SessionLocal, engine, init_db
+from app.main import app
+from app.models import (
+    CatalogProduct, Category, MaintenanceRun, RecommendationBody, RecommendationJob, RecommendationSet,
+)
+from app.retention import delete_sets, prune_catalog
+from app.services.maintenance import run_once
+
+
+def answer(label: str, shared: bool) -> dict:
+    products = [{
+        "name": f"{label} ski {i}",
+        "brand": "Shared" if shared and i == 0 else f"{label} brand",
+        "description": f"All-mountain ski number {i} for {label}. " * 20,
+        "priceRange": "$500-600",
+        "pros": [f"{label} pro {i}", "Stable at speed"],
+        "cons": [f"{label} con {i}"],
+        "highlight": "Best Value",
+        "storeLink": [f"https://www.rei.com/product/{label}-{i}"],
+    } for i in range(4)]
+    if shared:
+        products[0]["name"] = "Shared ski"
+    return {"categories": [{"categoryTitle": f"{label} skis", "products": products}]}
+
+
+def write_history() -> dict:
+    """Sets keyed by name; `shared` sets all recommend the same first product"""
+    ages = {"recent": 1, "recent-2": 10, "old-shared": 60, "legacy": 90, "ancient": 500}
+    sets = {}
+    with SessionLocal() as db:
+        for name, age in ages.items():
+            set_id = create_recommendation_set(db, "check-user", f"{name} skis for Utah", answer(name, name != "legacy")).id
+            db.query(RecommendationSet).filter(RecommendationSet.id == set_id)\
+                .update({"created_at": datetime.utcnow() - timedelta(days=age)})
+            sets[name] = set_id
+        # Filler that makes the archive free a good number of pages
+        for i in range(150):
+            set_id = create_recommendation_set(db, "filler-user", f"filler skis {i}", answer(f"filler{i}", False)).id
+            db.query(RecommendationSet).filter(RecommendationSet.id == set_id)\
+                .update({"created_at": datetime.utcnow() - timedelta(days=40 + i % 100)})
+        # A set written before bodies were stored
+        db.query(RecommendationBody).filter(RecommendationBody.set_id == sets["legacy"]).delete()
+
+        for name, age in (("old-job", 30), ("new-job", 1)):
+            sets[name] = create_job(db, "check-user", name)[0].id
+            db.query(RecommendationJob).filter(RecommendationJob.id == sets[name]).update({
+                "status": "succeeded",
+                "recommendation_set_id": sets["ancient"],
+                "finished_at": datetime.utcnow() - timedelta(days=age),
+            })
+        db.commit()
+    return sets
+
+
+class WriteBeforeDeletes:
+    """Session proxy that runs `write` between prune_catalog's read of candidates and its deletes"""
+
+    def __init__(self, db, write):
+        self._db = db
+        self._write = write
+        self._calls = 0
+
+    def execute(self, *args, **kwargs):
+        self._calls += 1
+        if self._calls == 2:
+            self._write()
+        return self._db.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+def check_prune_race() -> None:
+    """A product that becomes linked again after prune_catalog picked it is left alone"""
+    with SessionLocal() as db:
+        create_recommendation_set(db, "race-user", "race skis", answer("race", False))
+        while delete_sets(db, datetime.utcnow() + timedelta(seconds=1)):
+            pass
+    written = {}
+
+    def write_set() -> None:
+        with SessionLocal() as other:
+            written["id"] = create_recommendation_set(other, "race-user", "race skis again", answer("race", False)).id
+
+    with SessionLocal() as db:
+        prune_catalog(WriteBeforeDeletes(db, write_set), 1000)
+        products = recommendation_set_to_response(get_recommendation_set(db, written["id"]))["categories"][0]["products"]
+        kept = db.query(CatalogProduct).filter(CatalogProduct.brand == "race brand").count()
+    expect(kept == 4 and all(p["pros"] and p["cons"] and p["storeLink"] for p in products),
+           "a set written during a prune keeps its products whole")
+
+
+async def fetch(client: httpx.AsyncClient, set_id: str, **headers) -> httpx.Response:
+    return await client.get(f"/api/recommendations/{set_id}", headers=headers)
+
+
+async def check() -> None:
+    # A file created before incremental auto-vacuum was turned on
+    sqlite3.connect(DB_PATH).execute("CREATE TABLE legacy_marker (x)").connection.close()
+    init_db()
+    sets = write_history()
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://app") as client:
+        before = {name: await fetch(client, set_id) for name, set_id in sets.items() if not name.endswith("job")}
+        # Reading the legacy set stores its body; drop it again so archival has to render one
+        with SessionLocal() as db:
+            db.query(RecommendationBody).filter(RecommendationBody.set_id == sets["legacy"]).delete()
+            db.commit()
+            catalog_before = db.query(CatalogProduct).count()
+
+        summary = run_once(force=True)
+        print(f"     pass: {json.dumps(summary)}")
+
+        with SessionLocal() as db:
+            archived = {s.id for s in db.query(RecommendationSet).filter(RecommendationSet.archived_at.isnot(None))}
+            trees = {row[0] for row in db.query(Category.recommendation_set_id).distinct()}
+            shared_kept = db.query(CatalogProduct).filter(CatalogProduct.name == "Shared ski").count() == 1
+            legacy_pruned = db.query(CatalogProduct).filter(CatalogProduct.brand == "legacy brand").count() == 0
+            catalog_after = db.query(CatalogProduct).count()
+            jobs = {job.id: job for job in db.query(RecommendationJob)}
+            run = db.get(MaintenanceRun, "retention")
+
+        expect({sets["old-shared"], sets["legacy"]} <= archived and not trees & archived
+               and summary["archived"] == 152, f"old sets are archived without their trees ({summary['archived']})")
+        for name in ("old-shared", "legacy"):
+            response = await fetch(client, sets[name])
+            expect(response.status_code == 200 and response.content == before[name].content
+                   and response.headers["ETag"] == before[name].headers["ETag"],
+                   f"archived set '{name}' is served with the same body and ETag")
+        not_modified = await fetch(client, sets["legacy"], **{"If-None-Match": before["legacy"].headers["ETag"]})
+        expect(not_modified.status_code == 304, "and revalidates with 304")
+
+        history = {item["id"] for item in (await client.get("/api/history/check-user")).json()}
+        found = {item["id"] for item in (await client.get("/api/search", params={"q": "skis utah"})).json()}
+        expect({sets["old-shared"], sets["legacy"]} <= history & found, "archived sets stay in history and search")
+
+        expect((await fetch(client, sets["ancient"])).status_code == 404
+               and sets["ancient"] not in history | found and summary["deleted"] == 1,
+               "sets past DELETE_AFTER_DAYS are gone")
+        recent = await fetch(client, sets["recent"])
+        expect(recent.content == before["recent"].content and sets["recent"] in trees and sets["recent"] not in archived,
+               "recent sets are untouched")
+
+        expect(shared_kept and legacy_pruned and catalog_after == catalog_before - summary["catalog_pruned"],
+               f"unlinked catalog products are pruned, shared ones kept ({catalog_before} -> {catalog_after})")
+        expect(sets["old-job"] not in jobs and jobs[sets["new-job"]].recommendation_set_id is None,
+               "old finished jobs are deleted, newer ones lose the link to a deleted set")
+
+    compacted = summary["compact"]
+    with engine.connect() as conn:
+        auto_vacuum = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+    expect(auto_vacuum == 2 and compacted["after"]["free_pages"] < max(1, compacted["before"]["free_pages"])
+           and compacted["after"]["pages"] < compacted["before"]["pages"],
+           f"the file is converted to incremental auto-vacuum and shrinks ({compacted['before']} -> {compacted['after']})")
+
+    expect(run.finished_at is not None and json.loads(run.summary)["archived"] == summary["archived"],
+           "the pass is recorded in maintenance_runs")
+    expect(run_once() is None, "a second pass within the interval is skipped")
+    check_prune_race()
+
+
+def main():
+    asyncio.run(check())
+    finish()
+
+
+if __name__ == "__main__":
+    main()
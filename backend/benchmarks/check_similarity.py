@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Check for similarity-based answer reuse.
+
+Runs app/similarity.PromptIndex against a few prompts (rewording, changed
+budget, unrelated prompt, eviction) and against real paraphrases at the
+default threshold, where only near-identical wording is reused; then drives the app in-process against
+benchmarks/fake_gemini.py and checks that a near-duplicate prompt is served
+from the earlier set without a Gemini call, with the similarity reported in
+headers and on the stream, and that the reuse is stored on the new set.
+Exits with code 1 if any expectation fails.
+
+Usage (from the backend directory, needs numpy):
+    python benchmarks/check_similarity.py
+"""
+import asyncio
+import json
+import sys
+
+import httpx
+
+from check_harness import check_environment, expect, fake_gemini, finish, free_port
+
+PORT = free_port()
+check_environment("similarity", PORT, SIMILARITY_REUSE_ENABLED="true", SIMILARITY_THRESHOLD="0.9")
+
+from app.database import SessionLocal, init_db
+from app.main import app
+from app.models import RecommendationSet
+from app.services.upstream import close_client, start_client
+from app.similarity import PromptIndex, np
+
+PROMPT = "I'm an intermediate skier heading to Utah, budget $800. What gear should I get?"
+
+
+def check_index() -> None:
+    index = PromptIndex(dimensions=1024, max_entries=3, threshold=0.9)
+    index.add([
+        ("utah", PROMPT),
+        ("tahoe", "Expert snowboarder going to Lake Tahoe, what board and boots?"),
+        ("touring", "Which avalanche beacon and skins for backcountry touring?"),
+    ])
+    set_id, similarity = index.lookup("i'm an intermediate skier heading to utah - budget $800, what gear should i get")
+    expect(set_id == "utah" and similarity > 0.95, f"a change of case and punctuation finds the set ({similarity:.3f})")
+    set_id, similarity = index.lookup("I'm an intermediate skier heading to Utah, budget $1,200. What gear should I get?")
+    expect(set_id is None and similarity > 0.9, f"a different budget is not reused ({similarity:.3f})")
+    set_id, similarity = index.lookup("What wax for cross-country racing skis?")
+    expect(set_id is None and similarity < 0.5, f"an unrelated prompt is not reused ({similarity:.3f})")
+
+    index.add([("utah-2", PROMPT.upper())])
+    expect(len(index) == 3 and index.lookup(PROMPT)[0] == "utah-2", "a repeated prompt points at its newest set")
+    index.add([("crosscountry", "What wax for cross-country racing skis?")])
+    expect(len(index) == 3 and index.lookup(PROMPT)[0] is None
+           and index.lookup("what wax for cross country racing skis")[0] == "crosscountry",
+           "a full index replaces its oldest row")
+
+    # Real paraphrases at the default threshold: the same words in another
+    # order are reused, other words for the same request are not
+    index = PromptIndex(dimensions=1024, max_entries=10, threshold=0.95)
+    index.add([
+        ("utah", PROMPT),
+        ("tahoe", "beginner snowboarder, Tahoe, $500"),
+        ("touring", "Which avalanche beacon and skins for backcountry touring?"),
+    ])
+    set_id, similarity = index.lookup("Intermediate skier, heading to Utah, $800 budget: what gear should I get?")
+    expect(set_id == "utah", f"a paraphrase that reorders the same words is reused ({similarity:.3f})")
+    set_id, similarity = index.lookup("I'm an intermediate skier going to Utah with a budget of $800. What gear should I buy?")
+    expect(set_id is None and 0.7 < similarity < 0.95,
+           f"a paraphrase in other words is not reused at 0.95 ({similarity:.3f})")
+    set_id, similarity = index.lookup("new to snowboarding, going to Tahoe, budget 500")
+    expect(set_id is None and similarity < 0.6, f"a free paraphrase scores far below the threshold ({similarity:.3f})")
+
+
+async def check_app() -> None:
+    init_db()
+    await start_client()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://app", timeout=60) as client, \
+                httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}") as fake:
+            first = await client.post("/api/recommendations", json={"prompt": PROMPT, "userId": "check-user"})
+            calls = (await fake.get("/stats")).json()["requests"]
+
+            reworded = "intermediate skier heading to Utah, budget $800 - what gear should I get?"
+            second = await client.post("/api/recommendations", json={"prompt": reworded, "userId": "check-user"})
+            expect(second.status_code == 200 and second.headers.get("X-Reused-From") == first.json()["id"],
+                   f"a near-duplicate is served from the earlier set (similarity {second.headers.get('X-Similarity')})")
+            expect((await fake.get("/stats")).json()["requests"] == calls, "without calling Gemini")
+            expect(second.json()["categories"] == first.json()["categories"] and second.json()["id"] != first.json()["id"],
+                   "with the stored categories, as a set of its own")
+
+            with SessionLocal() as db:
+                stored = db.get(RecommendationSet, second.json()["id"])
+                expect(stored.reused_from == first.json()["id"] and stored.similarity > 0.9,
+                       "the reuse and its similarity are stored on the set")
+
+            events, reused = [], {}
+            async with client.stream("POST", "/api/recommendations/stream",
+                                     json={"prompt": "I am an intermediate skier heading to Utah, budget $800. What gear should I get?", "userId": "check-user"}) as response:
+                async for line in response.aiter_lines():
+                    if line.startswith("event: "):
+                        events.append(line[7:])
+                    elif line.startswith("data: ") and events[-1] == "reused":
+                        reused = json.loads(line[6:])
+            expect(events[:1] == ["reused"] and events[-1:] == ["complete"] and reused.get("reusedFrom") == first.json()["id"],
+                   f"the stream reports the reuse first (similarity {reused.get('similarity')})")
+
+            third = await client.post("/api/recommendations", json={"prompt": PROMPT.replace("$800", "$300"), "userId": "check-user"})
+            expect("X-Reused-From" not in third.headers and (await fake.get("/stats")).json()["requests"] == calls + 1,
+                   "a prompt with a different budget goes to Gemini")
+    finally:
+        await close_client()
+
+
+def main():
+    if np is None:
+        sys.exit("numpy is required: pip install numpy")
+    check_index()
+    with fake_gemini(PORT, "--latency", "0.1", "--latency-jitter", "0"):
+        asyncio.run(check_app())
+    finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Offline evaluation of similarity-based answer reuse (app/similarity.py).
+
+Replays a stream of prompts through a PromptIndex at several thresholds:
+each prompt is looked up, a hit reuses the stored answer, and a miss "calls
+the model" and adds the prompt to the index, as the server does. For each
+threshold it reports the hit rate, the upstream time saved (hits times
+--upstream-latency, less the time spent on lookups) and, for generated
+prompts, how many reuses were wrong.
+
+By default the prompts are generated: paraphrases of requests that differ
+in skill level, sport, destination and budget, so a reuse is correct only
+if all four match. With --database the prompts stored in a SlopeSelector
+database are replayed in the order they were written instead; there is no
+ground truth then, only hit rate and time saved.
+
+Usage (from the backend directory, needs numpy):
+    python benchmarks/eval_similarity.py
+    python benchmarks/eval_similarity.py --prompts 5000 --upstream-latency 20
+    python benchmarks/eval_similarity.py --database sqlite:///./slopeselector.db
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from typing import List, Optional, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.similarity import PromptIndex, np
+
+SKILLS = {
+    "beginner": ["beginner", "first-time", "novice"],
+    "intermediate": ["intermediate", "intermediate-level"],
+    "advanced": ["advanced"],
+    "expert": ["expert", "very experienced"],
+}
+SPORTS = {
+    "ski": {"person": ["skier"], "gear": ["ski", "skiing"]},
+    "snowboard": {"person": ["snowboarder", "boarder"], "gear": ["snowboard", "snowboarding"]},
+}
+PLACES = ["Lake Tahoe", "Colorado", "Utah", "Whistler", "Japan", "Vermont", "the Alps", "Jackson Hole"]
+BUDGETS = [None, None, 300, 500, 800, 1200]
+TEMPLATES = [
+    "I'm a {skill} {person} heading to {place}{budget_clause}. What gear should I get?",
+    "{skill} {person} looking for gear for {place}{budget_clause}",
+    "What {gear} gear should a {skill} {person} buy for a trip to {place}?{budget_sentence}",
+    "Recommend {gear} equipment for a {skill} {person} going to {place}{budget_clause}",
+    "need a {gear} setup, {skill} {person}, trip to {place}{budget_clause}",
+    "Going to {place} soon as a {skill} {person}. Which {gear} gear do you recommend?{budget_sentence}",
+]
+BUDGET_CLAUSES = [", budget ${budget}", " under ${budget}", " with about ${budget} to spend"]
+BUDGET_SENTENCES = [" Budget is ${budget}.", " I can spend up to ${budget}."]
+
+
+def generate(count: int, seed: int) -> List[Tuple[str, tuple]]:
+    """`count` paraphrased prompts with the (skill, sport, place, budget) they ask about"""
+    rng = random.Random(seed)
+    prompts = []
+    for _ in range(count):
+        skill, sport, place, budget = rng.choice(list(SKILLS)), rng.choice(list(SPORTS)), rng.choice(PLACES), rng.choice(BUDGETS)
+        budget_clause = rng.choice(BUDGET_CLAUSES).format(budget=budget) if budget else ""
+        budget_sentence = rng.choice(BUDGET_SENTENCES).format(budget=budget) if budget else ""
+        prompt = rng.choice(TEMPLATES).format(
+            skill=rng.choice(SKILLS[skill]),
+            person=rng.choice(SPORTS[sport]["person"]),
+            gear=rng.choice(SPORTS[sport]["gear"]),
+            place=place,
+            budget_clause=budget_clause,
+            budget_sentence=budget_sentence,
+        )
+        if rng.random() < 0.3:
+            prompt = prompt.lower()
+        if rng.random() < 0.2:
+            prompt += rng.choice([" Thanks!", " Please help.", " thx"])
+        prompts.append((prompt, (skill, sport, place, budget)))
+    return prompts
+
+
+def load(database_url: str) -> List[Tuple[str, None]]:
+    """Stored prompts answered by the model, oldest first"""
+    from sqlalchemy import create_engine, text
+    engine = create_engine(database_url)
+    with engine.connect() as conn:
+        columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(recommendation_sets)")} \
+            if engine.dialect.name == "sqlite" else {"reused_from"}
+        where = "WHERE reused_from IS NULL" if "reused_from" in columns else ""
+        rows = conn.execute(text(f"SELECT prompt_text FROM recommendation_sets {where} ORDER BY created_at")).all()
+    return [(row[0], None) for row in rows if row[0]]
+
+
+def replay(prompts: List[Tuple[str, Optional[tuple]]], threshold: float, dimensions: int) -> dict:
+    index = PromptIndex(dimensions=dimensions, max_entries=len(prompts) or 1, threshold=threshold)
+    truth = {}
+    hits = wrong = 0
+    lookup_seconds = 0.0
+    for i, (prompt, label) in enumerate(prompts):
+        start = time.perf_counter()
+        set_id, _ = index.lookup(prompt)
+        lookup_seconds += time.perf_counter() - start
+        if set_id is None:
+            truth[str(i)] = label
+            index.add([(str(i), prompt)])
+        else:
+            hits += 1
+            wrong += label is not None and truth[set_id] != label
+    return {"hits": hits, "wrong": wrong, "lookup_seconds": lookup_seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hit rate against upstream time saved for similarity reuse")
+    parser.add_argument("--prompts", type=int, default=3000, help="generated prompts to replay")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--database", help="replay the prompts stored in this database instead")
+    parser.add_argument("--thresholds", default="0.7,0.75,0.8,0.85,0.9,0.95")
+    parser.add_argument("--dimensions", type=int, default=1024, help="hashed feature dimensions (SIMILARITY_DIMENSIONS)")
+    parser.add_argument("--upstream-latency", type=float, default=15.0, help="seconds a Gemini call takes")
+    args = parser.parse_args()
+    if np is None:
+        sys.exit("numpy is required: pip install numpy")
+
+    prompts = load(args.database) if args.database else generate(args.prompts, args.seed)
+    labelled = not args.database
+    print(f"{len(prompts)} prompts from {args.database or 'the generator'}, "
+          f"{args.dimensions} dimensions, {args.upstream_latency:.1f}s per upstream call")
+    if labelled:
+        distinct = len({label for _, label in prompts})
+        print(f"{distinct} distinct requests: at most {1 - distinct / len(prompts):.1%} of prompts can be reused correctly")
+    print()
+    header = f"{'threshold':>9}  {'hit rate':>8}  {'wrong':>7}  {'lookup ms':>9}  {'saved s':>9}  {'saved/prompt':>12}"
+    print(header)
+    print("-" * len(header))
+    for threshold in (float(t) for t in args.thresholds.split(",")):
+        result = replay(prompts, threshold, args.dimensions)
+        hits = result["hits"]
+        saved = hits * args.upstream_latency - result["lookup_seconds"]
+        wrong = f"{result['wrong'] / hits:.1%}" if labelled and hits else "-"
+        print(f"{threshold:>9.2f}  {hits / len(prompts):>8.1%}  {wrong:>7}  "
+              f"{1000 * result['lookup_seconds'] / len(prompts):>9.3f}  {saved:>9.0f}  {saved / len(prompts):>11.2f}s")
+
+
+if __name__ == "__main__":
+    main()
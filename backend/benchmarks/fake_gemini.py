@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Gemini generateContent API, for offline benchmarks.
+
+Serves POST /v1beta/models/{model}:generateContent and
+:streamGenerateContent with schema-conforming recommendation JSON, after a
+configurable delay (per model, with an optional slow tail) and with
+configurable 500 and 429 rates. Also implements
+enough of /v1beta/cachedContents (create, TTL update, delete) to exercise
+system-prompt context caching; POST /admin/drop-caches forgets every entry
+to simulate expiry upstream. Responses carry usageMetadata.
+
+Usage (from the backend directory):
+    python benchmarks/fake_gemini.py --port 8090 --latency 2.0 --error-rate 0.02
+    python benchmarks/fake_gemini.py --latency 2.0 --tail-rate 0.05 --tail-latency 30 \
+        --model-latency gemini-2.5-flash=0.5
+    GEMINI_API_BASE=http://127.0.0.1:8090/v1beta GEMINI_API_KEY=fake python run_server.py
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def build_recommendations(categories: int, products: int, description_chars: int) -> dict:
+    """A schema-conforming answer of roughly the requested size"""
+    filler = ("88mm waist, 170cm length, intermediate flex. " * (description_chars // 45 + 1))[:description_chars]
+    return {
+        "categories": [
+            {
+                "categoryTitle": f"Category {c}",
+                "products": [
+                    {
+                        "name": f"Fake Product {c}-{p}",
+                        "brand": f"Brand {p}",
+                        "description": filler,
+                        "priceRange": "$400-500",
+                        "pros": ["Stable at speed", "Easy to turn", "Great value"],
+                        "cons": ["Heavy"],
+                        "highlight": "Best Value",
+                        "storeLink": [],
+                    }
+                    for p in range(products)
+                ],
+            }
+            for c in range(categories)
+        ]
+    }
+
+
+def create_app(args: argparse.Namespace) -> FastAPI:
+    app = FastAPI(title="Fake Gemini")
+    stats = {"requests": 0, "errors": 0, "rate_limited": 0, "cached_requests": 0, "inline_requests": 0,
+             "caches_created": 0, "caches_refreshed": 0, "caches_deleted": 0, "requests_by_model": {}}
+    model_latency = dict(parse_model_latency(value) for value in args.model_latency)
+    caches = {}  # name -> expiry (epoch seconds)
+
+    def parse_ttl(value: str) -> float:
+        return float(str(value).rstrip("s") or 0)
+
+    def error(code: int, message: str) -> JSONResponse:
+        return JSONResponse({"error": {"code": code, "message": message}}, status_code=code)
+
+    async def simulate(prompt: str, model: str):
+        """Sleeps for the model's latency; returns an error response or None"""
+        stats["requests"] += 1
+        stats["requests_by_model"][model] = stats["requests_by_model"].get(model, 0) + 1
+        latency = model_latency.get(model, args.latency)
+        if random.random() < args.tail_rate:
+            latency = args.tail_latency
+        await asyncio.sleep(max(0.0, random.gauss(latency, args.latency_jitter)))
+        roll = random.random()
+        if roll < args.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return JSONResponse({"error": {"code": 429, "message": "Resource exhausted"}}, status_code=429,
+                                headers={"Retry-After": str(args.retry_after)})
+        if roll < args.rate_limit_rate + args.error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": {"code": 500, "message": "Internal error"}}, status_code=500)
+        return None
+
+    def answer_text(prompt: str) -> str:
+        answer = build_recommendations(args.categories, args.products, args.description_chars)
+        answer["categories"][0]["categoryTitle"] = prompt[:60]
+        return json.dumps(answer)
+
+    def usage(prompt: str, cached: bool) -> dict:
+        prompt_tokens = args.system_tokens + len(prompt) // 4 + 1
+        usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": 900,
+                 "totalTokenCount": prompt_tokens + 900}
+        if cached:
+            usage["cachedContentTokenCount"] = args.system_tokens
+        return usage
+
+    def extract_prompt(body: dict) -> str:
+        try:
+            return body["contents"][0]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            return ""
+
+    @app.post("/v1beta/models/{model_method}")
+    async def generate(model_method: str, request: Request):
+        body = await request.json()
+        prompt = extract_prompt(body)
+        cached_content = body.get("cachedContent")
+        if cached_content:
+            if caches.get(cached_content, 0) < time.time():
+                return error(404, f"CachedContent not found (or permission denied): {cached_content}")
+            if "systemInstruction" in body:
+                return error(400, "CachedContent can not be used with systemInstruction")
+            stats["cached_requests"] += 1
+        else:
+            stats["inline_requests"] += 1
+        failure = await simulate(prompt, model_method.split(":")[0])
+        if failure is not None:
+            return failure
+        text = answer_text(prompt)
+        usage_metadata = usage(prompt, bool(cached_content))
+
+        if model_method.endswith(":streamGenerateContent"):
+            async def events():
+                step = max(1, len(text) // args.stream_chunks)
+                for i in range(0, len(text), step):
+                    chunk = {"candidates": [{"content": {"parts": [{"text": text[i:i + step]}]}}]}
+                    if i + step >= len(text):
+                        chunk["usageMetadata"] = usage_metadata
+                    yield f"data: {json.dumps(chunk)}\r\n\r\n"
+                    await asyncio.sleep(args.stream_interval)
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        return {
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}],
+            "usageMetadata": usage_metadata,
+            "modelVersion": model_method.split(":")[0],
+        }
+
+    @app.post("/v1beta/cachedContents")
+    async def create_cache(request: Request):
+        body = await request.json()
+        if args.no_context_cache:
+            return error(400, "Cached content is too small for this model")
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        caches[name] = time.time() + parse_ttl(body.get("ttl", "3600s"))
+        stats["caches_created"] += 1
+        return {"name": name, "model": body.get("model"), "usageMetadata": {"totalTokenCount": args.system_tokens}}
+
+    @app.patch("/v1beta/cachedContents/{cache_id}")
+    async def update_cache(cache_id: str, request: Request):
+        name = f"cachedContents/{cache_id}"
+        if caches.get(name, 0) < time.time():
+            return error(404, f"CachedContent not found: {name}")
+        caches[name] = time.time() + parse_ttl((await request.json()).get("ttl", "3600s"))
+        stats["caches_refreshed"] += 1
+        return {"name": name}
+
+    @app.delete("/v1beta/cachedContents/{cache_id}")
+    async def delete_cache(cache_id: str):
+        if caches.pop(f"cachedContents/{cache_id}", None) is not None:
+            stats["caches_deleted"] += 1
+        return {}
+
+    @app.post("/admin/drop-caches")
+    async def drop_caches():
+        caches.clear()
+        return {}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def parse_model_latency(value: str):
+    model, _, seconds = value.partition("=")
+    return model, float(seconds)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=1.0, help="mean response delay in seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.2, help="std deviation of the delay")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SECONDS",
+                        help="mean delay for one model instead of --latency (repeatable)")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="fraction of requests delayed by --tail-latency")
+    parser.add_argument("--tail-latency", type=float, default=30.0, help="delay of the slow tail in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--products", type=int, default=3)
+    parser.add_argument("--description-chars", type=int, default=60, help="payload size knob per product")
+    parser.add_argument("--stream-chunks", type=int, default=20)
+    parser.add_argument("--stream-interval", type=float, default=0.05)
+    parser.add_argument("--system-tokens", type=int, default=700, help="token size reported for the system prompt")
+    parser.add_argument("--no-context-cache", action="store_true", help="reject cachedContents creation")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
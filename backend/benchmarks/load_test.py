@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Offline load test for the backend.
+
+Starts benchmarks/fake_gemini.py and the FastAPI app (uvicorn, fresh SQLite
+file) as subprocesses, points the app at the fake upstream through
+GEMINI_API_BASE, and drives three phases at a fixed concurrency:
+
+    recommend  POST /api/recommendations with unique prompts
+    history    GET  /api/history/{userId}
+    set_fetch  GET  /api/recommendations/{setId}
+
+For each phase it reports req/s, error count and p50/p95/p99 latency, plus
+database growth per 1k recommendation sets, and writes everything to JSON.
+Pass --compare with an earlier results file to print the change.
+
+Usage (from the backend directory):
+    python benchmarks/load_test.py --requests 500 --concurrency 32 --latency 0.2
+    python benchmarks/load_test.py --output after.json --compare before.json
+    python benchmarks/load_test.py --tail-rate 0.05 --tail-latency 10 \
+        --app-env GEMINI_HEDGE_ENABLED=true --model-latency gemini-2.5-flash=0.3
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def db_size(path: str) -> int:
+    """Size of the SQLite file including its WAL/journal side files"""
+    return sum(os.path.getsize(p) for p in (path, path + "-wal", path + "-journal") if os.path.exists(p))
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def wait_until_up(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+async def run_phase(name, make_request, total, concurrency):
+    """Runs `total` requests with at most `concurrency` in flight"""
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    async def worker():
+        nonlocal errors
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                ok = await make_request(i)
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "requests": total,
+        "errors": errors,
+        "duration_s": round(elapsed, 3),
+        "req_per_s": round(total / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+    print(f"{name:<10} {result['req_per_s']:>9.2f} req/s  p50 {result['p50_ms']:>9.2f} ms  "
+          f"p95 {result['p95_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms  errors {errors}")
+    return result
+
+
+async def drive(args, app_url, db_path):
+    users = [f"bench-user-{i}" for i in range(args.users)]
+    set_ids = []
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=app_url, timeout=args.timeout, limits=limits) as client:
+        size_before = db_size(db_path)
+
+        async def recommend(i):
+            response = await client.post("/api/recommendations", json={
+                "prompt": f"benchmark prompt {i}: intermediate skier, all-mountain, ${random.randint(300, 900)} budget",
+                "userId": users[i % len(users)],
+            })
+            if response.status_code == 200:
+                set_ids.append(response.json()["id"])
+                return True
+            return False
+
+        async def history(i):
+            response = await client.get(f"/api/history/{users[i % len(users)]}")
+            return response.status_code == 200
+
+        async def set_fetch(i):
+            response = await client.get(f"/api/recommendations/{set_ids[i % len(set_ids)]}")
+            return response.status_code == 200
+
+        results = {"recommend": await run_phase("recommend", recommend, args.requests, args.concurrency)}
+        # Let any write-behind queue flush before measuring the file
+        await asyncio.sleep(1.0)
+        size_after = db_size(db_path)
+        if set_ids:
+            results["history"] = await run_phase("history", history, args.read_requests, args.concurrency)
+            results["set_fetch"] = await run_phase("set_fetch", set_fetch, args.read_requests, args.concurrency)
+
+    growth = (size_after - size_before) / len(set_ids) * 1000 if set_ids else 0.0
+    results["db"] = {
+        "sets_written": len(set_ids),
+        "size_bytes": size_after,
+        "growth_bytes_per_1k_sets": round(growth),
+    }
+    print(f"db growth  {growth / 1024 / 1024:.2f} MiB per 1k sets ({len(set_ids)} sets, {size_after} bytes total)")
+    return results
+
+
+def compare(current: dict, baseline: dict) -> None:
+    print(f"\nchange vs {baseline.get('commit', '?')}:")
+    for phase in ("recommend", "history", "set_fetch"):
+        if phase not in current["results"] or phase not in baseline.get("results", {}):
+            continue
+        now, then = current["results"][phase], baseline["results"][phase]
+        parts = []
+        for key in ("req_per_s", "p50_ms", "p95_ms", "p99_ms"):
+            if then.get(key):
+                parts.append(f"{key} {(now[key] - then[key]) / then[key] * 100:+.1f}%")
+        print(f"  {phase:<10} " + "  ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="recommendation requests to send")
+    parser.add_argument("--read-requests", type=int, default=1000, help="requests per read phase")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--latency", type=float, default=0.5, help="fake Gemini mean latency (s)")
+    parser.add_argument("--latency-jitter", type=float, default=0.1)
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="fraction of fake Gemini calls in the slow tail")
+    parser.add_argument("--tail-latency", type=float, default=10.0, help="fake Gemini slow-tail latency (s)")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SECONDS",
+                        help="fake Gemini mean latency for one model (repeatable)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--categories", type=int, default=4)
+    parser.add_argument("--products", type=int, default=3)
+    parser.add_argument("--description-chars", type=int, default=60)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve through run_server.py --production with this many workers (default: plain uvicorn)")
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the app, e.g. USE_ASYNC_DB=true (repeatable)")
+    parser.add_argument("--output", default=None, help="results JSON path (default: benchmarks/results/<commit>-<time>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    fake_port, app_port = free_port(), free_port()
+    tmp = tempfile.mkdtemp(prefix="slopeselector-bench-")
+    db_path = os.path.join(tmp, "bench.db")
+
+    fake_cmd = [
+        sys.executable, os.path.join(BACKEND_DIR, "benchmarks", "fake_gemini.py"),
+        "--port", str(fake_port),
+        "--latency", str(args.latency), "--latency-jitter", str(args.latency_jitter),
+        "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+        "--categories", str(args.categories), "--products", str(args.products),
+        "--description-chars", str(args.description_chars),
+        "--tail-rate", str(args.tail_rate), "--tail-latency", str(args.tail_latency),
+    ]
+    for item in args.model_latency:
+        fake_cmd += ["--model-latency", item]
+    app_env = dict(os.environ)
+    app_env.update({
+        "GEMINI_API_KEY": "fake-key",
+        "GEMINI_API_BASE": f"http://127.0.0.1:{fake_port}/v1beta",
+        "DATABASE_URL": f"sqlite:///{db_path}",
+        "LOG_LEVEL": "WARNING",
+    })
+    for item in args.app_env:
+        key, _, value = item.partition("=")
+        app_env[key] = value
+    app_cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(app_port), "--log-level", "warning"]
+    if args.workers:
+        app_cmd = [sys.executable, "run_server.py", "--production", "--workers", str(args.workers),
+                   "--host", "127.0.0.1", "--port", str(app_port)]
+
+    fake = subprocess.Popen(fake_cmd, cwd=BACKEND_DIR)
+    app = subprocess.Popen(app_cmd, cwd=BACKEND_DIR, env=app_env)
+    try:
+        app_url = f"http://127.0.0.1:{app_port}"
+        asyncio.run(wait_until_up(f"http://127.0.0.1:{fake_port}/stats"))
+        asyncio.run(wait_until_up(app_url + "/"))
+        results = asyncio.run(drive(args, app_url, db_path))
+    finally:
+        for process in (app, fake):
+            process.terminate()
+        for process in (app, fake):
+            process.wait(timeout=30)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": results,
+    }
+    output = args.output
+    if output is None:
+        results_dir = os.path.join(BACKEND_DIR, "benchmarks", "results")
+        os.makedirs(results_dir, exist_ok=True)
+        output = os.path.join(results_dir, f"{report['commit']}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
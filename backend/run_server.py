@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 """
 Startup script for SlopeSelector AI backend server
+
+    python run_server.py                            # development: one process, auto-reload
+    python run_server.py --production --workers 4   # production: worker processes, no reloader
 """
+import argparse
 import uvicorn
 import os
 from dotenv import load_dotenv
@@ -9,18 +13,81 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
+# Server settings, overridable through environment variables or flags
+SERVER_MODE = os.environ.get("SERVER_MODE", "development")
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "8000"))
+# uvicorn's own variable; production defaults to one worker per core
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "0")) or os.cpu_count() or 1
+# How long a stopping worker waits for in-flight requests (and their Gemini calls)
+SHUTDOWN_GRACE_PERIOD = float(os.environ.get("SHUTDOWN_GRACE_PERIOD", "90"))
+
+
+def _available(module: str) -> bool:
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def run_production(host: str, port: int, workers: int) -> None:
+    """
+    Initializes the database once, then serves with `workers` processes.
+
+    Workers skip init_db() in their startup hook, and with more than one
+    worker the caches and rate limits keep their state in the database
+    (SHARED_CACHE) unless it is set explicitly. uvicorn uses uvloop and httptools when installed.
+    """
+    if workers > 1:
+        os.environ.setdefault("SHARED_CACHE", "true")
+    # Each worker takes its share of the Gemini concurrency cap and queue
+    os.environ["SERVER_WORKERS"] = str(workers)
+
+    from app.database import engine, init_db
+    init_db()
+    # Workers open their own connections; don't hand them the parent's pool
+    engine.dispose()
+    os.environ["INIT_DB_ON_STARTUP"] = "false"
+
+    print(f"Starting {workers} worker(s) on {host}:{port} "
+          f"(event loop: {'uvloop' if _available('uvloop') else 'asyncio'}, "
+          f"HTTP parser: {'httptools' if _available('httptools') else 'h11'})")
+    uvicorn.run(
+        "app.main:app",
+        host=host,
+        port=port,
+        workers=workers,
+        loop="auto",
+        http="auto",
+        timeout_graceful_shutdown=SHUTDOWN_GRACE_PERIOD,
+        log_level="info"
+    )
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the SlopeSelector AI backend")
+    parser.add_argument("--production", action="store_true", default=SERVER_MODE == "production",
+                        help="run worker processes without the reloader (or set SERVER_MODE=production)")
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY, help="worker processes in production mode")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    args = parser.parse_args()
+
     # Check if GEMINI_API_KEY is set
     if not os.getenv("GEMINI_API_KEY"):
         print("⚠️  WARNING: GEMINI_API_KEY environment variable is not set!")
         print("   Please set your Gemini API key in a .env file or environment variable.")
         print("   Example: GEMINI_API_KEY=your_api_key_here")
         print()
-    
-    uvicorn.run(
-        "app.main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
+
+    if args.production:
+        run_production(args.host, args.port, args.workers)
+    else:
+        uvicorn.run(
+            "app.main:app",
+            host=args.host,
+            port=args.port,
+            reload=True,
+            log_level="info"
+        )